@@ -0,0 +1,203 @@
+"""Write-ahead journal of moves done in several steps, which are completed after a crash."""
+
+import email.parser
+import json
+import logging
+import os
+import pathlib
+import re
+import typing as t
+import uuid
+
+from .connection import Connection
+
+if t.TYPE_CHECKING:
+    from .imap_connection import IMAPConnection
+
+_LOG = logging.getLogger(__name__)
+
+MESSAGE_ID_HEADER = 'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'
+
+_UID_PATTERN = re.compile(rb'UID (\d+)')
+
+_UNQUOTABLE_PATTERN = re.compile(r'[^\x01-\x09\x0b\x0c\x0e-\x7f]')
+"""Characters that cannot be in an IMAP quoted string, see RFC 3501."""
+
+
+class JournalEntry(t.NamedTuple):
+    """Move of messages that was started, but was not known to be completed."""
+
+    entry_id: str
+    source: str
+    """Account of the source connection, see Connection.account."""
+    source_folder: str
+    uidvalidity: int
+    uids: t.Tuple[int, ...]
+    target: str
+    target_folder: str
+    copied: t.FrozenSet[int] = frozenset()
+    """UIDs of messages which the target confirmed to have."""
+
+
+class ActionJournal:
+    """Append-only file of JSON lines, each written to disk before the step it describes is taken.
+
+    A move of messages between folders or servers which is done via copy and delete is recorded
+    as "begin" line with the source and the target, "copied" lines with UIDs of messages which
+    the target confirmed to have, and "end" line after the originals were deleted.
+
+    If the daemon dies in the middle of a move, on the next start the move is rolled forward:
+    originals of copied messages are deleted. Originals of messages that were not confirmed
+    to be copied are deleted only if the target folder already has a message with the same
+    Message-Id; otherwise the move is abandoned, and the messages are simply filtered again.
+    Messages without Message-Id cannot be checked, so they are left where they are.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._path = path
+        self._entries = {}  # type: t.Dict[str, JournalEntry]
+        if path.is_file():
+            self._load()
+        self._compact()
+        self._file = path.open('a', encoding='utf-8')
+
+    def _load(self) -> None:
+        with self._path.open(encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line might be incomplete after a crash, and its step was never taken
+                    _LOG.warning('%s: ignoring incomplete record %r', self, line)
+                    continue
+                self._apply(record)
+        if self._entries:
+            _LOG.warning('%s: found %i incomplete moves', self, len(self._entries))
+
+    def _apply(self, record: t.Dict[str, t.Any]) -> None:
+        entry_id = record['id']
+        if record['op'] == 'begin':
+            self._entries[entry_id] = JournalEntry(
+                entry_id, record['source'], record['source_folder'], record['uidvalidity'],
+                tuple(record['uids']), record['target'], record['target_folder'])
+        elif record['op'] == 'copied':
+            entry = self._entries[entry_id]
+            self._entries[entry_id] = entry._replace(copied=entry.copied | set(record['uids']))
+        elif record['op'] == 'end':
+            del self._entries[entry_id]
+        else:
+            raise ValueError(f'unknown journal record: {record}')
+
+    def _compact(self) -> None:
+        """Rewrite the journal so that it contains only incomplete moves."""
+        temporary_path = self._path.with_name(f'{self._path.name}.tmp')
+        with temporary_path.open('w', encoding='utf-8') as journal_file:
+            for entry in self._entries.values():
+                journal_file.write(json.dumps(_begin_record(entry)) + '\n')
+                if entry.copied:
+                    record = {'op': 'copied', 'id': entry.entry_id, 'uids': sorted(entry.copied)}
+                    journal_file.write(json.dumps(record) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary_path, self._path)
+
+    def _write(self, record: t.Dict[str, t.Any]) -> None:
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._apply(record)
+
+    def begin(
+            self, source: 'IMAPConnection', source_folder: str, uidvalidity: int,
+            uids: t.Sequence[int], target: 'IMAPConnection', target_folder: str) -> str:
+        """Record the intent to move messages, before anything is copied."""
+        entry = JournalEntry(
+            uuid.uuid4().hex, source.account, source_folder, uidvalidity, tuple(uids),
+            target.account, target_folder)
+        self._write(_begin_record(entry))
+        return entry.entry_id
+
+    def record_copied(self, entry_id: str, uids: t.Sequence[int]) -> None:
+        """Record that the target confirmed to have given messages."""
+        self._write({'op': 'copied', 'id': entry_id, 'uids': list(uids)})
+
+    def end(self, entry_id: str) -> None:
+        """Record that the originals were deleted, or that there is nothing more to do."""
+        self._write({'op': 'end', 'id': entry_id})
+
+    @property
+    def pending(self) -> t.List[JournalEntry]:
+        return list(self._entries.values())
+
+    def recover(self, connections: t.Iterable[Connection]) -> None:
+        """Complete or abandon moves interrupted by a crash, using given (connected) connections.
+
+        Moves from or to accounts for which there is no connection are left for later.
+        """
+        connections_by_account = {connection.account: connection for connection in connections}
+        for entry in self.pending:
+            source = connections_by_account.get(entry.source)
+            target = connections_by_account.get(entry.target)
+            if source is None or target is None:
+                _LOG.warning('%s: cannot recover %s without connections', self, entry)
+                continue
+            try:
+                self._recover(entry, source, target)
+            except RuntimeError:
+                _LOG.exception('%s: failed to recover %s', self, entry)
+                continue
+            self.end(entry.entry_id)
+        self._file.close()
+        self._compact()
+        self._file = self._path.open('a', encoding='utf-8')
+
+    def _recover(
+            self, entry: JournalEntry, source: 'IMAPConnection', target: 'IMAPConnection'
+            ) -> None:
+        source.open_folder(entry.source_folder)
+        if source.uidvalidity != entry.uidvalidity:
+            _LOG.error('%s: UIDs of "%s" in %s changed, abandoning %s',
+                       self, entry.source_folder, source, entry)
+            return
+        remaining = set(source.retrieve_message_ids(entry.source_folder))
+        copied = [uid for uid in entry.uids if uid in entry.copied and uid in remaining]
+        unconfirmed = [uid for uid in entry.uids if uid not in entry.copied and uid in remaining]
+        found = []
+        if unconfirmed:
+            parser = email.parser.BytesHeaderParser()
+            for metadata, headers in source.retrieve_messages_parts(
+                    unconfirmed, ['UID', MESSAGE_ID_HEADER], entry.source_folder):
+                uid = int(_UID_PATTERN.search(metadata).group(1))
+                header = None if headers is None else parser.parsebytes(headers)['Message-Id']
+                message_id = None if header is None else str(header).strip()
+                if message_id is None or _UNQUOTABLE_PATTERN.search(message_id):
+                    _LOG.warning('%s: cannot check if message %i was copied', self, uid)
+                    continue
+                if target.retrieve_message_ids(
+                        entry.target_folder, ['HEADER', 'Message-Id', _quote(message_id)]):
+                    found.append(uid)
+        if copied or found:
+            source.delete_messages(copied + found, entry.source_folder)
+        _LOG.warning(
+            '%s: rolled forward move from %s "%s" to %s "%s": deleted %i originals,'
+            ' %i moves abandoned', self, source, entry.source_folder, target, entry.target_folder,
+            len(copied) + len(found), len(unconfirmed) - len(found))
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._path})'
+
+
+def _quote(value: str) -> str:
+    """Make an IMAP quoted string, see RFC 3501."""
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def _begin_record(entry: JournalEntry) -> t.Dict[str, t.Any]:
+    return {
+        'op': 'begin', 'id': entry.entry_id, 'source': entry.source,
+        'source_folder': entry.source_folder, 'uidvalidity': entry.uidvalidity,
+        'uids': list(entry.uids), 'target': entry.target, 'target_folder': entry.target_folder}
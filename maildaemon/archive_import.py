@@ -0,0 +1,381 @@
+"""Bulk import of messages from mbox files and Maildir directories into IMAP folders."""
+
+import calendar
+import collections
+import email.utils
+import imaplib
+import json
+import logging
+import mmap
+import os
+import pathlib
+import queue
+import re
+import threading
+import time
+import typing as t
+
+import timing
+
+from .forwarding import to_crlf
+from .imap_connection import IMAPConnection
+from .message_transfer import BATCH_SIZE, BATCH_BYTES
+from .replay import MAILDIR_FLAGS, MBOX_FLAGS
+
+_LOG = logging.getLogger(__name__)
+_TIME = timing.get_timing_group(__name__)
+
+SESSIONS = 4
+"""Default number of IMAP sessions appending messages in parallel."""
+
+PROGRESS_INTERVAL = 10.0
+"""Time in seconds between log messages with progress of an import."""
+
+STATISTICS_COUNTERS = ('imported', 'bytes', 'skipped', 'failed')
+
+_HEADERS_END = re.compile(rb'\r?\n\r?\n')
+_STATUS_HEADER = re.compile(rb'^(?:X-)?Status:[ \t]*([A-Za-z]*)', re.IGNORECASE | re.MULTILINE)
+_DATE_HEADER = re.compile(rb'^Date:[ \t]*(.*?)\r?$', re.IGNORECASE | re.MULTILINE)
+
+
+class ArchivedMessage(t.NamedTuple):
+    """Message read from an archive, with what is needed to append it to an IMAP folder."""
+
+    key: str
+    """Identifies the message within the archive: offset in mbox file, or unique Maildir name."""
+    raw: bytes
+    flags: t.FrozenSet[str]
+    """IMAP system flags, without backslashes."""
+    date: float
+    """Internal date, as timestamp."""
+
+
+def _mbox_date(from_line: bytes, headers: bytes) -> t.Optional[float]:
+    """Take date from "From " line of mbox message, or from its Date header if it has none."""
+    try:
+        return float(calendar.timegm(time.strptime(
+            b' '.join(from_line.split()[2:7]).decode('ascii'), '%a %b %d %H:%M:%S %Y')))
+    except (ValueError, UnicodeDecodeError):
+        pass
+    match = _DATE_HEADER.search(headers)
+    if match is None:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(match.group(1).decode('ascii')).timestamp()
+    except (ValueError, TypeError, UnicodeDecodeError):
+        return None
+
+
+def iterate_mbox(path: pathlib.Path) -> t.Iterator[ArchivedMessage]:
+    """Split mbox file into messages, by searching for "From " lines in the memory-mapped file.
+
+    Messages are split like mailbox.mbox does, but without parsing them. Flags are taken from
+    Status and X-Status headers, see replay.MBOX_FLAGS. Messages without a date in their
+    "From " line or in Date header get modification time of the file.
+    """
+    with path.open('rb') as mbox_file:
+        if os.fstat(mbox_file.fileno()).st_size == 0:
+            return
+        default_date = os.fstat(mbox_file.fileno()).st_mtime
+        with mmap.mmap(mbox_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:5] != b'From ':
+                raise ValueError(f'{path} is not an mbox file')
+            start = 0
+            while start < len(mapped):
+                end = mapped.find(b'\nFrom ', start)
+                end = len(mapped) if end == -1 else end + 1
+                from_line_end = mapped.find(b'\n', start, end)
+                if from_line_end == -1:
+                    from_line_end = end - 1
+                from_line = mapped[start:from_line_end]
+                raw = mapped[from_line_end + 1:end]
+                # the empty line before the next "From " line separates messages
+                if raw.endswith(b'\r\n\r\n'):
+                    raw = raw[:-2]
+                elif raw.endswith(b'\n\n'):
+                    raw = raw[:-1]
+                headers_end = _HEADERS_END.search(raw)
+                headers = raw if headers_end is None else raw[:headers_end.start()]
+                flags = frozenset(
+                    MBOX_FLAGS[flag] for match in _STATUS_HEADER.finditer(headers)
+                    for flag in match.group(1).decode() if flag in MBOX_FLAGS)
+                date = _mbox_date(from_line, headers)
+                yield ArchivedMessage(
+                    str(start), raw, flags, default_date if date is None else date)
+                start = end
+
+
+def iterate_maildir(path: pathlib.Path) -> t.Iterator[ArchivedMessage]:
+    """Read messages from "new" and "cur" subdirectories of Maildir.
+
+    Flags are taken from info part of file names, see replay.MAILDIR_FLAGS, and internal dates
+    are modification times of the files, like mailbox.MaildirMessage.get_date() returns.
+    """
+    for subdir in ('new', 'cur'):
+        subdir_path = path.joinpath(subdir)
+        for name in sorted(os.listdir(subdir_path)):
+            if name.startswith('.'):
+                continue
+            key, _, info = name.partition(':')
+            flags = info[2:] if info.startswith('2,') else ''
+            message_path = subdir_path.joinpath(name)
+            yield ArchivedMessage(
+                key, message_path.read_bytes(),
+                frozenset(MAILDIR_FLAGS[flag] for flag in flags if flag in MAILDIR_FLAGS),
+                message_path.stat().st_mtime)
+
+
+def iterate_archive(path: pathlib.Path) -> t.Iterator[ArchivedMessage]:
+    """Read messages from Maildir directory or mbox file."""
+    if path.is_dir():
+        if not all(path.joinpath(subdir).is_dir() for subdir in ('cur', 'new', 'tmp')):
+            raise ValueError(f'{path} is not a Maildir directory')
+        return iterate_maildir(path)
+    return iterate_mbox(path)
+
+
+def _envelope(message: ArchivedMessage) -> bytes:
+    """Create metadata of the message like in FETCH response, see IMAPConnection.add_message()."""
+    flags = ' '.join(f'\\{flag}' for flag in sorted(message.flags))
+    return f'FLAGS ({flags}) INTERNALDATE {imaplib.Time2Internaldate(message.date)}'.encode()
+
+
+class ImportCheckpoint:
+    """File of JSON lines with keys of messages that were imported, see ArchivedMessage.key.
+
+    Each line is written to disk after the server confirmed that it has the messages, so that
+    an interrupted import can be resumed without importing any message twice. A checkpoint
+    should be used for one archive and one folder only.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._path = path
+        self.keys = set()  # type: t.Set[str]
+        if path.is_file():
+            self._load()
+        self._compact()
+        self._file = path.open('a', encoding='utf-8')
+
+    def _load(self) -> None:
+        with self._path.open(encoding='utf-8') as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line might be incomplete after a crash, then its messages are imported
+                    # again, because there is no way to check if the server has them
+                    _LOG.warning('%s: ignoring incomplete record %r', self, line)
+                    continue
+                self.keys.update(record['keys'])
+        _LOG.info('%s: found %i imported messages', self, len(self.keys))
+
+    def _compact(self) -> None:
+        """Rewrite the checkpoint as one record, so that it ends with a complete line."""
+        temporary_path = self._path.with_name(f'{self._path.name}.tmp')
+        with temporary_path.open('w', encoding='utf-8') as checkpoint_file:
+            if self.keys:
+                checkpoint_file.write(json.dumps({'keys': sorted(self.keys)}) + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary_path, self._path)
+
+    def add(self, keys: t.Sequence[str]) -> None:
+        self._file.write(json.dumps({'keys': list(keys)}) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.keys.update(keys)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._path})'
+
+
+class ImportStatistics(t.NamedTuple):
+    """Outcome of an import."""
+
+    messages: int
+    bytes: int
+    skipped: int
+    """Number of messages that were imported before, according to the checkpoint."""
+    failed: int
+    elapsed: float
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+
+class ArchiveImport:
+    """Append messages from an archive to an IMAP folder, using several sessions in parallel.
+
+    The given (connected) connection is used as one of the sessions, and the other ones are
+    opened via IMAPConnection.open_session(). Messages are read in the calling thread,
+    and grouped into batches of at most batch_size messages and batch_bytes bytes. Each session
+    appends whole batches, using one MULTIAPPEND command if the server supports it.
+
+    Flags and internal dates of messages are preserved. If there is a checkpoint, messages
+    recorded in it are skipped, and each appended batch is recorded. A batch which failed
+    is not recorded, so that it is imported again when the import is resumed.
+    """
+
+    def __init__(
+            self, connection: IMAPConnection, folder: str = 'INBOX', sessions: int = SESSIONS,
+            batch_size: int = BATCH_SIZE, batch_bytes: int = BATCH_BYTES,
+            checkpoint: t.Optional[ImportCheckpoint] = None, extra_flags: t.Sequence[str] = ()):
+        assert sessions >= 1, sessions
+        assert batch_size >= 1, batch_size
+        self.connection = connection
+        self.folder = folder
+        self.sessions = sessions
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.checkpoint = checkpoint
+        self.extra_flags = extra_flags
+        self.statistics = collections.Counter({counter: 0 for counter in STATISTICS_COUNTERS})
+        self._last_progress = (0.0, 0)  # time and number of imported messages
+
+    def _batches(
+            self, messages: t.Iterable[ArchivedMessage]) -> t.Iterator[t.List[ArchivedMessage]]:
+        imported = set() if self.checkpoint is None else self.checkpoint.keys
+        batch = []  # type: t.List[ArchivedMessage]
+        batch_bytes = 0
+        for message in messages:
+            if message.key in imported:
+                self.statistics['skipped'] += 1
+                continue
+            if batch and (len(batch) >= self.batch_size
+                          or batch_bytes + len(message.raw) > self.batch_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(message)
+            batch_bytes += len(message.raw)
+        if batch:
+            yield batch
+
+    def _open_sessions(self) -> t.List[IMAPConnection]:
+        sessions = [self.connection]
+        try:
+            for _ in range(self.sessions - 1):
+                session = self.connection.open_session()
+                session.connect()
+                sessions.append(session)
+        except RuntimeError:
+            self._close_sessions(sessions)
+            raise
+        return sessions
+
+    def _close_sessions(self, sessions: t.Sequence[IMAPConnection]) -> None:
+        for session in sessions[1:]:
+            try:
+                session.disconnect()
+            except RuntimeError:
+                _LOG.warning('%s: failed to disconnect session %s', self, session)
+
+    def _append(self, session: IMAPConnection, batches: queue.Queue,
+                completed: queue.Queue) -> None:
+        """Append batches until None is taken, and put each batch with an error if it failed."""
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            try:
+                session.add_messages(
+                    [(_envelope(message), to_crlf(message.raw)) for message in batch],
+                    self.folder, self.extra_flags)
+            except Exception as err:
+                completed.put((batch, err))
+                continue
+            completed.put((batch, None))
+
+    def _record(self, completed: queue.Queue) -> None:
+        """Record batches completed so far, and log progress from time to time."""
+        while True:
+            try:
+                batch, error = completed.get_nowait()
+            except queue.Empty:
+                break
+            if error is not None:
+                _LOG.error('%s: failed to import %i messages: %s', self, len(batch), error)
+                self.statistics['failed'] += len(batch)
+                continue
+            if self.checkpoint is not None:
+                self.checkpoint.add([message.key for message in batch])
+            self.statistics['imported'] += len(batch)
+            self.statistics['bytes'] += sum(len(message.raw) for message in batch)
+        now = time.perf_counter()
+        last_time, last_imported = self._last_progress
+        if now - last_time >= PROGRESS_INTERVAL:
+            if last_time:
+                _LOG.warning('%s: imported %i messages, %.1f messages/s', self,
+                             self.statistics['imported'],
+                             (self.statistics['imported'] - last_imported) / (now - last_time))
+            self._last_progress = (now, self.statistics['imported'])
+
+    def run(self, path: pathlib.Path) -> ImportStatistics:
+        """Import messages from given mbox file or Maildir directory, and return statistics."""
+        self.statistics = collections.Counter({counter: 0 for counter in STATISTICS_COUNTERS})
+        self._last_progress = (time.perf_counter(), 0)
+        sessions = self._open_sessions()
+        batches = queue.Queue(2 * len(sessions))  # type: queue.Queue
+        completed = queue.Queue()  # type: queue.Queue
+        workers = [
+            threading.Thread(target=self._append, args=(session, batches, completed),
+                             name=f'{self} {i}', daemon=True)
+            for i, session in enumerate(sessions)]
+        try:
+            with _TIME.measure('import') as timer:
+                for worker in workers:
+                    worker.start()
+                try:
+                    for batch in self._batches(iterate_archive(path)):
+                        self._record(completed)
+                        batches.put(batch)
+                finally:
+                    for _ in workers:
+                        batches.put(None)
+                    for worker in workers:
+                        worker.join()
+                    self._record(completed)
+        finally:
+            self._close_sessions(sessions)
+        statistics = ImportStatistics(
+            self.statistics['imported'], self.statistics['bytes'], self.statistics['skipped'],
+            self.statistics['failed'], timer.elapsed)
+        _LOG.warning(
+            '%s: imported %i messages (%i bytes) from %s using %i sessions in %fs,'
+            ' %.1f messages/s, %.1f KiB/s; skipped %i, failed %i', self, statistics.messages,
+            statistics.bytes, path, len(sessions), statistics.elapsed,
+            statistics.messages_per_second, statistics.bytes_per_second / 1024,
+            statistics.skipped, statistics.failed)
+        return statistics
+
+    def __str__(self):
+        return f'{type(self).__name__}({self.connection} "{self.folder}")'
+
+
+def import_archive_from_config(
+        config: dict, connection_name: str, path: pathlib.Path, folder: str = 'INBOX',
+        sessions: int = SESSIONS,
+        checkpoint_path: t.Optional[pathlib.Path] = None) -> ImportStatistics:
+    """Import messages from given archive via IMAP connection with given name from configuration.
+
+    No other connections are established, and no filters are applied.
+    """
+    data = config['connections'][connection_name]
+    if data.get('protocol') != 'IMAP':
+        raise ValueError(f'connection "{connection_name}" is not an IMAP connection')
+    connection = IMAPConnection.from_dict(data)
+    checkpoint = None if checkpoint_path is None else ImportCheckpoint(checkpoint_path)
+    connection.connect()
+    try:
+        return ArchiveImport(connection, folder, sessions, checkpoint=checkpoint).run(path)
+    finally:
+        connection.disconnect()
+        if checkpoint is not None:
+            checkpoint.close()
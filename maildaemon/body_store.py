@@ -0,0 +1,164 @@
+"""Content-addressed store of complete raw messages, shared by all e-mail caches."""
+
+import hashlib
+import logging
+import pathlib
+import sqlite3
+import threading
+import time
+import typing as t
+import zlib
+
+from .message_store import split_raw_message
+
+_LOG = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bodies (
+    digest BLOB PRIMARY KEY,
+    size INTEGER NOT NULL,
+    header_digest BLOB NOT NULL,
+    stored_size INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    last_used REAL NOT NULL) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bodies_candidates ON bodies (size, header_digest);
+'''
+"""Schema of the store.
+
+Messages are keyed by SHA-256 digest of raw RFC 822 bytes, and they are stored compressed
+with zlib. Candidates for a message known only by its size and headers are found via
+the index on size and header digest.
+"""
+
+
+def header_digest(headers: bytes) -> bytes:
+    """Compute SHA-256 digest of raw headers, regardless of line endings."""
+    return hashlib.sha256(headers.replace(b'\r\n', b'\n').rstrip(b'\n')).digest()
+
+
+class BodyStore:
+    """Content-addressed, compressed store of raw messages.
+
+    The same message delivered to many accounts, or moved between servers, is stored once,
+    and it is downloaded only once as long as its raw bytes are identical.
+
+    It is safe to use from many threads, e.g. from the fetching thread of MessageTransfer.
+    """
+
+    def __init__(self, path: t.Optional[pathlib.Path] = None, compression_level: int = 6):
+        self._path = path
+        self.compression_level = compression_level
+        self._db = sqlite3.connect(
+            ':memory:' if path is None else str(path), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def put(self, raw_message: bytes) -> bytes:
+        """Store the raw message unless it is already stored, and return its digest."""
+        with self._lock:
+            digest = hashlib.sha256(raw_message).digest()
+            now = time.time()
+            cursor = self._db.execute(
+                'UPDATE bodies SET last_used = ? WHERE digest = ?', (now, digest))
+            if cursor.rowcount:
+                return digest
+            headers, _ = split_raw_message(raw_message)
+            data = zlib.compress(raw_message, self.compression_level)
+            self._db.execute(
+                'INSERT INTO bodies VALUES (?, ?, ?, ?, ?, ?)',
+                (digest, len(raw_message), header_digest(headers), len(data), data, now))
+            return digest
+
+    def get(self, digest: bytes) -> t.Optional[bytes]:
+        with self._lock:
+            row = self._db.execute('SELECT data FROM bodies WHERE digest = ?', (digest,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE bodies SET last_used = ? WHERE digest = ?', (time.time(), digest))
+            return zlib.decompress(row[0])
+
+    def find(self, size: int, headers: bytes) -> t.Optional[bytes]:
+        """Find a stored message with given size (RFC822.SIZE) and raw headers.
+
+        Integrity of the candidate is verified before it is returned. Hits and misses are counted,
+        and every hit counts as size bytes saved.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT digest, data FROM bodies WHERE size = ? AND header_digest = ?',
+                (size, header_digest(headers))).fetchall()
+            for digest, data in rows:
+                raw_message = zlib.decompress(data)
+                if hashlib.sha256(raw_message).digest() != digest:
+                    _LOG.error(
+                        '%s: stored message %s is corrupted, dropping it', self, digest.hex())
+                    self._db.execute('DELETE FROM bodies WHERE digest = ?', (digest,))
+                    continue
+                self._db.execute(
+                    'UPDATE bodies SET last_used = ? WHERE digest = ?', (time.time(), digest))
+                self.hits += 1
+                self.bytes_saved += size
+                return raw_message
+            self.misses += 1
+            return None
+
+    def collect_garbage(
+            self, max_age: t.Optional[float] = None, max_bytes: t.Optional[int] = None) -> int:
+        """Drop messages unused for longer than max_age seconds, and then least recently used
+        messages until compressed size of the store is at most max_bytes.
+
+        Return number of dropped messages.
+        """
+        with self._lock:
+            removed = 0
+            if max_age is not None:
+                removed += self._db.execute(
+                    'DELETE FROM bodies WHERE last_used < ?', (time.time() - max_age,)).rowcount
+            if max_bytes is not None:
+                rows = self._db.execute(
+                    'SELECT digest, stored_size FROM bodies ORDER BY last_used DESC').fetchall()
+                total = 0
+                dropped = []
+                for digest, stored_size in rows:
+                    total += stored_size
+                    if total > max_bytes:
+                        dropped.append((digest,))
+                self._db.executemany('DELETE FROM bodies WHERE digest = ?', dropped)
+                removed += len(dropped)
+            if removed:
+                _LOG.info('%s: garbage collection dropped %i messages', self, removed)
+            return removed
+
+    def statistics(self) -> t.Dict[str, t.Union[int, float]]:
+        with self._lock:
+            count, raw_bytes, stored_bytes = self._db.execute(
+                'SELECT COUNT(*), TOTAL(size), TOTAL(stored_size) FROM bodies').fetchone()
+            lookups = self.hits + self.misses
+            return {
+                'messages': count,
+                'raw_bytes': int(raw_bytes),
+                'stored_bytes': int(stored_bytes),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes_saved': self.bytes_saved}
+
+    def flush(self) -> None:
+        with self._lock:
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM bodies').fetchone()[0]
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._path})'
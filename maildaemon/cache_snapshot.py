@@ -0,0 +1,270 @@
+"""Binary snapshot of state of e-mail caches, for fast restarts."""
+
+import array
+import itertools
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import sys
+import typing as t
+
+import timing
+
+from .email_cache import EmailCache
+from .folder import Folder
+from .message import Message
+from .message_store import StoredMessage
+
+_LOG = logging.getLogger(__name__)
+_TIME = timing.get_timing_group(__name__)
+
+MAGIC = b'MDSNAP\r\n'
+
+VERSION = 1
+"""Version of the snapshot format, snapshots of other versions are ignored."""
+
+FILE_HEADER = struct.Struct('<8sHI')
+"""Magic, version and number of sections."""
+
+SECTION_HEADER = struct.Struct('<HHQIB')
+"""Lengths of account and folder names, UIDVALIDITY, number of messages and kind of UIDs.
+
+Section header is followed by the names and then by the columns, each prefixed by its length:
+
+- UIDs as array of unsigned 64-bit integers, or as offsets and contents of UIDL strings;
+- offsets and contents of distinct sets of flags, with flags separated by spaces;
+- index of set of flags of each message, as array of unsigned 16-bit integers;
+- offsets and contents of raw headers of messages.
+
+All offsets are arrays of unsigned 64-bit integers, with one more element than there are
+strings. All numbers are little-endian.
+"""
+
+COLUMN_HEADER = struct.Struct('<Q')
+
+UID_INT = 0
+UID_STR = 1
+
+_SectionKey = t.Tuple[str, str, int]
+_Section = t.Tuple[int, int, t.List[t.Tuple[int, int]]]
+
+
+def serialize_headers(message: Message) -> bytes:
+    """Represent headers of the message as raw header block, without the body."""
+    email_message = message._email_message
+    if email_message is None:
+        return b''
+    return ''.join(f'{key}: {value}\r\n' for key, value in email_message.items()).encode(
+        'utf-8', 'surrogateescape') + b'\r\n'
+
+
+def _array_to_bytes(values: array.array) -> bytes:
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _array_from_buffer(typecode: str, buffer: t.Any) -> array.array:
+    values = array.array(typecode)
+    values.frombytes(buffer)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _pack_strings(strings: t.Sequence[bytes]) -> t.Tuple[bytes, bytes]:
+    offsets = array.array('Q', [0])
+    offsets.extend(itertools.accumulate(len(string) for string in strings))
+    return _array_to_bytes(offsets), b''.join(strings)
+
+
+def _unpack_strings(
+        buffer: mmap.mmap, offsets_column: t.Tuple[int, int],
+        strings_column: t.Tuple[int, int]) -> t.List[str]:
+    offsets = _array_from_buffer('Q', buffer[offsets_column[0]:offsets_column[1]])
+    strings = buffer[strings_column[0]:strings_column[1]]
+    return [strings[start:end].decode() for start, end in zip(offsets, offsets[1:])]
+
+
+class _SnapshotSection(t.Mapping[t.Union[int, str], StoredMessage]):
+    """Messages of one folder in the snapshot, decoded from the memory-mapped file on access."""
+
+    def __init__(
+            self, buffer: mmap.mmap, uids: t.List[t.Union[int, str]],
+            flag_sets: t.List[str], flag_indexes: array.array, header_offsets: array.array,
+            headers_start: int):
+        self._buffer = buffer
+        self._uids = uids
+        self._flag_sets = flag_sets
+        self._flag_indexes = flag_indexes
+        self._header_offsets = header_offsets
+        self._headers_start = headers_start
+        self._indexes = None  # type: t.Optional[t.Dict[t.Union[int, str], int]]
+
+    def _message(self, index: int) -> StoredMessage:
+        start = self._headers_start + self._header_offsets[index]
+        end = self._headers_start + self._header_offsets[index + 1]
+        return StoredMessage(
+            set(self._flag_sets[self._flag_indexes[index]].split()), self._buffer[start:end],
+            None)
+
+    def __getitem__(self, uid: t.Union[int, str]) -> StoredMessage:
+        if self._indexes is None:
+            self._indexes = {uid: index for index, uid in enumerate(self._uids)}
+        return self._message(self._indexes[uid])
+
+    def __iter__(self):
+        return iter(self._uids)
+
+    def __len__(self):
+        return len(self._uids)
+
+    def items(self):
+        return ((uid, self._message(index)) for index, uid in enumerate(self._uids))
+
+
+class CacheSnapshot:
+    """Versioned binary snapshot of UIDs, flags and headers of messages in all e-mail caches.
+
+    Sections are keyed by (account, folder, UIDVALIDITY), like in the message store,
+    and they can be loaded via the same load_messages() interface. The file is memory-mapped,
+    and only section headers are read when it is opened. UIDs and flags of a section are decoded
+    only when the section is loaded, and headers of a message only when the message is accessed.
+
+    Snapshot is written to a temporary file which then replaces the previous snapshot,
+    so that a crash while writing never leaves a corrupted snapshot behind.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._path = path
+        self._mmap = None  # type: t.Optional[mmap.mmap]
+        # messages count, kind of UIDs and (start, end) of every column, for each section
+        self._sections = {}  # type: t.Dict[_SectionKey, _Section]
+        if path.is_file() and path.stat().st_size > 0:
+            with _TIME.measure('open') as timer:
+                self._open()
+            _LOG.info('%s: found %i sections in %fs', self, len(self._sections), timer.elapsed)
+
+    def _open(self) -> None:
+        with self._path.open('rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, sections_count = FILE_HEADER.unpack_from(self._mmap, 0)
+            if magic != MAGIC or version != VERSION:
+                _LOG.warning('%s: snapshot has unsupported format %s version %i, ignoring it',
+                             self, magic, version)
+                return
+            offset = FILE_HEADER.size
+            for _ in range(sections_count):
+                account_length, folder_length, uidvalidity, messages_count, uid_kind = \
+                    SECTION_HEADER.unpack_from(self._mmap, offset)
+                offset += SECTION_HEADER.size
+                account = self._mmap[offset:offset + account_length].decode()
+                offset += account_length
+                folder = self._mmap[offset:offset + folder_length].decode()
+                offset += folder_length
+                columns = []
+                for _ in range(7 if uid_kind == UID_STR else 6):
+                    column_length, = COLUMN_HEADER.unpack_from(self._mmap, offset)
+                    offset += COLUMN_HEADER.size
+                    columns.append((offset, offset + column_length))
+                    offset += column_length
+                if offset > len(self._mmap):
+                    raise struct.error('section extends beyond end of file')
+                self._sections[account, folder, uidvalidity] = (messages_count, uid_kind, columns)
+        except (struct.error, UnicodeDecodeError):
+            _LOG.exception('%s: snapshot is corrupted, ignoring it', self)
+            self._sections.clear()
+
+    def load_messages(
+            self, account: str, folder: str,
+            uidvalidity: int) -> t.Mapping[t.Union[int, str], StoredMessage]:
+        """Load all messages of a folder, which is empty if UIDVALIDITY doesn't match.
+
+        Only UIDs, flags and offsets of headers are decoded, and messages are created on access.
+        """
+        try:
+            messages_count, uid_kind, columns = self._sections[account, folder, uidvalidity]
+        except KeyError:
+            return {}
+        with _TIME.measure('load_messages') as timer:
+            buffer = self._mmap
+            columns = list(columns)
+            if uid_kind == UID_INT:
+                start, end = columns.pop(0)
+                uids = _array_from_buffer('Q', buffer[start:end]).tolist()
+            else:
+                uids = _unpack_strings(buffer, columns.pop(0), columns.pop(0))
+            flag_sets = _unpack_strings(buffer, columns.pop(0), columns.pop(0))
+            (flags_start, flags_end), (offsets_start, offsets_end), (headers_start, _) = columns
+            messages = _SnapshotSection(
+                buffer, uids, flag_sets,
+                _array_from_buffer('H', buffer[flags_start:flags_end]),
+                _array_from_buffer('Q', buffer[offsets_start:offsets_end]), headers_start)
+        assert len(messages) == messages_count, (len(messages), messages_count)
+        _LOG.info('%s: loaded %i messages of "%s" in %s in %fs',
+                  self, len(messages), folder, account, timer.elapsed)
+        return messages
+
+    def _write_section(
+            self, snapshot_file: t.BinaryIO, account: str, folder: Folder,
+            uids: t.List[t.Union[int, str]], messages: t.List[Message]) -> None:
+        uid_kind = UID_INT if all(isinstance(uid, int) for uid in uids) else UID_STR
+        if uid_kind == UID_INT:
+            uid_columns = [_array_to_bytes(array.array('Q', uids))]
+        else:
+            uid_columns = list(_pack_strings([str(uid).encode() for uid in uids]))
+        flag_sets = {}  # type: t.Dict[str, int]
+        flag_indexes = array.array('H', (
+            flag_sets.setdefault(' '.join(sorted(message.flags)), len(flag_sets))
+            for message in messages))
+        columns = [
+            *uid_columns,
+            *_pack_strings([flags.encode() for flags in flag_sets]),
+            _array_to_bytes(flag_indexes),
+            *_pack_strings([serialize_headers(message) for message in messages])]
+        raw_account = account.encode()
+        raw_folder = folder.name.encode()
+        snapshot_file.write(SECTION_HEADER.pack(
+            len(raw_account), len(raw_folder), folder.uidvalidity, len(messages), uid_kind))
+        snapshot_file.write(raw_account)
+        snapshot_file.write(raw_folder)
+        for column in columns:
+            snapshot_file.write(COLUMN_HEADER.pack(len(column)))
+            snapshot_file.write(column)
+
+    def save(self, caches: t.Iterable[EmailCache]) -> None:
+        """Write a new snapshot of all folders of given e-mail caches, replacing the old one."""
+        temporary_path = self._path.with_name(f'{self._path.name}.tmp')
+        sections_count = 0
+        with _TIME.measure('save') as timer:
+            with temporary_path.open('wb') as snapshot_file:
+                snapshot_file.write(FILE_HEADER.pack(MAGIC, VERSION, 0))
+                for cache in caches:
+                    for folder in cache.folders.values():
+                        uids, messages = [], []
+                        for message in folder.messages:
+                            uid = cache.snapshot_uid(message)
+                            if uid is not None:
+                                uids.append(uid)
+                                messages.append(message)
+                        self._write_section(snapshot_file, cache.account, folder, uids, messages)
+                        sections_count += 1
+                snapshot_file.seek(0)
+                snapshot_file.write(FILE_HEADER.pack(MAGIC, VERSION, sections_count))
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(temporary_path, self._path)
+        _LOG.info('%s: saved %i sections in %fs', self, sections_count, timer.elapsed)
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._sections.clear()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._path})'
@@ -1,6 +1,7 @@
 """Command-line interface of maildaemon."""
 
 import argparse
+import importlib.util
 import logging
 import pathlib
 
@@ -9,12 +10,30 @@ from boilerplates.cli import \
     add_verbosity_group, get_logging_level
 import colorama
 import daemon
+from encrypted_config import normalize_path
 
 from ._version import VERSION
 from .config import DEFAULT_CONFIG_PATH, load_config
 from .connection_group import ConnectionGroup
+from .duplicate_index import DEFAULT_MAX_SIZE, DEFAULT_TTL, DuplicateIndex
+from .email_cache import EmailCache
+from .imap_cache import IMAPCache
+from .imap_connection import IMAPConnection
+from .pop_cache import POPCache
+from .smtp_daemon import SMTPDaemon
+from .smtp_pool import TokenBucket, SMTPPool
+from .smtp_spool import SMTPSpool
+from .full_text_index import FullTextIndex
+from .memory_budget import MemoryBudget
+from .cache_snapshot import CacheSnapshot
+from .action_journal import ActionJournal
+from .message_store import MessageStore
+from .body_store import BodyStore
+from .filter_cache import FilterResultCache
 from .message_filter import MessageFilter
 from .daemon_group import DaemonGroup
+from .replay import replay_filters_from_config
+from .archive_import import SESSIONS, ImportStatistics, import_archive_from_config
 
 _LOG = logging.getLogger(__name__)
 
@@ -29,6 +48,8 @@ Configuration is stored in "{DEFAULT_CONFIG_PATH}".''',
         epilog=f'''examples:
   maildaemon -h
   maildaemon -d
+  maildaemon replay ~/mail/archive.mbox
+  maildaemon import ~/mail/archive.mbox my-imap Archive
 
 {make_copyright_notice(2016, 2024, url='https://github.com/mbdevpl/maildaemon')}''',
         formatter_class=ArgumentDefaultsAndRawDescriptionHelpFormatter, allow_abbrev=True)
@@ -44,9 +65,70 @@ Configuration is stored in "{DEFAULT_CONFIG_PATH}".''',
 
     add_verbosity_group(parser)
 
+    subparsers = parser.add_subparsers(
+        dest='command', metavar='COMMAND', help='''optional command;
+        if none is given, connections are established and filters are applied''')
+
+    replay_parser = subparsers.add_parser(
+        'replay', help='''evaluate the configured filters offline, over messages stored in files''',
+        description='''Evaluate the configured filters over messages stored in files,
+without connecting to any server and without executing any actions.
+
+Report throughput, per-filter statistics and actions that would be executed.''',
+        formatter_class=ArgumentDefaultsAndRawDescriptionHelpFormatter)
+    replay_parser.add_argument(
+        'corpus', metavar='PATH', type=pathlib.Path,
+        help='''mbox file, Maildir directory, single message file
+        or a directory of message files''')
+
+    import_parser = subparsers.add_parser(
+        'import',
+        help='''append messages from an mbox file or a Maildir directory to an IMAP folder''',
+        description='''Append messages from an mbox file or a Maildir directory to a folder
+of a configured IMAP connection, using several sessions in parallel.
+
+Flags and internal dates of messages are preserved. No filters are applied.''',
+        formatter_class=ArgumentDefaultsAndRawDescriptionHelpFormatter)
+    import_parser.add_argument(
+        'archive', metavar='PATH', type=pathlib.Path, help='''mbox file or Maildir directory''')
+    import_parser.add_argument(
+        'connection', metavar='CONNECTION', help='''name of a configured IMAP connection''')
+    import_parser.add_argument(
+        'folder', metavar='FOLDER', nargs='?', default='INBOX',
+        help='''existing folder to which messages are appended''')
+    import_parser.add_argument(
+        '--sessions', metavar='COUNT', type=int, default=SESSIONS,
+        help='''number of IMAP sessions appending messages in parallel''')
+    import_parser.add_argument(
+        '--checkpoint', metavar='PATH', type=pathlib.Path, default=None,
+        help='''file where imported messages are recorded; if the import is interrupted,
+        running it again with the same checkpoint skips messages that were already imported''')
+
     return parser.parse_args(args)
 
 
+def print_replay_report(report: dict) -> None:
+    """Print the report returned by replay_filters()."""
+    print(f'{report["messages"]} messages filtered in {report["elapsed"]:f}s'
+          f' ({report["messages_per_second"]:.1f} messages/s)')
+    for statistics in report['filters']:
+        condition_latency = statistics['latencies'].get('condition', {'mean': 0, 'max': 0})
+        print(f'filter "{statistics["name"]}": evaluated {statistics["evaluated"]},'
+              f' matched {statistics["matched"]}, errored {statistics["errored"]},'
+              f' mean {condition_latency["mean"]:f}s, max {condition_latency["max"]:f}s')
+    for message, message_filter, actions in report['fired']:
+        print(f'{message} -> filter "{message_filter.name}": {", ".join(actions)}')
+
+
+def print_import_report(statistics: ImportStatistics) -> None:
+    """Print the statistics returned by ArchiveImport.run()."""
+    print(f'{statistics.messages} messages ({statistics.bytes} bytes) imported'
+          f' in {statistics.elapsed:f}s ({statistics.messages_per_second:.1f} messages/s,'
+          f' {statistics.bytes_per_second / 1024:.1f} KiB/s)')
+    print(f'{statistics.skipped} messages skipped as already imported,'
+          f' {statistics.failed} messages failed')
+
+
 def main(args=None):
     """Command-line interface of maildaemon."""
     colorama.init()
@@ -63,17 +145,114 @@ def main(args=None):
 
     config = load_config(parsed_args.config)
 
+    if parsed_args.command == 'replay':
+        report = replay_filters_from_config(config, parsed_args.corpus)
+        print_replay_report(report)
+        return
+
+    if parsed_args.command == 'import':
+        statistics = import_archive_from_config(
+            config, parsed_args.connection, parsed_args.archive, parsed_args.folder,
+            parsed_args.sessions, parsed_args.checkpoint)
+        print_import_report(statistics)
+        return
+
     group = ConnectionGroup.from_dict(config['connections'])
 
     filters = []
-    for _, filter_data in config['filters'].items():
-        flt = MessageFilter.from_dict(filter_data, group.connections)
+    for filter_name, filter_data in config['filters'].items():
+        flt = MessageFilter.from_dict(filter_data, group.connections, filter_name)
         filters.append(flt)
 
-    daemon_group = DaemonGroup(group, filters)
+    for name, connection in group.connections.items():
+        if isinstance(connection, IMAPCache):
+            columnar_folders = config['connections'][name].get('columnar-folders', [])
+            if columnar_folders and importlib.util.find_spec('numpy') is None:
+                raise RuntimeError(
+                    'columnar folders require numpy, which is installed with the "columns" extra')
+            connection.columnar_folders.update(columnar_folders)
+        elif isinstance(connection, POPCache):
+            connection.headers_only = config['connections'][name].get('headers-only', False)
+        elif isinstance(connection, SMTPDaemon):
+            data = config['connections'][name]
+            if 'spool-path' in data:
+                connection.spool = SMTPSpool(normalize_path(pathlib.Path(data['spool-path'])))
+            if 'pool-size' in data or 'rate-limit' in data:
+                pool_size = data.get('pool-size', 1)
+                rate_limit = None
+                if 'rate-limit' in data:
+                    rate_limit = TokenBucket(data['rate-limit'], pool_size)
+                connection.pool = SMTPPool(connection.open_session, pool_size, rate_limit, name)
+
+    settings = config.get('settings', {})
+    group.duplicates = DuplicateIndex(
+        settings.get('duplicates-max-size', DEFAULT_MAX_SIZE),
+        settings.get('duplicates-ttl', DEFAULT_TTL))
+    message_store = None
+    if 'message-store-path' in settings:
+        message_store = MessageStore(
+            normalize_path(pathlib.Path(settings['message-store-path'])),
+            settings.get('message-store-bodies', False))
+        for connection in group.connections.values():
+            if isinstance(connection, EmailCache):
+                connection.message_store = message_store
+    body_store = None
+    if 'body-store-path' in settings:
+        body_store = BodyStore(normalize_path(pathlib.Path(settings['body-store-path'])))
+        for connection in group.connections.values():
+            if isinstance(connection, EmailCache):
+                connection.body_store = body_store
+    full_text_index = None
+    if 'full-text-index-path' in settings:
+        full_text_index = FullTextIndex(
+            normalize_path(pathlib.Path(settings['full-text-index-path'])))
+        for connection in group.connections.values():
+            if isinstance(connection, EmailCache):
+                connection.full_text_index = full_text_index
+    if 'memory-budget' in settings or any(
+            'memory-budget' in entry for entry in config['connections'].values()):
+        global_memory_budget = MemoryBudget(settings.get('memory-budget', None))
+        for name, connection in group.connections.items():
+            if isinstance(connection, EmailCache):
+                connection.memory_budget = MemoryBudget(
+                    config['connections'][name].get('memory-budget', None), global_memory_budget)
+    journal = None
+    if 'journal-path' in settings:
+        journal = ActionJournal(normalize_path(pathlib.Path(settings['journal-path'])))
+        for connection in group.connections.values():
+            if isinstance(connection, IMAPConnection):
+                connection.journal = journal
+    snapshot = None
+    if 'snapshot-path' in settings:
+        snapshot = CacheSnapshot(normalize_path(pathlib.Path(settings['snapshot-path'])))
+        for connection in group.connections.values():
+            if isinstance(connection, EmailCache):
+                connection.snapshot = snapshot
+    filter_results = None
+    if 'filter-cache-path' in settings:
+        filter_results = FilterResultCache(
+            normalize_path(pathlib.Path(settings['filter-cache-path'])))
+    daemon_group = DaemonGroup(
+        group, filters, message_time_budget=settings.get('message-time-budget', None),
+        filter_results=filter_results, snapshot=snapshot,
+        snapshot_interval=settings.get('snapshot-interval', None), journal=journal)
 
     if parsed_args.daemon:
         with daemon.DaemonContext():
             daemon_group.run()
     else:
         daemon_group.run()
+
+    if message_store is not None:
+        message_store.close()
+    if body_store is not None:
+        body_store.collect_garbage(
+            settings.get('body-store-max-age', None), settings.get('body-store-max-bytes', None))
+        _LOG.warning('%s: %s', body_store, body_store.statistics())
+        body_store.close()
+    if full_text_index is not None:
+        full_text_index.close()
+    if snapshot is not None:
+        snapshot.close()
+    if journal is not None:
+        journal.close()
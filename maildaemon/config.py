@@ -54,6 +54,17 @@ def validate_config(config: dict):
         assert isinstance(connection.get('login', 'test'), str), type(connection['login'])
         assert connection.get('login', ''), connection['login']
         assert isinstance(connection.get('password', 'test'), str), type(connection['password'])
+        assert isinstance(connection.get('memory-budget', 1), int), connection
+        assert isinstance(connection.get('columnar-folders', []), list), connection
+        for folder_name in connection.get('columnar-folders', []):
+            assert isinstance(folder_name, str), type(folder_name)
+        assert connection.get('memory-budget', 1) > 0, connection
+        assert isinstance(connection.get('headers-only', False), bool), connection
+        assert isinstance(connection.get('spool-path', ''), str), connection
+        assert isinstance(connection.get('pool-size', 1), int), connection
+        assert connection.get('pool-size', 1) >= 1, connection
+        assert isinstance(connection.get('rate-limit', 1.0), (int, float)), connection
+        assert connection.get('rate-limit', 1.0) > 0, connection
         assert connection.get('password', None) or connection.get('oauth', False), (
             connection('password', None), connection.get('oauth', False))
     for name, filter_ in config.get('filters', {}).items():
@@ -63,3 +74,32 @@ def validate_config(config: dict):
         assert isinstance(filter_['condition'], str), type(filter_['condition'])
         for action in filter_.get('actions', []):
             assert isinstance(action, str), type(action)
+        assert isinstance(filter_.get('time-budget', 1.0), (int, float)), filter_
+        assert filter_.get('time-budget', 1.0) > 0, filter_
+        assert isinstance(filter_.get('max-budget-violations', 1), int), filter_
+        assert isinstance(filter_.get('regex-engine', 're'), str), filter_
+        assert isinstance(filter_.get('run-once', False), bool), filter_
+        assert isinstance(filter_.get('columns-condition', ''), str), filter_
+    settings = config.get('settings', {})
+    assert isinstance(settings, dict), type(settings)
+    assert isinstance(settings.get('message-time-budget', 1.0), (int, float)), settings
+    assert settings.get('message-time-budget', 1.0) > 0, settings
+    assert isinstance(settings.get('filter-cache-path', ''), str), settings
+    assert isinstance(settings.get('message-store-path', ''), str), settings
+    assert isinstance(settings.get('message-store-bodies', False), bool), settings
+    assert isinstance(settings.get('full-text-index-path', ''), str), settings
+    assert isinstance(settings.get('body-store-path', ''), str), settings
+    assert isinstance(settings.get('body-store-max-age', 1.0), (int, float)), settings
+    assert settings.get('body-store-max-age', 1.0) > 0, settings
+    assert isinstance(settings.get('body-store-max-bytes', 1), int), settings
+    assert settings.get('body-store-max-bytes', 1) > 0, settings
+    assert isinstance(settings.get('memory-budget', 1), int), settings
+    assert isinstance(settings.get('snapshot-path', ''), str), settings
+    assert isinstance(settings.get('snapshot-interval', 1.0), (int, float)), settings
+    assert settings.get('snapshot-interval', 1.0) > 0, settings
+    assert settings.get('memory-budget', 1) > 0, settings
+    assert isinstance(settings.get('duplicates-max-size', 1), int), settings
+    assert settings.get('duplicates-max-size', 1) > 0, settings
+    assert isinstance(settings.get('duplicates-ttl', 1.0), (int, float)), settings
+    assert settings.get('duplicates-ttl', 1.0) > 0, settings
+    assert isinstance(settings.get('journal-path', ''), str), settings
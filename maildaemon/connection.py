@@ -108,6 +108,11 @@ class Connection(metaclass=abc.ABCMeta):
         assert password is None or isinstance(password, str)
         self._password = password
 
+    @property
+    def account(self) -> str:
+        """Identify the account on the server, without asking for login if it is not known."""
+        return f'{self._login}@{self.domain}:{self.port}'
+
     @abc.abstractmethod
     def connect(self) -> None:
         pass
@@ -5,8 +5,9 @@ import typing as t
 import ordered_set
 
 from .connection import Connection
+from .duplicate_index import DuplicateIndex
 from .imap_cache import IMAPCache
-from .smtp_connection import SMTPConnection
+from .smtp_daemon import SMTPDaemon
 from .pop_cache import POPCache
 
 _LOG = logging.getLogger(__name__)
@@ -24,7 +25,7 @@ class ConnectionGroup(t.Dict[str, Connection]):
             try:
                 connection_class = {
                     'IMAP': IMAPCache,
-                    'SMTP': SMTPConnection,
+                    'SMTP': SMTPDaemon,
                     'POP': POPCache
                     }[entry['protocol']]
             except KeyError:
@@ -45,6 +46,8 @@ class ConnectionGroup(t.Dict[str, Connection]):
 
     def __init__(self, **connections):
         super().__init__(**connections)
+        self.duplicates = DuplicateIndex()
+        """Messages handled by run-once filters, shared by all connections in the group."""
         self._connections = {}
         for name, connection in connections.items():
             self._connections[name] = connection
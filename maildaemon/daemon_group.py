@@ -1,30 +1,55 @@
 
 import logging
+import signal
 import time
 import typing as t
 
 import timing
 
-# from .message import Message
+from .message import Message
 from .message_filter import MessageFilter
+from .filter_cache import make_message_key, FilterResultCache
+from .duplicate_index import make_duplicate_key, make_origin_key
 from .connection_group import ConnectionGroup
 from .email_cache import EmailCache
+from .folder import Folder
+from .message_flags import DELETED
+from .daemon import Daemon
+from .cache_snapshot import CacheSnapshot
+from .action_journal import ActionJournal
 
 _LOG = logging.getLogger(__name__)
 _TIME = timing.get_timing_group(__name__)
 
+_PendingDuplicates = t.Dict[t.Tuple[str, t.Hashable], t.Set[t.Hashable]]
+"""Origins of messages matched by run-once filters, until actions of the filters are applied."""
+
 
 class DaemonGroup:
     """Manage a group of mail daemons."""
 
     def __init__(
             self, connections: ConnectionGroup, filters: t.Sequence[MessageFilter],
-            max_iterations: int = 1):
+            max_iterations: int = 1, message_time_budget: t.Optional[float] = None,
+            filter_results: t.Optional[FilterResultCache] = None,
+            snapshot: t.Optional[CacheSnapshot] = None,
+            snapshot_interval: t.Optional[float] = None,
+            journal: t.Optional[ActionJournal] = None):
         self._connections = connections
         self._filters = []
         for filter_ in filters:
             self._filters.append(filter_)
         self.max_iterations = max_iterations
+        self.message_time_budget = message_time_budget
+        self.messages_over_time_budget = 0
+        self._filter_results = filter_results
+        self._snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+        self._journal = journal
+        if filter_results is not None:
+            filter_results.retain_conditions(
+                filter_.condition_key for filter_ in self._filters
+                if filter_.condition_key is not None)
 
     # def add_filter(self, message_filter: 'MessageFilter'):
     #    self._filters.append(message_filter)
@@ -36,6 +61,14 @@ class DaemonGroup:
             _LOG.warning('updating "%s": %s', name, connection)
             connection.update()
 
+    def update_daemons(self):
+        """Let daemons do their work, e.g. send queued messages."""
+        for name, connection in self._connections.items():
+            if not isinstance(connection, Daemon):
+                continue
+            _LOG.info('updating daemon "%s": %s', name, connection)
+            connection.update()
+
     def apply_filters(self):
         if not self._filters:
             return
@@ -46,21 +79,175 @@ class DaemonGroup:
                 filter_ for filter_ in self._filters if connection in filter_._connections]
             _LOG.warning('filtering messages in "%s": %s', name, connection)
             for folder in connection.folders.values():
+                if folder.columns is not None:
+                    self._apply_filters_to_columns(connection, folder, connection_filters)
+                    continue
+                matched_messages = {message_filter: [] for message_filter in connection_filters}
+                pending_duplicates = {}  # type: _PendingDuplicates
                 for message in folder.messages:
                     if message.is_deleted:
                         _LOG.debug('ignoring deleted message')
                         continue
-                    for message_filter in connection_filters:
-                        if not message_filter.applies_to(message):
-                            continue
-                        _LOG.info('filter %s applies to:\n%s', message_filter, message)
-                        message_filter.apply_unconditionally(message)
-                        break
+                    message_filter = self._find_applicable_filter(
+                        message, connection_filters, pending_duplicates)
+                    if message_filter is None:
+                        continue
+                    _LOG.info('filter %s applies to:\n%s', message_filter, message)
+                    matched_messages[message_filter].append(message)
+                for message_filter, messages in matched_messages.items():
+                    message_filter.apply_unconditionally_to_many(messages)
+                    self._record_duplicates(message_filter, pending_duplicates)
+        if self._filter_results is not None:
+            self._filter_results.flush()
+
+    def _apply_filters_to_columns(
+            self, connection: EmailCache, folder: Folder,
+            filters: t.Sequence[MessageFilter]) -> None:
+        """Apply filters that have a columns condition to a columnar folder.
+
+        Only headers of messages selected by the columns condition of a filter are retrieved,
+        and then the condition of the filter is evaluated on them as usual. Each message
+        is handled by the first filter that applies to it. Other filters are not applied.
+        """
+        columns = folder.columns
+        remaining = columns.without_flags(DELETED)
+        pending_duplicates = {}  # type: _PendingDuplicates
+        for message_filter in filters:
+            mask = message_filter.select_columns(columns)
+            if mask is None:
+                continue
+            messages = [
+                message for message in connection.retrieve_selected_messages(
+                    folder, mask & remaining)
+                if self._find_applicable_filter(
+                    message, [message_filter], pending_duplicates) is message_filter]
+            if not messages:
+                continue
+            _LOG.info('filter %s applies to %i messages in columnar folder "%s"',
+                      message_filter, len(messages), folder.name)
+            remaining &= ~columns.with_uids([message._origin_id for message in messages])
+            message_filter.apply_unconditionally_to_many(messages)
+            self._record_duplicates(message_filter, pending_duplicates)
+
+    def _find_applicable_filter(
+            self, message: Message, filters: t.Sequence[MessageFilter],
+            pending_duplicates: t.Optional[_PendingDuplicates] = None
+            ) -> t.Optional[MessageFilter]:
+        """Return the first filter that applies to the message, if any.
+
+        Use cached outcomes of filters if possible, and respect the per-message time budget.
+        If a run-once filter already applied to a copy of the message, e.g. in another account,
+        the message is considered handled, and no filter applies to it.
+
+        If a run-once filter applies, the message is added to pending duplicates, if given,
+        so that copies of the message are ignored until actions of the filter are applied,
+        see _record_duplicates().
+        """
+        message_key = None if self._filter_results is None else make_message_key(message)
+        duplicate_key = None
+        origin = None
+        start = time.perf_counter()
+        for message_filter in filters:
+            if not message_filter.enabled:
+                continue
+            if message_filter.run_once:
+                if duplicate_key is None:
+                    duplicate_key = make_duplicate_key(message)
+                    origin = make_origin_key(message)
+                duplicate = (message_filter.name, duplicate_key)
+                pending = pending_duplicates is not None and duplicate in pending_duplicates
+                if pending and origin not in pending_duplicates[duplicate]:
+                    self._connections.duplicates.duplicates += 1
+                    pending_duplicates[duplicate].add(origin)
+                if pending or self._connections.duplicates.seen(duplicate, origin):
+                    _LOG.debug('filter "%s" already applied to a copy of message %s',
+                               message_filter.name, message)
+                    return None
+            result = None
+            cacheable = message_key is not None and message_filter.condition_key is not None
+            if cacheable:
+                result = self._filter_results.get(message_key, message_filter.condition_key)
+            if result is None:
+                time_budget = None
+                if self.message_time_budget is not None:
+                    time_budget = self.message_time_budget - (time.perf_counter() - start)
+                    if time_budget <= 0:
+                        self._record_message_over_time_budget(message)
+                        return None
+                result = message_filter.evaluate(message, time_budget)
+                if result is None and time_budget is not None \
+                        and time.perf_counter() - start >= self.message_time_budget:
+                    # evaluation was aborted because the time budget of the message ran out
+                    self._record_message_over_time_budget(message)
+                    return None
+                if cacheable and result is not None:
+                    self._filter_results.set(message_key, message_filter.condition_key, result)
+            if result:
+                if message_filter.run_once and pending_duplicates is not None:
+                    pending_duplicates[message_filter.name, duplicate_key] = {origin}
+                return message_filter
+        return None
+
+    def _record_duplicates(
+            self, message_filter: MessageFilter,
+            pending_duplicates: _PendingDuplicates) -> None:
+        """Record pending duplicates of a filter, after its actions were applied successfully."""
+        for key in [key for key in pending_duplicates if key[0] == message_filter.name]:
+            self._connections.duplicates.add(key, pending_duplicates.pop(key))
+
+    def _record_message_over_time_budget(self, message: Message) -> None:
+        self.messages_over_time_budget += 1
+        _LOG.warning('message %s exceeded time budget of %fs, remaining filters skipped',
+                     message, self.message_time_budget)
+
+    def save_snapshot(self) -> None:
+        if self._snapshot is None:
+            return
+        try:
+            self._snapshot.save(
+                connection for connection in self._connections.values()
+                if isinstance(connection, EmailCache))
+        except OSError:
+            _LOG.exception('failed to save snapshot %s', self._snapshot)
+
+    def log_filters_statistics(self, *_) -> None:
+        """Log counters and latencies of all filters.
+
+        Can be used as a signal handler, hence the ignored arguments.
+        """
+        if self.message_time_budget is not None:
+            _LOG.warning('messages over time budget: %i', self.messages_over_time_budget)
+        if self._filter_results is not None:
+            _LOG.warning('cached filter outcomes: %i hits, %i misses',
+                         self._filter_results.hits, self._filter_results.misses)
+        if any(message_filter.run_once for message_filter in self._filters):
+            _LOG.warning('%s: %i messages handled by run-once filters, %i duplicates skipped',
+                         self._connections.duplicates, len(self._connections.duplicates),
+                         self._connections.duplicates.duplicates)
+        for message_filter in self._filters:
+            statistics = message_filter.summarize_statistics()
+            _LOG.warning(
+                'filter "%s"%s: evaluated %i, matched %i, errored %i, over time budget %i,'
+                ' action failures %i', statistics['name'],
+                '' if statistics['enabled'] else ' (disabled)', statistics['evaluated'],
+                statistics['matched'], statistics['errored'], statistics['budget_exceeded'],
+                statistics['action_failures'])
+            for timing_name, latency in statistics['latencies'].items():
+                _LOG.warning(
+                    'filter "%s": %s latency: samples %i, mean %fs, max %fs, histogram %s',
+                    statistics['name'], timing_name, latency['samples'], latency['mean'],
+                    latency['max'], latency['histogram'])
 
     def run(self):
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.log_filters_statistics)
+
         self._connections.connect_all()
+        if self._journal is not None:
+            self._journal.recover(self._connections.connections.values())
 
         iteration = 0
+        last_snapshot = time.monotonic()
         while True:
             iteration += 1
             self._connections.purge_dead()
@@ -75,6 +262,12 @@ class DaemonGroup:
                 self.update()
 
             self.apply_filters()
+            self.update_daemons()
+
+            if self.snapshot_interval is not None \
+                    and time.monotonic() - last_snapshot >= self.snapshot_interval:
+                self.save_snapshot()
+                last_snapshot = time.monotonic()
 
             if iteration >= self.max_iterations:
                 break
@@ -85,6 +278,10 @@ class DaemonGroup:
                 time.sleep(4 - timer.elapsed)
 
         self._connections.disconnect_all()
+        self.save_snapshot()
+        if self._filter_results is not None:
+            self._filter_results.flush()
+        self.log_filters_statistics()
 
     def __len__(self):
         return len(self._connections)
@@ -0,0 +1,110 @@
+"""Index of messages seen across all connections, for detecting duplicate deliveries."""
+
+import collections
+import hashlib
+import logging
+import time
+import typing as t
+
+from .message import Message
+
+_LOG = logging.getLogger(__name__)
+
+DIGESTED_HEADERS = ('From', 'To', 'Cc', 'Date', 'Subject')
+"""Headers that must be identical, in addition to Message-Id, for messages to be duplicates.
+
+Headers added during delivery, like Received or Delivered-To, differ between accounts.
+"""
+
+DEFAULT_MAX_SIZE = 100000
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+
+def make_duplicate_key(message: Message) -> t.Tuple[str, str]:
+    """Identify the message by its Message-Id and digest of headers that survive delivery."""
+    digest = hashlib.sha256()
+    if message._email_message is not None:
+        for header in DIGESTED_HEADERS:
+            for value in message._email_message.get_all(header, []):
+                digest.update(f'{header}: {value}\n'.encode(errors='surrogateescape'))
+    else:
+        digest.update(message.str_headers_compact().encode())
+    return (message.message_id or '').strip(), digest.hexdigest()
+
+
+def make_origin_key(message: Message) -> t.Hashable:
+    """Identify where the message is stored, to tell copies of it apart."""
+    if message._origin_server is None:
+        return 'message', id(message)
+    return id(message._origin_server), message._origin_folder, message._origin_id
+
+
+class DuplicateIndex:
+    """Bounded set of message keys, each expiring after a time-to-live.
+
+    Keys are kept in insertion order, which is also the order of expiry. When there are more
+    than max_size keys, the oldest are dropped before their time.
+
+    Origins of messages with each key are recorded too, so that a copy of a message
+    is counted as a duplicate only once, even though it is seen again on every update.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL):
+        assert max_size > 0, max_size
+        assert ttl > 0, ttl
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expiry = collections.OrderedDict()  # type: t.Dict[t.Hashable, float]
+        self._origins = {}  # type: t.Dict[t.Hashable, t.Set[t.Hashable]]
+        self.duplicates = 0
+
+    def _expire(self, now: float) -> None:
+        while self._expiry:
+            key, expiry = next(iter(self._expiry.items()))
+            if expiry > now:
+                break
+            del self._expiry[key]
+            self._origins.pop(key, None)
+
+    def add(self, key: t.Hashable, origins: t.Iterable[t.Hashable] = ()) -> bool:
+        """Record the key, and return False if it was already recorded and did not expire.
+
+        Given origins of messages with the key are recorded as already seen.
+        """
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._expiry:
+            self._origins[key].update(origins)
+            return False
+        self._expiry[key] = now + self.ttl
+        self._origins[key] = set(origins)
+        while len(self._expiry) > self.max_size:
+            dropped, _ = self._expiry.popitem(last=False)
+            del self._origins[dropped]
+        return True
+
+    def seen(self, key: t.Hashable, origin: t.Optional[t.Hashable] = None) -> bool:
+        """Check if the key is recorded and did not expire.
+
+        If so, count it as a duplicate, unless a message with the key was already seen
+        at the given origin.
+        """
+        if key not in self:
+            return False
+        if origin is None or origin not in self._origins[key]:
+            self.duplicates += 1
+            if origin is not None:
+                self._origins[key].add(origin)
+        return True
+
+    def __contains__(self, key: t.Hashable) -> bool:
+        expiry = self._expiry.get(key)
+        return expiry is not None and expiry > time.monotonic()
+
+    def __len__(self):
+        self._expire(time.monotonic())
+        return len(self._expiry)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(max_size={self.max_size}, ttl={self.ttl})'
@@ -1,10 +1,19 @@
 """Abstract class defining cache of e-mail messages."""
 
 import abc
+import email
+import email.message
 import typing as t
 
 from .message import Message
 from .folder import Folder
+from .message_threads import ThreadIndex
+
+if t.TYPE_CHECKING:
+    from .message_store import MessageStore
+    from .body_store import BodyStore
+    from .full_text_index import FullTextIndex
+    from .memory_budget import MemoryBudget
 
 
 class EmailCache(metaclass=abc.ABCMeta):
@@ -12,6 +21,12 @@ class EmailCache(metaclass=abc.ABCMeta):
 
     def __init__(self):
         self.folders = {}  # type: t.Dict[str, Folder]
+        self.message_store: t.Optional['MessageStore'] = None
+        self.body_store: t.Optional['BodyStore'] = None
+        self.full_text_index: t.Optional['FullTextIndex'] = None
+        self.threads = ThreadIndex()
+        self.memory_budget: t.Optional['MemoryBudget'] = None
+        self.snapshot = None
         # self.message_ids = {}  # type: t.Mapping[str, t.List[int]]
         # self.messages = {}  # type: t.Mapping[t.Tuple[str, int], Message]
 
@@ -29,6 +44,51 @@ class EmailCache(metaclass=abc.ABCMeta):
     # def retrieve_message(self, message_id: int, folder: t.Optional[str] = None) -> Message:
     #     pass
 
+    def _track_message(self, message: Message, size: int) -> None:
+        """Register body of a newly created message in the memory budget, if there is one.
+
+        Messages with only headers are registered once their body is retrieved, see register_body().
+        """
+        if self.memory_budget is not None:
+            message.track_body(self.memory_budget, size)
+
+    def register_body(self, message: Message) -> None:
+        """Register the body of a message, which was created with only headers, once retrieved.
+
+        The body is tracked in the memory budget, and the message is indexed again, with contents.
+        """
+        self._track_message(message, message._body_size)
+        if self.full_text_index is None:
+            return
+        uid = self.snapshot_uid(message)
+        if uid is not None:
+            self.full_text_index.add_message(
+                self.account, message._origin_folder or 'INBOX', uid, message)
+
+    def retrieve_email_message(self, message: Message) -> email.message.Message:
+        """Retrieve the message again, for example after its body was evicted from memory."""
+        raw_message = self._retrieve_raw_message(message)
+        message._body_size = len(raw_message)
+        return email.message_from_bytes(raw_message)
+
+    def retrieve_raw_message(self, message: Message) -> bytes:
+        """Retrieve complete raw message, even if only its headers were retrieved so far."""
+        return self._retrieve_raw_message(message, headers_only=False)
+
+    @abc.abstractmethod
+    def _retrieve_raw_message(
+            self, message: Message, headers_only: t.Optional[bool] = None) -> bytes:
+        """Retrieve raw message from the message store if possible, or from the server.
+
+        Only headers are retrieved if headers_only is True, or if it is None
+        and only headers of the message were retrieved so far.
+        """
+        ...
+
+    def snapshot_uid(self, message: Message) -> t.Optional[t.Union[int, str]]:
+        """Return identifier of the message that stays valid after restart, if there is one."""
+        return message._origin_id
+
     def update_messages(self):
         for _, folder in self.folders.items():
             self.update_messages_in(folder)
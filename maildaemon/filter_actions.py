@@ -1,16 +1,27 @@
 """Actions for MessageFilter class."""
 
+import contextlib
+import typing as t
+
 from .connection import Connection
+from .latency_statistics import LatencyStatistics
 
 from .message import Message
+from .pop_connection import POPConnection
 # from .folder import Folder
 
+MARK_FLAGS = {'read': 'Seen'}
+"""Define a mapping: str -> str, from status used by mark action to IMAP system flag."""
+
+CROSS_SERVER_BATCH_SIZE = 50
+"""Maximum number of messages fetched together when forwarding messages."""
+
 
 def mark(message: Message, connection: Connection, status: str):
     """Mark given message."""
-    if status == 'read':
+    if status in MARK_FLAGS:
         # TODO: replace with message.set_flag(flag) after it's implemented
-        return connection.add_messages_flags([message._origin_id], ['Seen'])
+        return connection.add_messages_flags([message._origin_id], [MARK_FLAGS[status]])
 
     raise NotImplementedError(status)
 
@@ -18,3 +29,146 @@ def mark(message: Message, connection: Connection, status: str):
 def move(message: Message, connection: Connection, folder_name: str):
     """Move given message to a given location."""
     return message.move_to(connection, folder_name)
+
+
+def delete(message: Message):
+    """Delete given message."""
+    return message._origin_server.delete_message(message._origin_id, message._origin_folder)
+
+
+def forward(message: Message, smtp_daemon: Connection, address: str, as_attachment: bool = False):
+    """Forward given message to a given address, via outbox of a given SMTP daemon."""
+    return smtp_daemon.forward_message(
+        message._origin_server.retrieve_raw_message(message), address, as_attachment)
+
+
+def _retrieve_raw_messages(
+        server: Connection, folder_name: t.Optional[str], messages: t.Sequence[Message]
+        ) -> t.Iterator[bytes]:
+    """Retrieve complete raw messages, in chunks if the server supports that."""
+    from .imap_connection import IMAPConnection
+    if not isinstance(server, IMAPConnection):
+        for message in messages:
+            yield server.retrieve_raw_message(message)
+        return
+    message_ids = [message._origin_id for message in messages]
+    for i in range(0, len(message_ids), CROSS_SERVER_BATCH_SIZE):
+        for _, raw_message in server.retrieve_raw_messages(
+                message_ids[i:i + CROSS_SERVER_BATCH_SIZE], folder_name, ()):
+            yield raw_message
+
+
+class CoalescedActions(t.NamedTuple):
+    """End state of a message after a sequence of actions."""
+
+    flags: t.FrozenSet[str]
+    destination: t.Optional[t.Tuple[Connection, str]]
+    deleted: bool
+    forwards: t.Tuple[t.Tuple[Connection, str, bool], ...] = ()
+    """SMTP daemons, addresses and modes of forwarding, see forward()."""
+
+
+def coalesce_actions(
+        actions: t.Sequence[t.Tuple[t.Callable[..., None], t.Sequence[t.Any]]]) -> CoalescedActions:
+    """Reduce a sequence of actions to the end state of the message they are applied to.
+
+    Flags are set on the message wherever it ends up, regardless of the order of actions.
+    The last move determines the destination. Delete removes the message only from where
+    it is, so a message that is also moved ends up at the destination, like when the actions
+    are applied one by one. Forwards are done before anything else, each of them once.
+    """
+    flags = set()
+    destination = None
+    deleted = False
+    forwards = []
+    for action, args in actions:
+        if action is mark:
+            status, = args
+            if status not in MARK_FLAGS:
+                raise NotImplementedError(status)
+            flags.add(MARK_FLAGS[status])
+        elif action is move:
+            connection, folder_name = args
+            destination = (connection, folder_name)
+        elif action is delete:
+            deleted = True
+        elif action is forward:
+            smtp_daemon, address, as_attachment = args
+            if (smtp_daemon, address, as_attachment) not in forwards:
+                forwards.append((smtp_daemon, address, as_attachment))
+        else:
+            raise RuntimeError('refusing to execute untested action')
+    return CoalescedActions(frozenset(flags), destination, deleted, tuple(forwards))
+
+
+def apply_coalesced_actions(
+        messages: t.Sequence[Message], actions: CoalescedActions,
+        latencies: t.Optional[LatencyStatistics] = None) -> None:
+    """Bring given messages to the end state using as few commands as possible.
+
+    Messages are grouped by their origin, and each group is handled using:
+
+    - for forwards: FETCH of complete messages in chunks (or RETR for POP), each message
+      handed over to the outbox of every SMTP daemon right after it is fetched;
+    - for flags only: one STORE command;
+    - for deletion without move: one STORE command, including the flags
+      (or DELE commands for POP);
+    - for move within the same server: optional STORE of flags followed by MOVE,
+      or by COPY and STORE if MOVE is not supported;
+    - for move between servers: FETCH and APPEND (or MULTIAPPEND) with the flags for every
+      batch of messages, followed by one STORE marking all originals as deleted,
+      see MessageTransfer.
+
+    Latency of each kind of action is recorded in the optional latency statistics.
+    """
+    def measure(name: str):
+        if latencies is None:
+            return contextlib.nullcontext()
+        return latencies.measure(f'action_{name}')
+
+    groups: t.Dict[t.Tuple[int, t.Optional[str]], t.List[Message]] = {}
+    for message in messages:
+        groups.setdefault((id(message._origin_server), message._origin_folder), []).append(message)
+
+    for group in groups.values():
+        server = group[0]._origin_server
+        folder_name = group[0]._origin_folder
+        message_ids = [message._origin_id for message in group]
+
+        if actions.forwards:
+            with measure('forward'):
+                for raw_message in _retrieve_raw_messages(server, folder_name, group):
+                    for smtp_daemon, address, as_attachment in actions.forwards:
+                        smtp_daemon.forward_message(raw_message, address, as_attachment)
+
+        target_server, target_folder_name = \
+            (server, folder_name) if actions.destination is None else actions.destination
+
+        if actions.deleted and target_server is server and target_folder_name == folder_name:
+            with measure('delete'):
+                if isinstance(server, POPConnection):
+                    server.delete_messages(message_ids)
+                else:
+                    server.add_messages_flags(
+                        message_ids, sorted(actions.flags | {'Deleted'}), folder=folder_name)
+            for message in group:
+                message.flags.update(actions.flags | {'Deleted'})
+            continue
+
+        if target_server is not server:
+            from .message_transfer import MessageTransfer
+            with measure('transfer'):
+                MessageTransfer(
+                    server, folder_name, target_server, target_folder_name,
+                    sorted(actions.flags), journal=server.journal).run(message_ids)
+            continue
+
+        if actions.flags:
+            with measure('mark'):
+                server.add_messages_flags(message_ids, sorted(actions.flags), folder=folder_name)
+            for message in group:
+                message.flags.update(actions.flags)
+
+        if target_folder_name != folder_name:
+            with measure('move'):
+                server.move_messages(message_ids, target_folder_name, folder_name)
@@ -0,0 +1,94 @@
+"""Persistent cache of outcomes of filter conditions."""
+
+import hashlib
+import logging
+import pathlib
+import sqlite3
+import typing as t
+
+from .message import Message
+
+_LOG = logging.getLogger(__name__)
+
+
+def make_message_key(message: Message) -> str:
+    """Identify the message by its Message-Id, or by digest of its headers if it has none.
+
+    Flags are part of the key too, because filter conditions can depend on them.
+    """
+    digest = hashlib.sha256()
+    if message.message_id:
+        digest.update(message.message_id.strip().encode())
+    elif message._email_message is not None:
+        for key, value in message._email_message.items():
+            digest.update(f'{key}: {value}\n'.encode(errors='surrogateescape'))
+    else:
+        digest.update(message.str_headers_compact().encode())
+    digest.update(b'\0')
+    digest.update(' '.join(sorted(message.flags)).encode())
+    return digest.hexdigest()
+
+
+def make_condition_key(condition_code: str, *extras: str) -> str:
+    """Identify the filter condition by digest of its code and anything else that affects it."""
+    digest = hashlib.sha256(condition_code.encode())
+    for extra in extras:
+        digest.update(b'\0')
+        digest.update(extra.encode())
+    return digest.hexdigest()
+
+
+class FilterResultCache:
+    """Outcomes of filter conditions keyed by message key and condition key.
+
+    Keying by condition of each filter, and not by the whole set of filters, means that
+    a configuration change invalidates only the outcomes of filters that changed.
+    """
+
+    def __init__(self, path: t.Optional[pathlib.Path] = None):
+        self._path = path
+        self._db = sqlite3.connect(':memory:' if path is None else str(path))
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS outcomes (message_key TEXT, condition_key TEXT,'
+            ' result INTEGER, PRIMARY KEY (message_key, condition_key)) WITHOUT ROWID')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message_key: str, condition_key: str) -> t.Optional[bool]:
+        row = self._db.execute(
+            'SELECT result FROM outcomes WHERE message_key = ? AND condition_key = ?',
+            (message_key, condition_key)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bool(row[0])
+
+    def set(self, message_key: str, condition_key: str, result: bool) -> None:
+        self._db.execute(
+            'INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?)',
+            (message_key, condition_key, int(result)))
+
+    def retain_conditions(self, condition_keys: t.Iterable[str]) -> None:
+        """Drop outcomes of all conditions except the given ones."""
+        condition_keys = list(condition_keys)
+        placeholders = ', '.join('?' for _ in condition_keys)
+        cursor = self._db.execute(
+            f'DELETE FROM outcomes WHERE condition_key NOT IN ({placeholders})', condition_keys)
+        if cursor.rowcount:
+            _LOG.warning('%s: dropped %i outcomes of conditions that are no longer used',
+                         self, cursor.rowcount)
+        self.flush()
+
+    def flush(self) -> None:
+        self._db.commit()
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM outcomes').fetchone()[0]
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._path})'
@@ -1,25 +1,47 @@
 """Folder of e-mail messages."""
 
+import datetime
 import logging
 import typing as t
 
+import sortedcontainers
+
 from .connection import Connection
 from .message import Message
+from .message_threads import ThreadIndex
+
+if t.TYPE_CHECKING:
+    from .folder_columns import FolderColumns
 
 _LOG = logging.getLogger(__name__)
 
 
 class Folder:
-    """For storing messages."""
+    """For storing messages.
+
+    Messages are kept in a map keyed by their UID (i.e. origin id) and indexed by Message-Id,
+    sender address and date, so that they can be found without scanning the whole folder.
+    They are also added to and removed from the thread index, if one is given.
+
+    Alternatively, for very large folders, only columnar metadata of messages can be kept,
+    see FolderColumns.
+    """
 
-    def __init__(self, connection: Connection, name: str, flags: t.Sequence[str] = None):
+    def __init__(self, connection: Connection, name: str, flags: t.Sequence[str] = None,
+                 threads: t.Optional[ThreadIndex] = None):
         if flags is None:
             flags = set()
         self._connection = connection  # type: Connection
         self._name = name  # type: str
         self._flags = set(flags)  # type: t.Set[str]
-        self._messages = set()  # type: t.Set[Message]
+        self._messages = {}  # type: t.Dict[int, Message]
+        self._messages_by_message_id = {}  # type: t.Dict[str, t.Dict[int, Message]]
+        self._messages_by_from_address = {}  # type: t.Dict[str, t.Dict[int, Message]]
+        self._timestamps = sortedcontainers.SortedList()  # type: sortedcontainers.SortedList
+        self._threads = threads  # type: t.Optional[ThreadIndex]
+        self.columns: t.Optional['FolderColumns'] = None
         self._subfolders = set()  # type: t.Set[Folder]
+        self.uidvalidity = 0  # type: int
 
     @property
     def name(self):
@@ -30,19 +52,99 @@ class Folder:
         return self._flags
 
     @property
-    def messages(self):
-        return self._messages
+    def messages(self) -> t.Collection[Message]:
+        return self._messages.values()
+
+    @property
+    def uids(self) -> t.Collection[int]:
+        return self._messages.keys()
 
     def add_message(self, message: Message):
         assert isinstance(message, Message)
-        assert message not in self._messages
-        self._messages.add(message)
+        uid = message._origin_id
+        assert uid not in self._messages, (self, uid)
+        self._messages[uid] = message
+        if message.message_id is not None:
+            self._messages_by_message_id.setdefault(message.message_id, {})[uid] = message
+        if message.from_address is not None:
+            self._messages_by_from_address.setdefault(message.from_address, {})[uid] = message
+        if message.datetime is not None:
+            self._timestamps.add((message.datetime.timestamp(), uid))
+        if self._threads is not None:
+            self._threads.add_message(message)
 
     def remove_message(self, message: Message):
-        self._messages.remove(message)
+        uid = message._origin_id
+        del self._messages[uid]
+        if message._memory_budget is not None:
+            message._memory_budget.discard(message)
+        _remove_from_index(self._messages_by_message_id, message.message_id, uid)
+        _remove_from_index(self._messages_by_from_address, message.from_address, uid)
+        if message.datetime is not None:
+            self._timestamps.remove((message.datetime.timestamp(), uid))
+        if self._threads is not None:
+            self._threads.remove_message(message)
+
+    def renumber_messages(self, new_uids: t.Mapping[int, int]) -> None:
+        """Change UIDs of messages, like POP message numbers, which change between sessions.
 
-    def find_message(self, *args, **kwargs):
-        raise NotImplementedError()
+        Unlike removing and adding the messages again, this keeps them in the memory budget
+        and in the thread index.
+        """
+        messages = [self._messages.pop(uid) for uid in new_uids]
+        for message in messages:
+            uid = message._origin_id
+            _remove_from_index(self._messages_by_message_id, message.message_id, uid)
+            _remove_from_index(self._messages_by_from_address, message.from_address, uid)
+            if message.datetime is not None:
+                self._timestamps.remove((message.datetime.timestamp(), uid))
+        for message in messages:
+            uid = new_uids[message._origin_id]
+            message._origin_id = uid
+            if message.datetime is not None:
+                self._timestamps.add((message.datetime.timestamp(), uid))
+            assert uid not in self._messages, (self, uid)
+            self._messages[uid] = message
+            if message.message_id is not None:
+                self._messages_by_message_id.setdefault(message.message_id, {})[uid] = message
+            if message.from_address is not None:
+                self._messages_by_from_address.setdefault(message.from_address, {})[uid] = message
+
+    def find_message(
+            self, uid: t.Optional[int] = None, message_id: t.Optional[str] = None
+            ) -> t.Optional[Message]:
+        """Find message by UID or by Message-Id, return None if there is no such message.
+
+        If several messages have the same Message-Id, the one with the lowest UID is returned.
+        """
+        if uid is not None:
+            return self._messages.get(uid)
+        if message_id is not None:
+            messages = self._messages_by_message_id.get(message_id)
+            return messages[min(messages)] if messages else None
+        raise ValueError('uid or message_id is required')
+
+    def find_messages(
+            self, from_address: t.Optional[str] = None,
+            since: t.Optional[datetime.datetime] = None,
+            before: t.Optional[datetime.datetime] = None) -> t.List[Message]:
+        """Find messages from a given sender and/or sent in a given date range, ordered by UID.
+
+        The range includes "since" and excludes "before". Messages without a date are found
+        only if no date range is given.
+        """
+        if from_address is not None:
+            candidates = self._messages_by_from_address.get(from_address, {})
+        else:
+            candidates = self._messages
+        if since is None and before is None:
+            return [candidates[uid] for uid in sorted(candidates)]
+        start = 0 if since is None else self._timestamps.bisect_left(
+            (since.timestamp(), float('-inf')))
+        end = len(self._timestamps) if before is None else self._timestamps.bisect_left(
+            (before.timestamp(), float('-inf')))
+        uids = sorted(uid for _, uid in self._timestamps[start:end] if uid in candidates)
+        return [candidates[uid] for uid in uids]
 
     @property
     def subfolders(self):
@@ -54,3 +156,12 @@ class Folder:
 
     def remove_subfolder(self, folder):
         self._subfolders.remove(folder)
+
+
+def _remove_from_index(index: t.Dict[str, t.Dict[int, Message]], key: t.Optional[str], uid: int):
+    if key is None:
+        return
+    messages = index[key]
+    del messages[uid]
+    if not messages:
+        del index[key]
@@ -0,0 +1,207 @@
+"""Columnar representation of metadata of messages in a folder."""
+
+import datetime
+import logging
+import typing as t
+
+import numpy as np
+
+from .message import Message
+
+_LOG = logging.getLogger(__name__)
+
+
+class _Column:
+    """Growable NumPy array, with capacity doubled whenever it is exceeded."""
+
+    def __init__(self, dtype: t.Any):
+        self._data = np.empty(16, dtype=dtype)
+        self._length = 0
+
+    def append(self, value: t.Any) -> None:
+        if self._length == len(self._data):
+            self._data = np.resize(self._data, 2 * len(self._data))
+        self._data[self._length] = value
+        self._length += 1
+
+    def keep(self, mask: np.ndarray) -> None:
+        kept = self.data[mask]
+        self._data = np.resize(kept, max(16, len(kept)))
+        self._length = len(kept)
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._data[:self._length]
+
+    def __setitem__(self, index: int, value: t.Any) -> None:
+        self.data[index] = value
+
+
+class _DictionaryColumn(_Column):
+    """Column of strings, encoded as indexes into a list of distinct values."""
+
+    def __init__(self):
+        super().__init__(np.uint32)
+        self.values = []  # type: t.List[t.Optional[str]]
+        self._codes = {}  # type: t.Dict[t.Optional[str], int]
+
+    def append(self, value: t.Optional[str]) -> None:
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self._codes[value] = code
+            self.values.append(value)
+        super().append(code)
+
+    def codes_of(self, values: t.Iterable[t.Optional[str]]) -> t.List[int]:
+        return [self._codes[value] for value in values if value in self._codes]
+
+
+class FolderColumns:
+    """Metadata of messages in a folder, stored in arrays instead of Message objects.
+
+    Columns are UIDs, bitmasks of system flags (see message_flags module), dates as POSIX
+    timestamps (NaN if unknown), sizes in bytes (0 if unknown), and dictionary-encoded
+    sender addresses and subjects. Columns are NumPy arrays, so that predicates run over
+    the whole folder at once and produce boolean masks. Masks can be combined with &, | and ~,
+    and only UIDs of matching messages are extracted from them.
+
+    Messages are kept in the order of increasing UIDs, so that a message is found by binary
+    search. Removed messages are only marked as such, and are skipped by all predicates,
+    until compact() is called.
+    """
+
+    def __init__(self):
+        self._uids = _Column(np.uint64)
+        self._flags = _Column(np.uint8)
+        self._timestamps = _Column(np.float64)
+        self._sizes = _Column(np.uint64)
+        self._senders = _DictionaryColumn()
+        self._subjects = _DictionaryColumn()
+        self._removed = _Column(np.bool_)
+
+    @classmethod
+    def from_messages(cls, messages: t.Iterable[Message]) -> 'FolderColumns':
+        """Build columns from existing messages, with dates from their Date headers."""
+        columns = cls()
+        for message in sorted(messages, key=lambda _: _._origin_id):
+            columns.append(
+                message._origin_id, message.flags.system, message.datetime,
+                message._body_size, message.from_address, message.subject)
+        return columns
+
+    def append(
+            self, uid: int, flags: int, date: t.Optional[datetime.datetime], size: int,
+            sender: t.Optional[str], subject: t.Optional[str]) -> None:
+        assert not len(self.uids) or uid > self.uids[-1], uid
+        self._uids.append(uid)
+        self._flags.append(flags)
+        self._timestamps.append(float('nan') if date is None else date.timestamp())
+        self._sizes.append(size)
+        self._senders.append(sender)
+        self._subjects.append(subject)
+        self._removed.append(False)
+
+    def _position_of(self, uid: int) -> int:
+        position = int(np.searchsorted(self.uids, uid))
+        if position == len(self.uids) or self.uids[position] != uid or self.removed[position]:
+            raise KeyError(uid)
+        return position
+
+    def remove(self, uid: int) -> None:
+        self._removed[self._position_of(uid)] = True
+
+    def remove_selected(self, mask: np.ndarray) -> None:
+        """Remove messages selected by the mask."""
+        self.removed[mask] = True
+
+    def set_flags(self, uid: int, flags: int) -> None:
+        self._flags[self._position_of(uid)] = flags
+
+    def compact(self) -> None:
+        """Drop removed messages from all columns."""
+        kept = ~self.removed
+        for column in (self._uids, self._flags, self._timestamps, self._sizes, self._senders,
+                       self._subjects, self._removed):
+            column.keep(kept)
+
+    @property
+    def known_uids(self) -> np.ndarray:
+        """UIDs of messages which are not removed."""
+        return self.uids[~self.removed]
+
+    @property
+    def uids(self) -> np.ndarray:
+        return self._uids.data
+
+    @property
+    def flags(self) -> np.ndarray:
+        return self._flags.data
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._timestamps.data
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return self._sizes.data
+
+    @property
+    def removed(self) -> np.ndarray:
+        return self._removed.data
+
+    def all(self) -> np.ndarray:
+        return ~self.removed
+
+    def with_flags(self, flags: int) -> np.ndarray:
+        """Select messages that have all of the given system flags."""
+        return ((self.flags & flags) == flags) & ~self.removed
+
+    def without_flags(self, flags: int) -> np.ndarray:
+        """Select messages that have none of the given system flags."""
+        return ((self.flags & flags) == 0) & ~self.removed
+
+    def dated_between(
+            self, since: t.Optional[datetime.datetime] = None,
+            before: t.Optional[datetime.datetime] = None) -> np.ndarray:
+        """Select messages dated in the given range, including "since" and excluding "before"."""
+        mask = ~np.isnan(self.timestamps) & ~self.removed
+        if since is not None:
+            mask &= self.timestamps >= since.timestamp()
+        if before is not None:
+            mask &= self.timestamps < before.timestamp()
+        return mask
+
+    def retain_uids(self, uids: t.Sequence[int]) -> t.List[int]:
+        """Remove messages whose UIDs are not among the given ones, and return new UIDs, sorted."""
+        uids = np.asarray(uids, dtype=np.uint64)
+        self.remove_selected(self.all() & ~self.with_uids(uids))
+        return np.sort(uids[~np.isin(uids, self.known_uids)]).tolist()
+
+    def with_uids(self, uids: t.Sequence[int]) -> np.ndarray:
+        """Select messages with any of the given UIDs."""
+        return np.isin(self.uids, np.asarray(uids, dtype=np.uint64)) & ~self.removed
+
+    def larger_than(self, size: int) -> np.ndarray:
+        return (self.sizes > size) & ~self.removed
+
+    def from_senders(self, senders: t.Iterable[str]) -> np.ndarray:
+        """Select messages from any of the given sender addresses."""
+        codes = self._senders.codes_of(senders)
+        return np.isin(self._senders.data, codes) & ~self.removed
+
+    def subject_matches(self, predicate: t.Callable[[str], bool]) -> np.ndarray:
+        """Select messages whose subject satisfies the predicate.
+
+        Predicate is evaluated only once for each distinct subject.
+        """
+        codes = [code for code, subject in enumerate(self._subjects.values)
+                 if subject is not None and predicate(subject)]
+        return np.isin(self._subjects.data, codes) & ~self.removed
+
+    def select(self, mask: np.ndarray) -> t.List[int]:
+        """Return UIDs of messages selected by the mask."""
+        return self.uids[mask].tolist()
+
+    def __len__(self):
+        return int(np.count_nonzero(~self.removed))
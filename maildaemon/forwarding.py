@@ -0,0 +1,70 @@
+"""Forwarding of raw messages, either resent as they are or attached to a new message."""
+
+import email.parser
+import email.utils
+import re
+import typing as t
+import uuid
+
+FORWARD_TEXT = 'Forwarded message is attached.'
+
+_LONE_LF = re.compile(rb'(?<!\r)\n')
+
+
+def to_crlf(raw_message: bytes) -> bytes:
+    """Convert line endings to CRLF, unless they already are, without copying the message then."""
+    if raw_message.count(b'\n') == raw_message.count(b'\r\n'):
+        return raw_message
+    return _LONE_LF.sub(b'\r\n', raw_message)
+
+
+def _header_lines(headers: t.Sequence[t.Tuple[str, str]]) -> bytes:
+    return ''.join(f'{name}: {value}\r\n' for name, value in headers).encode()
+
+
+def resend_chunks(raw_message: bytes, from_address: str, to_address: str) -> t.List[bytes]:
+    """Prepend Resent-* headers to the message, see RFC 5322 section 3.6.6."""
+    return [
+        _header_lines([
+            ('Resent-From', from_address), ('Resent-To', to_address),
+            ('Resent-Date', email.utils.formatdate(localtime=True)),
+            ('Resent-Message-ID', email.utils.make_msgid())]),
+        to_crlf(raw_message)]
+
+
+def attachment_chunks(raw_message: bytes, from_address: str, to_address: str) -> t.List[bytes]:
+    """Wrap the message in a new multipart message, with the original as message/rfc822 part."""
+    raw_message = to_crlf(raw_message)
+    headers_end = raw_message.find(b'\r\n\r\n')
+    headers = email.parser.BytesHeaderParser().parsebytes(
+        raw_message if headers_end == -1 else raw_message[:headers_end + 2])
+    subject = ' '.join(str(headers.get('Subject', '')).split())
+    boundary = f'=_{uuid.uuid4().hex}'
+    encoding = '7bit' if raw_message.isascii() else '8bit'
+    head = _header_lines([
+        ('From', from_address), ('To', to_address), ('Subject', f'Fwd: {subject}'),
+        ('Date', email.utils.formatdate(localtime=True)),
+        ('Message-ID', email.utils.make_msgid()), ('MIME-Version', '1.0'),
+        ('Content-Type', f'multipart/mixed; boundary="{boundary}"')])
+    head += (
+        f'\r\n--{boundary}\r\n'
+        'Content-Type: text/plain; charset="utf-8"\r\n'
+        f'\r\n{FORWARD_TEXT}\r\n'
+        f'\r\n--{boundary}\r\n'
+        'Content-Type: message/rfc822\r\n'
+        'Content-Disposition: attachment\r\n'
+        f'Content-Transfer-Encoding: {encoding}\r\n\r\n').encode()
+    return [head, raw_message, f'\r\n--{boundary}--\r\n'.encode()]
+
+
+def forward_chunks(
+        raw_message: bytes, from_address: str, to_address: str,
+        as_attachment: bool = False) -> t.List[bytes]:
+    """Create the forwarded message in its wire format, as chunks that are never joined.
+
+    The original message is one of the chunks, so it is not copied, unless its line endings
+    have to be converted to CRLF.
+    """
+    if as_attachment:
+        return attachment_chunks(raw_message, from_address, to_address)
+    return resend_chunks(raw_message, from_address, to_address)
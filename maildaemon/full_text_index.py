@@ -0,0 +1,120 @@
+"""Full-text index of cached messages."""
+
+import logging
+import pathlib
+import sqlite3
+import typing as t
+
+from .message import Message
+
+_LOG = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS message_keys (
+    rowid INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uid NOT NULL,
+    UNIQUE (account, folder, uid));
+CREATE VIRTUAL TABLE IF NOT EXISTS message_texts USING fts5(
+    from_address, from_name, to_address, subject, contents,
+    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3');
+'''
+"""Schema of the index.
+
+Every row of message_texts has the same rowid as the row of message_keys that identifies it,
+so that messages can be removed from the index without scanning it.
+"""
+
+
+class FullTextIndex:
+    """Index of headers and text contents of messages, using SQLite FTS5.
+
+    Messages are identified by (account, folder, UID), same as in the message store.
+    Messages with only headers are indexed with empty contents, and they are indexed again
+    once their body is retrieved, see EmailCache.register_body().
+    Queries use FTS5 syntax, which includes phrases ("some phrase"), prefixes (pref*),
+    boolean operators and column filters (subject: word).
+    """
+
+    def __init__(self, path: t.Optional[pathlib.Path] = None):
+        self._path = path
+        self._db = sqlite3.connect(':memory:' if path is None else str(path))
+        self._db.executescript(SCHEMA)
+
+    def add_message(
+            self, account: str, folder: str, uid: t.Union[int, str], message: Message,
+            replace: bool = True) -> None:
+        """Index the message, optionally keeping it as is if it is already indexed."""
+        row = self._db.execute(
+            'SELECT rowid FROM message_keys WHERE account = ? AND folder = ? AND uid = ?',
+            (account, folder, uid)).fetchone()
+        if row is not None:
+            if not replace:
+                return
+            rowid, = row
+            self._db.execute('DELETE FROM message_texts WHERE rowid = ?', (rowid,))
+        else:
+            rowid = self._db.execute(
+                'INSERT INTO message_keys (account, folder, uid) VALUES (?, ?, ?)',
+                (account, folder, uid)).lastrowid
+        self._db.execute(
+            'INSERT INTO message_texts (rowid, from_address, from_name, to_address, subject,'
+            ' contents) VALUES (?, ?, ?, ?, ?, ?)',
+            (rowid, message.from_address, message.from_name, message.to_address, message.subject,
+             '\n'.join(message.contents)))
+
+    def remove_messages(
+            self, account: str, folder: str, uids: t.Iterable[t.Union[int, str]]) -> None:
+        for uid in uids:
+            row = self._db.execute(
+                'SELECT rowid FROM message_keys WHERE account = ? AND folder = ? AND uid = ?',
+                (account, folder, uid)).fetchone()
+            if row is None:
+                continue
+            self._db.execute('DELETE FROM message_texts WHERE rowid = ?', row)
+            self._db.execute('DELETE FROM message_keys WHERE rowid = ?', row)
+
+    def remove_folder(self, account: str, folder: str) -> None:
+        rowids = self._db.execute(
+            'SELECT rowid FROM message_keys WHERE account = ? AND folder = ?',
+            (account, folder)).fetchall()
+        self._db.executemany('DELETE FROM message_texts WHERE rowid = ?', rowids)
+        self._db.executemany('DELETE FROM message_keys WHERE rowid = ?', rowids)
+
+    def search(
+            self, query: str, account: t.Optional[str] = None, folder: t.Optional[str] = None,
+            limit: int = -1) -> t.List[t.Tuple[str, str, t.Union[int, str]]]:
+        """Return (account, folder, UID) of messages matching the query, best matches first.
+
+        Raise RuntimeError if the query is invalid.
+        """
+        conditions = ['message_texts MATCH ?']
+        parameters = [query]  # type: t.List[t.Any]
+        if account is not None:
+            conditions.append('message_keys.account = ?')
+            parameters.append(account)
+        if folder is not None:
+            conditions.append('message_keys.folder = ?')
+            parameters.append(folder)
+        parameters.append(limit)
+        try:
+            return self._db.execute(
+                'SELECT message_keys.account, message_keys.folder, message_keys.uid'
+                ' FROM message_texts JOIN message_keys ON message_keys.rowid = message_texts.rowid'
+                f' WHERE {" AND ".join(conditions)} ORDER BY rank LIMIT ?', parameters).fetchall()
+        except sqlite3.OperationalError as err:
+            raise RuntimeError(f'search() failed for query {query!r}') from err
+
+    def flush(self) -> None:
+        self._db.commit()
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM message_keys').fetchone()[0]
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._path})'
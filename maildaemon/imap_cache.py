@@ -1,22 +1,44 @@
 """E-mail cache working with IMAP connections."""
 
+import datetime
 import email
 import imaplib
 import logging
+import re
 import typing as t
 
 import colorama
 
-from .message import Message
+from .message import Message, recode_header, split_name_and_address
+from .message_flags import MessageFlags
 from .folder import Folder
 from .email_cache import EmailCache
 from .imap_connection import IMAPConnection
 
+if t.TYPE_CHECKING:
+    from .folder_columns import FolderColumns
+
 _LOG = logging.getLogger(__name__)
 
 HEADER_ONLY_IGNORED_DEFECTS = (
     email.errors.StartBoundaryNotFoundDefect, email.errors.MultipartInvariantViolationDefect)
 
+UID_PATTERN = re.compile(rb'UID (\d+)')
+
+GMAIL_THREAD_ID_PATTERN = re.compile(rb'X-GM-THRID (\d+)')
+
+INTERNALDATE_PATTERN = re.compile(rb'INTERNALDATE "([^"]+)"')
+
+SIZE_PATTERN = re.compile(rb'RFC822\.SIZE (\d+)')
+
+COLUMNS_BATCH_SIZE = 1000
+"""Maximum number of messages whose metadata is fetched together into folder columns."""
+
+
+def parse_flags(metadata: bytes) -> MessageFlags:
+    """Parse flags from FETCH response, system flags are named without the leading backslash."""
+    return MessageFlags.from_imap(imaplib.ParseFlags(metadata))
+
 
 class IMAPCache(EmailCache, IMAPConnection):
     """E-mail cache working with IMAP connections."""
@@ -25,6 +47,7 @@ class IMAPCache(EmailCache, IMAPConnection):
                  oauth: bool = False):
         EmailCache.__init__(self)
         IMAPConnection.__init__(self, domain, port, ssl, oauth)
+        self.columnar_folders = set()  # type: t.Set[str]
 
     def update_folders(self):
         folders = dict(self.retrieve_folders_with_flags())
@@ -41,9 +64,18 @@ class IMAPCache(EmailCache, IMAPConnection):
             if folder_name not in self.folders:
                 _LOG.info('%s%s%s: new folder "%s" found',
                           colorama.Style.DIM, self, colorama.Style.RESET_ALL, folder_name)
-                self.folders[folder_name] = Folder(self, folder_name, flags)
+                self.folders[folder_name] = Folder(self, folder_name, flags, self.threads)
 
     def update_messages_in(self, folder: Folder):
+        """Bring messages in the folder up to date with the server.
+
+        Only headers of new messages are retrieved, and only flags of known messages.
+        If the folder is empty, known messages are first loaded from the message store, if any,
+        or from the snapshot, if any.
+        """
+        if folder.name in self.columnar_folders:
+            self._update_columns_in(folder)
+            return
         if folder.name != 'INBOX':
             return  # TODO: in the future, fetch all folders
         try:
@@ -53,37 +85,174 @@ class IMAPCache(EmailCache, IMAPConnection):
             return
 
         assert folder.name == self._folder, (self._folder)
+        if folder.uidvalidity != self._folder_uidvalidity:
+            if folder.messages:
+                _LOG.warning('%s: UIDVALIDITY of folder "%s" changed, dropping %i messages',
+                             self, folder.name, len(folder.messages))
+            for message in list(folder.messages):
+                folder.remove_message(message)
+            folder.uidvalidity = self._folder_uidvalidity
+            if self.full_text_index is not None:
+                self.full_text_index.remove_folder(self.account, folder.name)
+        if not folder.messages:
+            if self.message_store is not None:
+                self._load_stored_messages(folder, self.message_store)
+            elif self.snapshot is not None:
+                self._load_stored_messages(folder, self.snapshot)
+
         message_ids = self.retrieve_message_ids(folder.name)
-        messages = self.retrieve_messages(message_ids, folder.name, headers_only=True)
-
-        folder._messages = messages
-
-        # for message_id in self.message_ids[folder]:
-        #     if message_id not in message_ids:
-        #         _LOG.warning('%s: message #%i in folder "%s" was deleted',
-        #                      self, message_id, folder)
-        #         self.message_ids[folder].remove(message_id)
-        #         del self.messages[folder, message_id]
-        #         # try:
-        #         # except KeyError:
-        #         #    LOG.exception('%s: deleted a non-existing message "%i" from folder "%s"',
-        #         #                  self, message_id, folder)
-        #
-        # for message_id in message_ids:
-        #     if message_id not in self.message_ids[folder]:
-        #         _LOG.info('%s: new message #%i in folder "%s" found', self, message_id, folder)
-        #         self.message_ids[folder].append(message_id)
-        #         new_message_ids.append(message_id)
-
-        # else:
-        #     _LOG.info('%s: %i messages found in new folder "%s"', self, len(message_ids), folder)
-        #     self.message_ids[folder] = message_ids
-        #     new_message_ids = message_ids
-
-        # self._update_messages_in(folder.name)
 
+        current_message_ids = set(message_ids)
+        removed_message_ids = [
+            message_id for message_id in folder.uids if message_id not in current_message_ids]
+        for message_id in removed_message_ids:
+            folder.remove_message(folder.find_message(uid=message_id))
+
+        known_messages = {
+            message_id: folder.find_message(uid=message_id) for message_id in folder.uids}
+        if known_messages:
+            self._update_flags(folder, known_messages)
+
+        new_message_ids = [
+            message_id for message_id in message_ids if message_id not in known_messages]
+        if new_message_ids:
+            for message in self.retrieve_messages(new_message_ids, folder.name, headers_only=True):
+                folder.add_message(message)
+            self._update_threads(folder)
+        _LOG.info('%s%s%s: folder "%s" has %i known, %i new and %i removed messages',
+                  colorama.Style.DIM, self, colorama.Style.RESET_ALL, folder.name,
+                  len(known_messages), len(new_message_ids), len(removed_message_ids))
+
+        if self.message_store is not None:
+            self.message_store.remove_messages(
+                self.account, folder.name, folder.uidvalidity, removed_message_ids)
+            self.message_store.flush()
+        if self.full_text_index is not None:
+            self.full_text_index.remove_messages(self.account, folder.name, removed_message_ids)
+            self.full_text_index.flush()
+
+        self.close_folder()
+
+    def _load_stored_messages(self, folder: Folder, source) -> None:
+        """Load messages from the message store or from the snapshot."""
+        stored_messages = source.load_messages(
+            self.account, folder.name, folder.uidvalidity)
+        for message_id, stored_message in stored_messages.items():
+            email_message = email.message_from_bytes(
+                stored_message.headers if stored_message.body is None else stored_message.body)
+            message = Message(email_message, self, folder.name, message_id)
+            message.flags.update(stored_message.flags)
+            message.headers_only = stored_message.body is None
+            if not message.headers_only:
+                self._track_message(message, len(stored_message.body))
+            folder.add_message(message)
+            if self.full_text_index is not None:
+                self.full_text_index.add_message(
+                    self.account, folder.name, message_id, message, replace=False)
+        _LOG.info('%s%s%s: loaded %i messages of folder "%s" from %s',
+                  colorama.Style.DIM, self, colorama.Style.RESET_ALL, len(stored_messages),
+                  folder.name, source)
+
+    def _update_columns_in(self, folder: Folder) -> None:
+        """Bring columnar metadata of the folder up to date with the server.
+
+        No Message objects are created. Metadata of new messages is fetched in batches,
+        and dates in the columns are internal dates of messages on the server.
+        """
+        from .folder_columns import FolderColumns
+        try:
+            self.open_folder(folder.name)
+        except RuntimeError:
+            _LOG.exception('%s: skipping folder "%s"', self, folder)
+            return
+        if folder.columns is None or folder.uidvalidity != self._folder_uidvalidity:
+            folder.columns = FolderColumns()
+            folder.uidvalidity = self._folder_uidvalidity
+        columns = folder.columns
+
+        new_message_ids = columns.retain_uids(self.retrieve_message_ids(folder.name))
+        known_message_ids = columns.known_uids.tolist()
+        if known_message_ids:
+            for metadata, _ in self.retrieve_messages_parts(
+                    known_message_ids, ['UID', 'FLAGS'], folder.name):
+                uid_match = UID_PATTERN.search(metadata)
+                if uid_match is not None:
+                    columns.set_flags(int(uid_match.group(1)), parse_flags(metadata).system)
+
+        for i in range(0, len(new_message_ids), COLUMNS_BATCH_SIZE):
+            batch = new_message_ids[i:i + COLUMNS_BATCH_SIZE]
+            messages_data = self.retrieve_messages_parts(
+                batch, ['UID', 'FLAGS', 'INTERNALDATE', 'RFC822.SIZE',
+                        'BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)]'], folder.name)
+            for message_id, (metadata, header_data) in zip(batch, messages_data):
+                self._append_columns(columns, message_id, metadata, header_data)
+        if columns.removed.any():
+            columns.compact()
+        _LOG.info('%s%s%s: folder "%s" has %i known and %i new messages in columns',
+                  colorama.Style.DIM, self, colorama.Style.RESET_ALL, folder.name,
+                  len(known_message_ids), len(new_message_ids))
         self.close_folder()
 
+    @staticmethod
+    def _append_columns(
+            columns: 'FolderColumns', message_id: int, metadata: bytes,
+            header_data: t.Optional[bytes]) -> None:
+        date_match = INTERNALDATE_PATTERN.search(metadata)
+        date = None if date_match is None else datetime.datetime.strptime(
+            date_match.group(1).decode().strip(), '%d-%b-%Y %H:%M:%S %z')
+        size_match = SIZE_PATTERN.search(metadata)
+        headers = email.message_from_bytes(header_data or b'')
+        sender = None
+        if headers['From'] is not None:
+            sender, _ = split_name_and_address(str(recode_header(headers['From'])))
+        subject = None if headers['Subject'] is None else str(recode_header(headers['Subject']))
+        columns.append(
+            message_id, parse_flags(metadata).system, date,
+            0 if size_match is None else int(size_match.group(1)), sender, subject)
+
+    def retrieve_selected_messages(self, folder: Folder, mask) -> t.List[Message]:
+        """Create Message objects (from headers) only for messages selected in folder columns."""
+        message_ids = folder.columns.select(mask)
+        if not message_ids:
+            return []
+        return self.retrieve_messages(message_ids, folder.name, headers_only=True)
+
+    def _update_threads(self, folder: Folder) -> None:
+        """Join threads reported by the server, if it supports the THREAD command.
+
+        Gmail reports thread ids with every message instead, see retrieve_messages().
+        """
+        if 'X-GM-EXT-1' in self._link.capabilities \
+                or 'THREAD=REFERENCES' not in self._link.capabilities:
+            return
+        try:
+            threads = self.retrieve_threads(folder.name)
+        except RuntimeError:
+            _LOG.exception('%s: failed to retrieve threads of folder "%s"', self, folder.name)
+            return
+        for message_ids in threads:
+            messages = [folder.find_message(uid=message_id) for message_id in message_ids]
+            self.threads.add_thread([message for message in messages if message is not None])
+
+    def _update_flags(self, folder: Folder, messages: t.Mapping[int, Message]) -> None:
+        """Retrieve current flags of given messages and update them if they changed."""
+        changed_flags = {}  # type: t.Dict[int, MessageFlags]
+        messages_data = self.retrieve_messages_parts(
+            sorted(messages), ['UID', 'FLAGS'], folder.name)
+        for metadata, _ in messages_data:
+            uid_match = UID_PATTERN.search(metadata)
+            if uid_match is None:
+                _LOG.error('%s: no UID in response %s', self, metadata)
+                continue
+            message = messages[int(uid_match.group(1))]
+            flags = parse_flags(metadata)
+            if flags != message.flags:
+                message.flags.assign(flags)
+                changed_flags[message._origin_id] = flags
+        if changed_flags and self.message_store is not None:
+            self.message_store.update_flags(
+                self.account, folder.name, folder.uidvalidity, changed_flags)
+
     '''
     def _update_messages_in(self, folder: str):
 
@@ -136,6 +305,8 @@ class IMAPCache(EmailCache, IMAPConnection):
         """For each message ID request message flags and contents and parse it to Message."""
 
         requested_parts = ['FLAGS']
+        if 'X-GM-EXT-1' in self._link.capabilities:
+            requested_parts.append('X-GM-THRID')
         # The BODY.PEEK[] is a functional equivalent of obsolete RFC822.PEEK,
         # see https://www.ietf.org/rfc/rfc2062 for details.
         requested_parts.append('BODY.PEEK[HEADER]' if headers_only else 'BODY.PEEK[]')
@@ -144,11 +315,14 @@ class IMAPCache(EmailCache, IMAPConnection):
         # print(flags_data[0])
         # all_data = self.retrieve_messages_parts(message_ids, ['FLAGS', 'BODY.PEEK[]'], folder)
         # print(all_data[0])
-        messages_data = self.retrieve_messages_parts(message_ids, requested_parts, folder)
+        if headers_only or self.body_store is None:
+            messages_data = self.retrieve_messages_parts(message_ids, requested_parts, folder)
+        else:
+            messages_data = self.retrieve_raw_messages(message_ids, folder, requested_parts[:-1])
 
         messages = []
-        for message_id, (metadata, message) in zip(message_ids, messages_data):
-            email_message = email.message_from_bytes(message)
+        for message_id, (metadata, message_data) in zip(message_ids, messages_data):
+            email_message = email.message_from_bytes(message_data)
             if headers_only:
                 email_message.defects = [
                     defect for defect in email_message.defects
@@ -158,18 +332,78 @@ class IMAPCache(EmailCache, IMAPConnection):
                            self, message_id, self._folder, email_message.defects)
 
             message = Message(email_message, self, self._folder, message_id)
-            flags = imaplib.ParseFlags(metadata)
-            for raw_flag in flags:
-                flag = raw_flag.decode()
-                if flag.startswith('\\'):
-                    flag = flag[1:]
-                else:
-                    _LOG.warning('atypical flag "%s" detected in "%s"', flag, flags)
-                message.flags.add(flag)
+            message.flags.assign(parse_flags(metadata))
+            message.headers_only = headers_only
+            if not headers_only:
+                self._track_message(message, len(message_data))
+            thread_id_match = GMAIL_THREAD_ID_PATTERN.search(metadata)
+            if thread_id_match is not None:
+                message.thread_id = int(thread_id_match.group(1))
             messages.append(message)
+            if self.message_store is not None:
+                self.message_store.save_message(
+                    self.account, self._folder, self._folder_uidvalidity, message_id,
+                    message, message_data)
+            if self.full_text_index is not None:
+                self.full_text_index.add_message(self.account, self._folder, message_id, message)
 
         return messages
 
+    def _retrieve_raw_message(
+            self, message: Message, headers_only: t.Optional[bool] = None) -> bytes:
+        if headers_only is None:
+            headers_only = message.headers_only
+        folder = self.folders[message._origin_folder]
+        if self.message_store is not None:
+            stored_message = self.message_store.load_message(
+                self.account, folder.name, folder.uidvalidity, message._origin_id)
+            if stored_message is not None and stored_message.body is not None:
+                return stored_message.body
+            if stored_message is not None and headers_only:
+                return stored_message.headers
+        if headers_only:
+            (_, message_data), = self.retrieve_messages_parts(
+                [message._origin_id], ['BODY.PEEK[HEADER]'], folder.name)
+        else:
+            (_, message_data), = self.retrieve_raw_messages([message._origin_id], folder.name, ())
+        return message_data
+
+    def retrieve_raw_messages(
+            self, message_ids: t.List[int], folder: t.Optional[str] = None,
+            metadata_parts: t.Sequence[str] = ('UID', 'FLAGS', 'INTERNALDATE')
+            ) -> t.List[t.Tuple[bytes, bytes]]:
+        """Retrieve metadata and complete raw contents of requested messages.
+
+        If there is a body store, only sizes and headers are fetched first, and complete
+        messages are fetched only if they are not in the body store. Fetched messages
+        are then added to the body store.
+        """
+        if self.body_store is None:
+            return super().retrieve_raw_messages(message_ids, folder, metadata_parts)
+        headers_data = self.retrieve_messages_parts(
+            message_ids, [*metadata_parts, 'RFC822.SIZE', 'BODY.PEEK[HEADER]'], folder)
+        messages_data = []  # type: t.List[t.Tuple[bytes, t.Optional[bytes]]]
+        missing = []  # type: t.List[int]
+        for index, (metadata, headers) in enumerate(headers_data):
+            size_match = SIZE_PATTERN.search(metadata)
+            message_data = None
+            if size_match is not None and headers is not None:
+                message_data = self.body_store.find(int(size_match.group(1)), headers)
+            if message_data is None:
+                missing.append(index)
+            messages_data.append((metadata, message_data))
+        if missing:
+            bodies_data = self.retrieve_messages_parts(
+                [message_ids[index] for index in missing], ['BODY.PEEK[]'], folder)
+            for index, (_, message_data) in zip(missing, bodies_data):
+                self.body_store.put(message_data)
+                messages_data[index] = (messages_data[index][0], message_data)
+            self.body_store.flush()
+        _LOG.info('%s%s%s: %i of %i messages found in %s',
+                  colorama.Style.DIM, self, colorama.Style.RESET_ALL,
+                  len(message_ids) - len(missing), len(message_ids), self.body_store)
+        return messages_data
+
     def retrieve_message(self, message_id: int, folder: t.Optional[str] = None) -> Message:
         messages = self.retrieve_messages([message_id], folder)
         return messages[0]
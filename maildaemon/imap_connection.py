@@ -4,7 +4,9 @@ import datetime
 import imaplib
 import json
 import logging
+import mmap
 import pathlib
+import re
 import shlex
 import socket
 import typing as t
@@ -16,6 +18,9 @@ import timing
 
 from .connection import Response, Connection
 
+if t.TYPE_CHECKING:
+    from .action_journal import ActionJournal
+
 _LOG = logging.getLogger(__name__)
 _TIME = timing.get_timing_group(__name__)
 
@@ -25,6 +30,71 @@ TIMEOUT = 10
 socket.setdefaulttimeout(TIMEOUT)
 
 
+def parse_threads(response: bytes) -> t.List[t.List[int]]:
+    """Parse THREAD response into lists of UIDs of messages in each thread.
+
+    For example, b'(2)(3 6 (4 23)(44 7 96))' becomes [[2], [3, 6, 4, 23, 44, 7, 96]].
+    Nesting within a thread is not kept, because only thread membership is used.
+    """
+    threads = []
+    depth = 0
+    for token in re.findall(rb'[()]|\d+', response):
+        if token == b'(':
+            if depth == 0:
+                threads.append([])
+            depth += 1
+        elif token == b')':
+            depth -= 1
+        elif depth > 0:
+            threads[-1].append(int(token))
+    return threads
+
+
+def uid_set(message_ids: t.Iterable[int]) -> str:
+    """Represent message IDs as IMAP sequence set, using ranges for consecutive IDs."""
+    ranges = []
+    for message_id in message_ids:
+        if ranges and ranges[-1][1] + 1 == message_id:
+            ranges[-1][1] = message_id
+        else:
+            ranges.append([message_id, message_id])
+    return ','.join(str(first) if first == last else f'{first}:{last}' for first, last in ranges)
+
+
+def _append_arguments(envelope: bytes, extra_flags: t.Sequence[str]) -> t.Tuple[str, str]:
+    """Create flags and date arguments of APPEND command from FETCH response of a message."""
+    raw_flags = [_.decode() for _ in imaplib.ParseFlags(envelope)]
+    raw_flags += [f'{_BACKSLASH}{flag}' for flag in extra_flags
+                  if f'{_BACKSLASH}{flag}' not in raw_flags]
+    flags = f'({" ".join(raw_flags)})'
+    date = imaplib.Time2Internaldate(imaplib.Internaldate2tuple(envelope))
+    assert date is not None
+    return flags, date
+
+
+class _MultiappendLiterals:
+    """Send messages of MULTIAPPEND command (RFC 3502) one after another.
+
+    imaplib sends only one literal per command, unless it is given a method, which is called
+    after each continuation request. The method sends the message itself, and returns
+    the rest of the command up to the literal of the next message, see IMAP4._command().
+    """
+
+    def __init__(self, link: imaplib.IMAP4, arguments: t.Sequence[str],
+                 bodies: t.Sequence[t.Union[bytes, mmap.mmap]]):
+        self._link = link
+        self._arguments = arguments
+        self._bodies = bodies
+        self._index = 0
+
+    def send_next(self, continuation: bytes) -> bytes:
+        self._link.send(self._bodies[self._index])
+        self._index += 1
+        if self._index == len(self._bodies):
+            return b''
+        return f' {self._arguments[self._index]}'.encode()
+
+
 class IMAPConnection(Connection):
     """For handling IMAP connections.
 
@@ -50,6 +120,22 @@ class IMAPConnection(Connection):
         # self._link.debug = 4
 
         self._folder: t.Optional[str] = None
+        self._folder_uidvalidity: int = 0
+        self.journal: t.Optional['ActionJournal'] = None
+
+    @property
+    def uidvalidity(self) -> int:
+        """UIDVALIDITY of the open folder, or 0 if the server did not report it."""
+        return self._folder_uidvalidity
+
+    def open_session(self) -> 'IMAPConnection':
+        """Create another (not yet connected) session with the same account, e.g. for an import."""
+        session = IMAPConnection(self.domain, self._port, self.ssl, self.oauth)
+        session.oauth_data = self.oauth_data
+        session.login = self.login
+        if not self.oauth:
+            session.password = self.password
+        return session
 
     def connect(self) -> None:
         """Use imaplib.login() command."""
@@ -230,9 +316,16 @@ class IMAPConnection(Connection):
             raise RuntimeError('open_folder() failed')
 
         self._folder = folder
+        _, uidvalidity = self._link.response('UIDVALIDITY')
+        self._folder_uidvalidity = 0 if uidvalidity[-1] is None else int(uidvalidity[-1])
+
+    def retrieve_message_ids(
+            self, folder: t.Optional[str] = None,
+            criteria: t.Sequence[str] = ('ALL',)) -> t.List[int]:
+        """Use imaplib.search() command, by default to find all messages in the folder.
 
-    def retrieve_message_ids(self, folder: t.Optional[str] = None) -> t.List[int]:
-        """Use imaplib.search() command."""
+        :param criteria: optional, search keys, e.g. ['HEADER', 'Message-Id', '"<id@host>"']
+        """
         if folder is None:
             folder = self._folder
 
@@ -241,14 +334,15 @@ class IMAPConnection(Connection):
         status = None
         try:
             with _TIME.measure('retrieve_message_ids') as timer:
-                status, response = self._link.uid('search', None, 'ALL')
+                status, response = self._link.uid('search', None, *criteria)
         except imaplib.IMAP4.error as err:
-            _LOG.exception('%s: search(%s, %s) failed', self, None, 'ALL')
+            _LOG.exception('%s: search(%s, %s) failed', self, None, ' '.join(criteria))
             raise RuntimeError('retrieve_message_ids() failed') from err
         _LOG.info(
             '%s%s%s: search(%s, %s) completed in %fs status: %s, response: %s%s%s',
-            colorama.Style.DIM, self, colorama.Style.RESET_ALL, None, 'ALL', timer.elapsed,
-            status, colorama.Style.DIM, Response(response), colorama.Style.RESET_ALL)
+            colorama.Style.DIM, self, colorama.Style.RESET_ALL, None, ' '.join(criteria),
+            timer.elapsed, status, colorama.Style.DIM, Response(response),
+            colorama.Style.RESET_ALL)
 
         if status != 'OK':
             raise RuntimeError('retrieve_message_ids() failed')
@@ -257,6 +351,32 @@ class IMAPConnection(Connection):
 
         return message_ids
 
+    def retrieve_threads(
+            self, folder: t.Optional[str] = None,
+            algorithm: str = 'REFERENCES') -> t.List[t.List[int]]:
+        """Use THREAD command (RFC 5256) and return UIDs of messages in each thread."""
+        if folder is None:
+            folder = self._folder
+
+        self.open_folder(folder)
+
+        status = None
+        try:
+            with _TIME.measure('retrieve_threads') as timer:
+                status, response = self._link.uid('thread', algorithm, 'UTF-8', 'ALL')
+        except imaplib.IMAP4.error as err:
+            _LOG.exception('%s: thread(%s, %s, %s) failed', self, algorithm, 'UTF-8', 'ALL')
+            raise RuntimeError('retrieve_threads() failed') from err
+        _LOG.info(
+            '%s%s%s: thread(%s, %s, %s) completed in %fs status: %s, response: %s%s%s',
+            colorama.Style.DIM, self, colorama.Style.RESET_ALL, algorithm, 'UTF-8', 'ALL',
+            timer.elapsed, status, colorama.Style.DIM, Response(response), colorama.Style.RESET_ALL)
+
+        if status != 'OK':
+            raise RuntimeError('retrieve_threads() failed')
+
+        return parse_threads(b''.join(_ for _ in response if _ is not None))
+
     def retrieve_messages_parts(
             self, message_ids: t.List[int], parts: t.List[str],
             folder: t.Optional[str] = None) -> t.List[t.Tuple[bytes, t.Optional[bytes]]]:
@@ -285,7 +405,7 @@ class IMAPConnection(Connection):
         try:
             with _TIME.measure('retrieve_messages_parts') as timer:
                 status, messages_data = self._link.uid(
-                    'fetch', ','.join([str(message_id) for message_id in message_ids]),
+                    'fetch', uid_set(message_ids),
                     f'({" ".join(parts)})')
         except imaplib.IMAP4.error as err:
             _LOG.exception('%s: fetch(%s, %s) failed', self, message_ids, parts)
@@ -329,6 +449,17 @@ class IMAPConnection(Connection):
         data = self.retrieve_messages_parts([message_id], parts, folder)
         return data[0]
 
+    def retrieve_raw_messages(
+            self, message_ids: t.List[int], folder: t.Optional[str] = None,
+            metadata_parts: t.Sequence[str] = ('UID', 'FLAGS', 'INTERNALDATE')
+            ) -> t.List[t.Tuple[bytes, bytes]]:
+        """Retrieve metadata and complete raw contents of requested messages.
+
+        Return list of tuples (metadata, raw message), which can be given directly
+        to add_messages() as long as metadata includes flags and internal date.
+        """
+        return self.retrieve_messages_parts(message_ids, [*metadata_parts, 'BODY.PEEK[]'], folder)
+
     def _alter_messages_flags(
             self, message_ids: t.Sequence[int], flags: t.Sequence[str],
             alteration: t.Optional[bool], silent: bool = False,
@@ -359,7 +490,7 @@ class IMAPConnection(Connection):
         status = None
         try:
             status, response = self._link.uid(
-                'store', ','.join([str(message_id) for message_id in message_ids]), command,
+                'store', uid_set(message_ids), command,
                 f'({" ".join([f"{_BACKSLASH}{flag}" for flag in flags])})')
         except imaplib.IMAP4.error as err:
             _LOG.exception('%s: store(%s, "%s", %s) failed', self, message_ids, command, flags)
@@ -390,33 +521,75 @@ class IMAPConnection(Connection):
         """Issue "FLAGS" command."""
         self._alter_messages_flags(message_ids, flags, None, silent, folder)
 
-    def add_messages(self, messages_parts: t.List[t.Tuple[bytes, bytes]],
-                     folder: t.Optional[str] = None) -> None:
+    def add_messages(self, messages_parts: t.List[t.Tuple[bytes, t.Union[bytes, mmap.mmap]]],
+                     folder: t.Optional[str] = None,
+                     extra_flags: t.Sequence[str] = ()) -> None:
+        """Add messages to a folder, using one MULTIAPPEND command if the server supports it.
+
+        With MULTIAPPEND, either all messages are added or none of them. Otherwise, one APPEND
+        command is used for each message. See add_message() for details.
+        """
+        if len(messages_parts) > 1 and 'MULTIAPPEND' in self._link.capabilities:
+            self._add_messages_at_once(messages_parts, folder, extra_flags)
+            return
         for message_parts in messages_parts:
-            self.add_message(message_parts, folder)
+            self.add_message(message_parts, folder, extra_flags)
 
-    def add_message(self, message_parts: t.Tuple[bytes, bytes],
-                    folder: t.Optional[str] = None) -> None:
+    def _add_messages_at_once(
+            self, messages_parts: t.List[t.Tuple[bytes, t.Union[bytes, mmap.mmap]]],
+            folder: t.Optional[str], extra_flags: t.Sequence[str]) -> None:
+        """Use MULTIAPPEND command, see https://tools.ietf.org/html/rfc3502"""
+        if folder is None:
+            folder = self._folder
+        self.open_folder(folder)
+
+        arguments = []
+        for envelope, body in messages_parts:
+            flags, date = _append_arguments(envelope, extra_flags)
+            arguments.append(f'{flags} {date} {{{len(body)}}}')
+        bodies = [body for _, body in messages_parts]
+        size = sum(len(body) for body in bodies)
+
+        status = None
+        try:
+            with _TIME.measure('add_messages') as timer:
+                self._link.literal = _MultiappendLiterals(self._link, arguments, bodies).send_next
+                status, response = self._link._simple_command(
+                    'APPEND', f'"{folder}"', arguments[0])
+        except imaplib.IMAP4.error as err:
+            _LOG.exception('%s: multiappend("%s", ... (%i messages, %i bytes)) failed',
+                           self, folder, len(bodies), size)
+            raise RuntimeError('add_messages() failed') from err
+        _LOG.info(
+            '%s%s%s: multiappend("%s", ... (%i messages, %i bytes)) status: %s, response: %s'
+            ' in %fs', colorama.Style.DIM, self, colorama.Style.RESET_ALL, folder, len(bodies),
+            size, status, [r for r in response], timer.elapsed)
+
+        if status != 'OK':
+            raise RuntimeError('add_messages() failed')
+
+    def add_message(self, message_parts: t.Tuple[bytes, t.Union[bytes, mmap.mmap]],
+                    folder: t.Optional[str] = None, extra_flags: t.Sequence[str] = ()) -> None:
         """Add a message to a folder using APPEND command.
 
         :param message_parts: tuple (envelope: bytes, body: bytes), with both elements properly set,
           which is exactly the same type as received via:
           parts = retrieve_message_parts(uid, parts=['FLAGS', 'INTERNALDATE', 'BODY.PEEK[]'])
+          body can also be memory-mapped file with the message
+        :param extra_flags: list of strings of: 'Seen', etc. to be set on the added message
+          in addition to flags from the envelope
         """
         assert isinstance(message_parts, tuple), type(message_parts)
         assert len(message_parts) == 2, len(message_parts)
         envelope, body = message_parts
         assert isinstance(envelope, bytes), type(envelope)
-        assert isinstance(body, bytes), type(body)
+        assert isinstance(body, (bytes, mmap.mmap)), type(body)
 
         if folder is None:
             folder = self._folder
         self.open_folder(folder)
 
-        flags = f'({" ".join(_.decode() for _ in imaplib.ParseFlags(envelope))})'
-        assert isinstance(flags, str), flags
-        date = imaplib.Time2Internaldate(imaplib.Internaldate2tuple(envelope))
-        assert date is not None
+        flags, date = _append_arguments(envelope, extra_flags)
 
         status = None
         try:
@@ -449,7 +622,7 @@ class IMAPConnection(Connection):
         status = None
         try:
             status, response = self._link.uid(
-                'copy', ','.join([str(message_id) for message_id in message_ids]),
+                'copy', uid_set(message_ids),
                 f'"{target_folder}"')
         except imaplib.IMAP4.error as err:
             _LOG.exception('%s: copy(%s, "%s") failed', self, message_ids, target_folder)
@@ -499,10 +672,50 @@ class IMAPConnection(Connection):
             source_folder: t.Optional[str] = None) -> None:
         """Move messages from one folder to a different folder on the same connection.
 
-        This method does not rely on MOVE command https://tools.ietf.org/html/rfc6851
+        Use MOVE command https://tools.ietf.org/html/rfc6851 if server supports it,
+        and otherwise COPY the messages and mark the originals as deleted. The latter is recorded
+        in the journal, if there is one, see ActionJournal.
         """
-        self.copy_messages(message_ids, target_folder, source_folder)
-        self.delete_messages(message_ids, source_folder)
+        if 'MOVE' not in self._link.capabilities:
+            entry_id = None
+            if self.journal is not None:
+                if source_folder is None:
+                    source_folder = self._folder
+                self.open_folder(source_folder)
+                entry_id = self.journal.begin(
+                    self, self._folder, self._folder_uidvalidity, message_ids, self, target_folder)
+            self.copy_messages(message_ids, target_folder, source_folder)
+            if entry_id is not None:
+                self.journal.record_copied(entry_id, message_ids)
+            self.delete_messages(message_ids, source_folder)
+            if entry_id is not None:
+                self.journal.end(entry_id)
+            return
+
+        if source_folder is None:
+            source_folder = self._folder
+
+        self.open_folder(source_folder)
+
+        if self._folder == target_folder:
+            raise RuntimeError(
+                'move_messages() failed because source and target folders are the same')
+
+        status = None
+        try:
+            status, response = self._link.uid(
+                'move', uid_set(message_ids),
+                f'"{target_folder}"')
+        except imaplib.IMAP4.error as err:
+            _LOG.exception('%s: move(%s, "%s") failed', self, message_ids, target_folder)
+            raise RuntimeError('move_messages() failed') from err
+        _LOG.info(
+            '%s%s%s: move(%s, "%s") status: %s, response: %s%s%s',
+            colorama.Style.DIM, self, colorama.Style.RESET_ALL, message_ids, target_folder,
+            status, colorama.Style.DIM, Response(response), colorama.Style.RESET_ALL)
+
+        if status != 'OK':
+            raise RuntimeError('move_messages() failed')
 
     def move_message(self, message_id: int, target_folder: str,
                      source_folder: t.Optional[str] = None) -> None:
@@ -0,0 +1,70 @@
+"""Summaries of latencies of repeated operations, kept in constant memory."""
+
+import contextlib
+import time
+import typing as t
+
+LATENCY_HISTOGRAM_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, float('inf'))
+"""Upper bounds (in seconds) of buckets of latency histograms in filter statistics."""
+
+
+def _bucket_of(value: float, buckets: t.Sequence[float]) -> t.Optional[float]:
+    for bucket in buckets:
+        if value <= bucket:
+            return bucket
+    return None
+
+
+def latency_histogram(
+        elapsed: t.Iterable[float],
+        buckets: t.Sequence[float] = LATENCY_HISTOGRAM_BUCKETS) -> t.Dict[float, int]:
+    """Count latencies into buckets, each bucket being identified by its upper bound."""
+    histogram = {bucket: 0 for bucket in buckets}
+    for value in elapsed:
+        bucket = _bucket_of(value, buckets)
+        if bucket is not None:
+            histogram[bucket] += 1
+    return histogram
+
+
+class LatencyStatistics:
+    """Number of samples, total, maximum and histogram of latencies of named operations.
+
+    Unlike timing groups, which keep every measurement, this is updated in place,
+    so it can be used for the whole lifetime of the daemon.
+    """
+
+    def __init__(self, buckets: t.Sequence[float] = LATENCY_HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self._summaries = {}  # type: t.Dict[str, t.Dict[str, t.Any]]
+
+    def record(self, name: str, elapsed: float) -> None:
+        summary = self._summaries.get(name)
+        if summary is None:
+            summary = {'samples': 0, 'total': 0.0, 'max': 0.0,
+                       'histogram': {bucket: 0 for bucket in self.buckets}}
+            self._summaries[name] = summary
+        summary['samples'] += 1
+        summary['total'] += elapsed
+        summary['max'] = max(summary['max'], elapsed)
+        bucket = _bucket_of(elapsed, self.buckets)
+        if bucket is not None:
+            summary['histogram'][bucket] += 1
+
+    @contextlib.contextmanager
+    def measure(self, name: str):
+        """Record latency of the code in the context, unless it raises."""
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start)
+
+    def summarize(self) -> t.Dict[str, t.Dict[str, t.Any]]:
+        """Return samples, total, mean, max and histogram of latencies of each operation."""
+        return {
+            name: {
+                'samples': summary['samples'],
+                'total': summary['total'],
+                'mean': summary['total'] / summary['samples'],
+                'max': summary['max'],
+                'histogram': dict(summary['histogram'])}
+            for name, summary in self._summaries.items()}
@@ -0,0 +1,77 @@
+"""Memory budget for bodies of cached messages."""
+
+import collections
+import logging
+import typing as t
+
+_LOG = logging.getLogger(__name__)
+
+
+class MemoryBudget:
+    """Least-recently-used accounting of memory taken by bodies of messages.
+
+    Every message whose body is in memory is registered with its approximate size, i.e. size
+    of the raw message. When the total exceeds the limit, bodies of least recently used messages
+    are evicted via Message.evict_body(), leaving only their headers and flags in memory.
+    The most recently used message is never evicted.
+
+    Budgets can be nested: per-account budget with a global budget as parent. A message
+    registered in a budget is registered in all its ancestors, and eviction at any level
+    removes it from all of them.
+    """
+
+    def __init__(self, limit: t.Optional[int] = None, parent: t.Optional['MemoryBudget'] = None):
+        assert limit is None or limit > 0, limit
+        self.limit = limit
+        self.parent = parent
+        self._sizes = collections.OrderedDict()  # type: t.Dict[t.Any, int]
+        self.used = 0
+        self.evictions = 0
+
+    def add(self, message, size: int) -> None:
+        """Register message whose body was just loaded, and evict other bodies if needed."""
+        self._discard(message)
+        self._sizes[message] = size
+        self.used += size
+        if self.parent is not None:
+            self.parent.add(message, size)
+        self._evict()
+
+    def touch(self, message) -> None:
+        """Mark message as the most recently used."""
+        if message not in self._sizes:
+            return
+        self._sizes.move_to_end(message)
+        if self.parent is not None:
+            self.parent.touch(message)
+
+    def discard(self, message) -> None:
+        """Unregister message from this budget and all its ancestors."""
+        budget = self
+        while budget is not None:
+            budget._discard(message)
+            budget = budget.parent
+
+    def _discard(self, message) -> None:
+        size = self._sizes.pop(message, None)
+        if size is not None:
+            self.used -= size
+
+    def _evict(self) -> None:
+        if self.limit is None:
+            return
+        evictions = self.evictions
+        while self.used > self.limit and len(self._sizes) > 1:
+            message = next(iter(self._sizes))
+            message.evict_body()
+            self._discard(message)
+            self.evictions += 1
+        if self.evictions > evictions:
+            _LOG.debug('%s: %i bytes used by %i messages, %i evictions so far',
+                       self, self.used, len(self._sizes), self.evictions)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(limit={self.limit})'
@@ -9,6 +9,7 @@ import typing as t
 import dateutil.parser
 
 from .connection import Connection
+from .message_flags import SEEN, ANSWERED, FLAGGED, DELETED, MessageFlags
 
 _LOG = logging.getLogger(__name__)
 
@@ -87,17 +88,107 @@ class Message:
         self.return_path = None
         self.envelope_to = None
         self.message_id = None
+        self.in_reply_to = None  # type: str
+        self.references = None  # type: str
+        self.thread_id = None
         self.content_type = None
         self.other_headers = []
 
-        self.flags = set()  # type: t.Set[str]
-        self.contents = []
-        self.attachments = []
+        self.flags = MessageFlags()
+        self._contents = []  # type: t.List[str]
+        self._attachments = []  # type: t.List[email.message.Message]
+        self.headers_only = False  # type: bool
+        self._body_evicted = False  # type: bool
+        self._body_size = 0  # type: int
+        self._memory_budget = None
 
         if msg is not None:
             self._init_headers_from_email_message(msg)
             self._init_contents_from_email_message(msg)
 
+    @property
+    def email_message(self) -> email.message.EmailMessage:
+        """Complete message, which is retrieved first if only headers were retrieved so far."""
+        self.retrieve_body()
+        self._load_body()
+        return self._email_message
+
+    @property
+    def contents(self) -> t.List[str]:
+        self._load_body()
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents: t.List[str]):
+        self._contents = contents
+
+    @property
+    def attachments(self) -> t.List[email.message.Message]:
+        self._load_body()
+        return self._attachments
+
+    @attachments.setter
+    def attachments(self, attachments: t.List[email.message.Message]):
+        self._attachments = attachments
+
+    def track_body(self, memory_budget, size: int) -> None:
+        """Register the body of this message in a memory budget, see MemoryBudget."""
+        self._memory_budget = memory_budget
+        self._body_size = size
+        memory_budget.add(self, size)
+
+    def evict_body(self) -> None:
+        """Drop body and parsed contents from memory, keeping only headers and flags.
+
+        The body is retrieved again from the origin server when it is needed.
+        """
+        if self._body_evicted:
+            return
+        headers_stub = email.message.Message()
+        if self._email_message is not None:
+            for key, value in self._email_message.items():
+                headers_stub[key] = value
+        self._email_message = headers_stub
+        self._contents = []
+        self._attachments = []
+        self._body_evicted = True
+        if self._memory_budget is not None:
+            self._memory_budget.discard(self)
+
+    def _load_body(self) -> None:
+        if self._memory_budget is not None:
+            self._memory_budget.touch(self)
+        if not self._body_evicted:
+            return
+        _LOG.debug('%s: rehydrating evicted body from %s', self, self._origin_server)
+        email_message = self._origin_server.retrieve_email_message(self)
+        self._body_evicted = False
+        self._email_message = email_message
+        self._init_contents_from_email_message(email_message)
+        if self._memory_budget is not None:
+            self._memory_budget.add(self, self._body_size)
+
+    def retrieve_body(self) -> None:
+        """Retrieve the complete message from the origin server, if only headers were retrieved.
+
+        This is deferred until the body is really needed, e.g. to forward the message.
+        """
+        if not self.headers_only:
+            return
+        _LOG.debug('%s: retrieving complete message from %s', self, self._origin_server)
+        self.headers_only = False
+        try:
+            email_message = self._origin_server.retrieve_email_message(self)
+        except:
+            self.headers_only = True
+            raise
+        self._body_evicted = False
+        self._email_message = email_message
+        self._init_contents_from_email_message(email_message)
+        register_body = getattr(self._origin_server, 'register_body', None)
+        if register_body is not None:
+            register_body(self)
+
     @property
     def date(self) -> datetime.date:
         if self.datetime is None:
@@ -112,7 +203,7 @@ class Message:
 
     @property
     def is_read(self) -> bool:
-        return 'Seen' in self.flags
+        return bool(self.flags.system & SEEN)
 
     @property
     def is_unread(self) -> bool:
@@ -120,15 +211,23 @@ class Message:
 
     @property
     def is_answered(self) -> bool:
-        return 'Answered' in self.flags
+        return bool(self.flags.system & ANSWERED)
 
     @property
     def is_flagged(self) -> bool:
-        return 'Flagged' in self.flags
+        return bool(self.flags.system & FLAGGED)
 
     @property
     def is_deleted(self) -> bool:
-        return 'Deleted' in self.flags
+        return bool(self.flags.system & DELETED)
+
+    @property
+    def thread(self) -> t.List['Message']:
+        """All known messages in the same thread, according to thread index of origin server."""
+        threads = getattr(self._origin_server, 'threads', None)
+        if threads is None:
+            return [self]
+        return threads.thread_of(self)
 
     def _init_headers_from_email_message(self, msg: email.message.EmailMessage) -> None:
         for key, value in msg.items():
@@ -152,8 +251,12 @@ class Message:
             self.return_path = value
         elif key == 'Envelope-To':
             self.envelope_to = value
-        elif key == 'Message-Id':
+        elif key.lower() == 'message-id':
             self.message_id = value
+        elif key == 'In-Reply-To':
+            self.in_reply_to = value
+        elif key == 'References':
+            self.references = value
         elif key == 'Content-Type':
             self.content_type = value
         else:
@@ -211,7 +314,7 @@ class Message:
         content_type = part.get_content_type()
         if content_type not in {'text/plain', 'text/html'}:
             _LOG.info('treating message part with type %s as attachment', content_type)
-            self.attachments.append(part)
+            self._attachments.append(part)
             return
         charset = part.get_content_charset()
         if charset:
@@ -232,11 +335,11 @@ class Message:
             if not isinstance(text, str):
                 _LOG.error('no content charset in a message %s in part %s -- attachment?',
                            self.str_headers_compact(), part.as_bytes()[:128])
-                self.attachments.append(part)
+                self._attachments.append(part)
                 text = None
         if not text:
             return
-        self.contents.append(text)
+        self._contents.append(text)
 
     def move_to(self, server: Connection, folder_name: str) -> None:
         """Move message to a specific folder on a specific server."""
@@ -245,13 +348,12 @@ class Message:
             from .imap_connection import IMAPConnection
             assert isinstance(self._origin_server, IMAPConnection), type(self._origin_server)
             assert isinstance(server, IMAPConnection), type(server)
-            parts = self._origin_server.retrieve_message_parts(
-                self._origin_id, ['UID', 'ENVELOPE', 'FLAGS', 'INTERNALDATE', 'BODY.PEEK[]'],
-                self._origin_folder)
+            from .message_transfer import MessageTransfer
             _LOG.warning('moving %s between servers: from %s "%s" to %s "%s"',
                          self, self._origin_server, self._origin_folder, server, folder_name)
-            server.add_message(parts, folder_name)
-            self._origin_server.delete_message(self._origin_id, self._origin_folder)
+            MessageTransfer(
+                self._origin_server, self._origin_folder, server, folder_name,
+                journal=self._origin_server.journal).run([self._origin_id])
             return
         if folder_name == self._origin_folder:
             _LOG.debug('move_to() destination same as origin, nothing to do')
@@ -266,7 +368,7 @@ class Message:
         raise NotImplementedError()
 
     def send_via(self, server: Connection) -> None:
-        server.send_message(self._email_message)
+        server.send_message(self.email_message)
 
     def str_oneline(self):
         return (f'{type(self).__name__}(From:{self.from_name}<{self.from_address}>,'
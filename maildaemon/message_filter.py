@@ -1,14 +1,28 @@
 """Filter that is applied on e-mail messages."""
 
+import collections
+import contextlib
+import datetime
 import functools
+import importlib
 import logging
 import operator
 import re
+import signal
+import threading
+import time
 import typing as t
 
+from .latency_statistics import LatencyStatistics
 from .message import Message
 from .connection import Connection
-from .filter_actions import mark, move
+from .filter_cache import make_condition_key
+from .message_flags import SYSTEM_FLAGS
+from .filter_actions import \
+    mark, move, delete, forward, coalesce_actions, apply_coalesced_actions
+
+if t.TYPE_CHECKING:
+    from .folder_columns import FolderColumns
 
 _LOG = logging.getLogger(__name__)
 
@@ -39,9 +53,9 @@ ACTIONS = {
     'mark': mark,
     'move': move,
     'copy': lambda message, imap_daemon, folder: imap_daemon.copy_message(message, folder),
-    'delete': None,
+    'delete': delete,
     'reply': None,
-    'forward': lambda message, smtp_daemon, address: smtp_daemon.forward_message(message, address)}
+    'forward': forward}
 """Define a mapping: str -> t.Callable[[Message], None].
 
 In such mapping:
@@ -55,15 +69,67 @@ Every action is meant to create and return one-argument function that performs a
 involving a and possibly other entities.
 """
 
+FORWARD_MODES = {'': False, 'resend': False, 'attachment': True}
+"""Define a mapping: str -> bool, from mode of forward action to its "as_attachment" argument.
+
+The action is written as "forward:<SMTP connection>/<address>" or
+"forward:<SMTP connection>/<address>/<mode>".
+"""
+
 FILTER_CODE = 'lambda message: {}'
 
+COLUMNS_FILTER_CODE = 'lambda columns: {}'
+"""Code of columns condition, which selects messages of columnar folders via FolderColumns.
+
+System flags (SEEN, FLAGGED, DELETED, etc.) and the datetime module are available in it.
+"""
+
+STATISTICS_COUNTERS = ('evaluated', 'matched', 'errored', 'budget_exceeded', 'action_failures')
+
+REGEX_ENGINES = {'re': 're', 're2': 're2'}
+"""Define a mapping: str -> str, from regex engine name to module implementing it.
+
+Module is made available as "re" in the filter condition. The "re2" module is provided by
+the optional google-re2 package, and it guarantees matching in time linear in input size.
+"""
+
+DEFAULT_MAX_BUDGET_VIOLATIONS = 3
+
+
+class EvaluationTimeout(RuntimeError):
+    """Raised when evaluation of a filter condition exceeds its time budget."""
+
+
+@contextlib.contextmanager
+def evaluation_time_limit(seconds: t.Optional[float]):
+    """Raise EvaluationTimeout in the context if it does not finish within given time.
+
+    Regular expression matching is interruptible too. The limit is enforced using SIGALRM,
+    so it works only in the main thread on platforms that have it. Elsewhere, this does nothing.
+    """
+    if seconds is None or not hasattr(signal, 'setitimer') \
+            or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(*_):
+        raise EvaluationTimeout(f'evaluation did not finish within {seconds}s')
+
+    previous_handler = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, max(seconds, 1e-6))
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
 
 class MessageFilter:
     """For selective actions on messages."""
 
     @classmethod
-    def from_dict(cls, data: dict,
-                  named_connections: t.Mapping[str, Connection] = {}) -> 'MessageFilter':
+    def from_dict(cls, data: dict, named_connections: t.Mapping[str, Connection] = {},
+                  name: t.Optional[str] = None) -> 'MessageFilter':
         try:
             connection_names = data['connections']
         except KeyError:
@@ -73,7 +139,17 @@ class MessageFilter:
         for connection_name in connection_names:
             connections.append(named_connections[connection_name])
 
-        condition = eval(FILTER_CODE.format(data['condition']))
+        regex_engine = data.get('regex-engine', 're')
+        try:
+            regex_module = importlib.import_module(REGEX_ENGINES[regex_engine])
+        except (KeyError, ImportError) as err:
+            raise RuntimeError(f'regex engine "{regex_engine}" is not available') from err
+        condition = eval(FILTER_CODE.format(data['condition']), {**globals(), 're': regex_module})
+        columns_condition = None
+        if 'columns-condition' in data:
+            columns_condition = eval(COLUMNS_FILTER_CODE.format(data['columns-condition']), {
+                **globals(), 're': regex_module, 'datetime': datetime,
+                **{flag.upper(): bit for flag, bit in SYSTEM_FLAGS.items()}})
 
         try:
             action_strings = data['actions']
@@ -95,6 +171,14 @@ class MessageFilter:
                 args = (named_connections[connection], folder)
             elif action is mark:
                 args = (raw_args,)
+            elif action is delete:
+                args = ()
+            elif action is forward:
+                connection, _, address = raw_args.partition('/')
+                address, _, mode = address.partition('/')
+                if mode not in FORWARD_MODES:
+                    raise RuntimeError(f'invalid forward mode "{mode}" in action "{action_string}"')
+                args = (named_connections[connection], address, FORWARD_MODES[mode])
             else:
                 raise NotImplementedError(
                     f'parsing args "{raw_args}" for action "{operation}" is not implemented yet')
@@ -102,41 +186,145 @@ class MessageFilter:
                        operation, action, args)
             actions.append((action, args))
 
-        return cls(connections, condition, actions)
+        return cls(
+            connections, condition, actions, name, data.get('time-budget', None),
+            data.get('max-budget-violations', DEFAULT_MAX_BUDGET_VIOLATIONS),
+            make_condition_key(data['condition'], regex_engine), data.get('run-once', False),
+            columns_condition)
 
     def __init__(
             self, connections: t.List[Connection],
             condition: t.List[t.List[t.Tuple[str, t.Callable[[str], bool]]]],
-            actions: t.List[t.Tuple[t.Callable[[t.Any], None], t.Sequence[t.Any]]]):
+            actions: t.List[t.Tuple[t.Callable[[t.Any], None], t.Sequence[t.Any]]],
+            name: t.Optional[str] = None, time_budget: t.Optional[float] = None,
+            max_budget_violations: int = DEFAULT_MAX_BUDGET_VIOLATIONS,
+            condition_key: t.Optional[str] = None, run_once: bool = False,
+            columns_condition: t.Optional[t.Callable[['FolderColumns'], t.Any]] = None):
+        if name is None:
+            name = f'filter{id(self)}'
         self._connections = connections
         self._condition = condition
         self._actions = actions
+        self.name = name
+        self.time_budget = time_budget
+        self.max_budget_violations = max_budget_violations
+        self.enabled = True
+        self.condition_key = condition_key
+        """Identifies the condition if outcomes of this filter can be cached, None otherwise."""
+        self.run_once = run_once
+        """If True, copies of the same message in other connections or folders are ignored."""
+        self._columns_condition = columns_condition
+        self.statistics = collections.Counter({counter: 0 for counter in STATISTICS_COUNTERS})
+        self.latencies = LatencyStatistics()
+
+    def applies_to(self, message: Message, time_budget: t.Optional[float] = None) -> bool:
+        """Evaluate the condition of this filter on the given message.
 
-    def applies_to(self, message: Message) -> bool:
+        :param time_budget: optional, used instead of the time budget of this filter
+          if it is smaller, e.g. what is left of the time budget of the message
+
+        Evaluation that exceeds the time budget is aborted and treated as not applicable.
+        Only evaluations that exceed the time budget of this filter count as its violations,
+        and after max_budget_violations such evaluations, the filter is disabled.
+        """
+        return bool(self.evaluate(message, time_budget))
+
+    def evaluate(
+            self, message: Message, time_budget: t.Optional[float] = None) -> t.Optional[bool]:
+        """Work like applies_to(), but return None if there is no outcome.
+
+        That is the case if the filter is disabled, or the evaluation failed or was aborted.
+        """
+        if not self.enabled:
+            return None
+        # otherwise, the given time budget is the limit, and exceeding it is not this filter's fault
+        own_time_budget = self.time_budget is not None \
+            and (time_budget is None or self.time_budget <= time_budget)
+        if own_time_budget:
+            time_budget = self.time_budget
+        self.statistics['evaluated'] += 1
         try:
-            return self._condition(message)
+            with evaluation_time_limit(time_budget):
+                start = time.perf_counter()
+                result = self._condition(message)
+                elapsed = time.perf_counter() - start
+        except EvaluationTimeout:
+            if own_time_budget:
+                self._record_budget_violation(message, time_budget)
+            return None
         except:
+            self.statistics['errored'] += 1
             _LOG.exception('filter %s failed on message %s', self, message)
-            return False
+            return None
+        self.latencies.record('condition', elapsed)
+        if own_time_budget and elapsed > time_budget:
+            # the limit is not enforced in some cases, see evaluation_time_limit()
+            self._record_budget_violation(message, time_budget)
+        if result:
+            self.statistics['matched'] += 1
+        return bool(result)
+
+    def select_columns(self, columns: 'FolderColumns') -> t.Optional[t.Any]:
+        """Evaluate the columns condition of this filter on metadata of a columnar folder.
+
+        Return mask of selected messages, or None if the filter is disabled, it has no columns
+        condition, or the evaluation failed.
+        """
+        if not self.enabled or self._columns_condition is None:
+            return None
+        try:
+            with self.latencies.measure('columns_condition'):
+                return self._columns_condition(columns)
+        except BaseException:
+            self.statistics['errored'] += 1
+            _LOG.exception('filter %s failed on columns %s', self, columns)
+            return None
+
+    def _record_budget_violation(self, message: Message, time_budget: float) -> None:
+        self.statistics['budget_exceeded'] += 1
+        _LOG.warning('filter "%s" exceeded time budget of %fs on message %s',
+                     self.name, time_budget, message)
+        if self.statistics['budget_exceeded'] >= self.max_budget_violations:
+            self.enabled = False
+            _LOG.error('filter "%s" disabled after %i time budget violations',
+                       self.name, self.statistics['budget_exceeded'])
 
     def apply_unconditionally(self, message: Message):
         """Apply actions of this filter to the given message ignoring the conditions."""
-        for action, args in self._actions:
-            if action not in {move, mark}:
-                raise RuntimeError('refusing to execute untested action')
-            if action is mark:
-                args = (message._origin_server, *args)
-            action(message, *args)
+        self.apply_unconditionally_to_many([message])
+
+    def apply_unconditionally_to_many(self, messages: t.Sequence[Message]):
+        """Apply actions of this filter to the given messages ignoring the conditions.
+
+        Actions are coalesced, so that the end state of messages is reached
+        with as few commands as possible, see apply_coalesced_actions().
+        """
+        if not messages or not self._actions:
+            return
+        actions = coalesce_actions(self._actions)
+        try:
+            apply_coalesced_actions(messages, actions, self.latencies)
+        except BaseException:
+            self.statistics['action_failures'] += 1
+            raise
 
     def apply_to(self, message: Message):
         """Apply filter on the message if it satisfies the filter conditions."""
         if self.applies_to(message):
             self.apply_unconditionally(message)
 
+    def summarize_statistics(self) -> t.Dict[str, t.Any]:
+        """Return counters of this filter and summary of its condition and action latencies."""
+        return {
+            'name': self.name, 'enabled': self.enabled, **self.statistics,
+            'latencies': self.latencies.summarize()}
+
+    def str_actions(self) -> t.List[str]:
+        return [f'{action.__name__}(message, {", ".join([str(arg) for arg in args])})'
+                for action, args in self._actions]
+
     def __str__(self):
         return str({
             'connections': self._connections,
             'condition': self._condition,
-            'actions': [
-                f'{action.__name__}(message, {", ".join([str(arg) for arg in args])})'
-                for action, args in self._actions]})
+            'actions': self.str_actions()})
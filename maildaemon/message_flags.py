@@ -0,0 +1,130 @@
+"""Compact representation of flags of e-mail messages."""
+
+import sys
+import typing as t
+
+SEEN = 1
+ANSWERED = 2
+FLAGGED = 4
+DELETED = 8
+DRAFT = 16
+RECENT = 32
+
+SYSTEM_FLAGS = {
+    'Seen': SEEN, 'Answered': ANSWERED, 'Flagged': FLAGGED, 'Deleted': DELETED, 'Draft': DRAFT,
+    'Recent': RECENT}
+"""Define a mapping: str -> int, from IMAP system flag (RFC 3501) without backslash to its bit."""
+
+IMAP_SYSTEM_FLAGS = {f'\\{flag}'.encode(): bit for flag, bit in SYSTEM_FLAGS.items()}
+"""Define a mapping: bytes -> int, from IMAP system flag as in FETCH response to its bit."""
+
+_KEYWORDS = {(): ()}  # type: t.Dict[t.Tuple[str, ...], t.Tuple[str, ...]]
+
+
+def intern_keywords(keywords: t.Iterable[str]) -> t.Tuple[str, ...]:
+    """Return a sorted tuple of keywords, shared by all messages with the same keywords."""
+    key = tuple(sorted(set(keywords)))
+    try:
+        return _KEYWORDS[key]
+    except KeyError:
+        pass
+    key = tuple(sys.intern(keyword) for keyword in key)
+    _KEYWORDS[key] = key
+    return key
+
+
+class MessageFlags(t.MutableSet[str]):
+    """Set of flags of a message, with system flags stored as bits of an integer.
+
+    Other flags (keywords) are kept in an interned tuple, so that messages with the same
+    keywords share it. System flags are named without the leading backslash, like 'Seen'.
+    """
+
+    __slots__ = ('system', 'keywords')
+
+    def __init__(self, flags: t.Iterable[str] = ()):
+        self.system = 0  # type: int
+        self.keywords = ()  # type: t.Tuple[str, ...]
+        self.update(flags)
+
+    @classmethod
+    def from_imap(cls, raw_flags: t.Iterable[bytes]) -> 'MessageFlags':
+        """Create flags from raw flags in FETCH response, like b'\\Seen' or b'$Forwarded'."""
+        flags = cls()
+        keywords = []
+        for raw_flag in raw_flags:
+            bit = IMAP_SYSTEM_FLAGS.get(raw_flag)
+            if bit is not None:
+                flags.system |= bit
+                continue
+            keyword = raw_flag.decode()
+            keywords.append(keyword[1:] if keyword.startswith('\\') else keyword)
+        if keywords:
+            flags.keywords = intern_keywords(keywords)
+        return flags
+
+    @classmethod
+    def _from_iterable(cls, iterable: t.Iterable[str]) -> t.Set[str]:
+        return set(iterable)
+
+    def __contains__(self, flag: object) -> bool:
+        bit = SYSTEM_FLAGS.get(flag)  # type: ignore
+        if bit is not None:
+            return bool(self.system & bit)
+        return flag in self.keywords
+
+    def __iter__(self) -> t.Iterator[str]:
+        for flag, bit in SYSTEM_FLAGS.items():
+            if self.system & bit:
+                yield flag
+        yield from self.keywords
+
+    def __len__(self) -> int:
+        return bin(self.system).count('1') + len(self.keywords)
+
+    def add(self, flag: str) -> None:
+        bit = SYSTEM_FLAGS.get(flag)
+        if bit is not None:
+            self.system |= bit
+        elif flag not in self.keywords:
+            self.keywords = intern_keywords(self.keywords + (flag,))
+
+    def discard(self, flag: str) -> None:
+        bit = SYSTEM_FLAGS.get(flag)
+        if bit is not None:
+            self.system &= ~bit
+        elif flag in self.keywords:
+            self.keywords = intern_keywords(_ for _ in self.keywords if _ != flag)
+
+    def update(self, flags: t.Iterable[str]) -> None:
+        keywords = []
+        for flag in flags:
+            bit = SYSTEM_FLAGS.get(flag)
+            if bit is not None:
+                self.system |= bit
+            else:
+                keywords.append(flag)
+        if keywords:
+            self.keywords = intern_keywords(self.keywords + tuple(keywords))
+
+    def clear(self) -> None:
+        self.system = 0
+        self.keywords = ()
+
+    def assign(self, flags: 'MessageFlags') -> None:
+        """Replace all flags in place, for example with flags from a FETCH response."""
+        self.system = flags.system
+        self.keywords = flags.keywords
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, MessageFlags):
+            return self.system == other.system and self.keywords == other.keywords
+        return super().__eq__(other)
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return f'{type(self).__name__}({set(self)})'
+
+    def __str__(self):
+        return str(set(self))
@@ -0,0 +1,133 @@
+"""Persistent store of messages cached by e-mail caches."""
+
+import logging
+import pathlib
+import sqlite3
+import typing as t
+
+from .message import Message
+
+_LOG = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid NOT NULL,
+    flags TEXT NOT NULL,
+    message_id TEXT,
+    from_address TEXT,
+    subject TEXT,
+    datetime TEXT,
+    headers BLOB NOT NULL,
+    body BLOB,
+    PRIMARY KEY (account, folder, uidvalidity, uid)) WITHOUT ROWID
+'''
+"""Schema of the store.
+
+The uid column has no type affinity, so it holds integer IMAP UIDs and textual POP UIDLs alike.
+The body column holds complete raw message, and it is filled only if bodies are stored.
+"""
+
+
+class StoredMessage(t.NamedTuple):
+    """Message data as kept in the store."""
+
+    flags: t.Set[str]
+    headers: bytes
+    body: t.Optional[bytes]
+
+
+def split_raw_message(raw_message: bytes) -> t.Tuple[bytes, t.Optional[bytes]]:
+    """Split raw message into headers and the rest, which is None if there is no body."""
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        index = raw_message.find(separator)
+        if index >= 0:
+            end = index + len(separator)
+            return raw_message[:end], raw_message[end:] or None
+    return raw_message, None
+
+
+class MessageStore:
+    """Messages of all folders of all e-mail caches, keyed by (account, folder, UIDVALIDITY, UID).
+
+    For POP connections, UIDVALIDITY is 0 and UIDL is used as UID.
+    """
+
+    def __init__(self, path: pathlib.Path, store_bodies: bool = False):
+        self._path = path
+        self.store_bodies = store_bodies
+        self._db = sqlite3.connect(str(path))
+        self._db.execute(SCHEMA)
+
+    def load_messages(
+            self, account: str, folder: str,
+            uidvalidity: int) -> t.Dict[t.Union[int, str], StoredMessage]:
+        """Load all messages of a folder.
+
+        Messages stored with a different UIDVALIDITY are outdated, and they are dropped.
+        """
+        cursor = self._db.execute(
+            'DELETE FROM messages WHERE account = ? AND folder = ? AND uidvalidity != ?',
+            (account, folder, uidvalidity))
+        if cursor.rowcount:
+            _LOG.warning('%s: UIDVALIDITY of "%s" in %s changed, dropped %i stored messages',
+                         self, folder, account, cursor.rowcount)
+        rows = self._db.execute(
+            'SELECT uid, flags, headers, body FROM messages'
+            ' WHERE account = ? AND folder = ? AND uidvalidity = ?',
+            (account, folder, uidvalidity))
+        return {
+            uid: StoredMessage(set(flags.split()), headers, body)
+            for uid, flags, headers, body in rows}
+
+    def load_message(
+            self, account: str, folder: str, uidvalidity: int,
+            uid: t.Union[int, str]) -> t.Optional[StoredMessage]:
+        row = self._db.execute(
+            'SELECT flags, headers, body FROM messages'
+            ' WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?',
+            (account, folder, uidvalidity, uid)).fetchone()
+        if row is None:
+            return None
+        flags, headers, body = row
+        return StoredMessage(set(flags.split()), headers, body)
+
+    def save_message(
+            self, account: str, folder: str, uidvalidity: int, uid: t.Union[int, str],
+            message: Message, raw_message: bytes) -> None:
+        """Store message given as raw headers, or raw headers followed by body."""
+        headers, body = split_raw_message(raw_message)
+        self._db.execute(
+            'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (account, folder, uidvalidity, uid, ' '.join(sorted(message.flags)),
+             message.message_id, message.from_address, message.subject,
+             None if message.datetime is None else message.datetime.isoformat(),
+             headers, raw_message if self.store_bodies and body is not None else None))
+
+    def update_flags(
+            self, account: str, folder: str, uidvalidity: int,
+            flags: t.Mapping[t.Union[int, str], t.Set[str]]) -> None:
+        self._db.executemany(
+            'UPDATE messages SET flags = ?'
+            ' WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?',
+            [(' '.join(sorted(uid_flags)), account, folder, uidvalidity, uid)
+             for uid, uid_flags in flags.items()])
+
+    def remove_messages(
+            self, account: str, folder: str, uidvalidity: int,
+            uids: t.Iterable[t.Union[int, str]]) -> None:
+        self._db.executemany(
+            'DELETE FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?',
+            [(account, folder, uidvalidity, uid) for uid in uids])
+
+    def flush(self) -> None:
+        self._db.commit()
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._path})'
@@ -0,0 +1,177 @@
+"""Index of conversation threads of cached messages."""
+
+import logging
+import re
+import typing as t
+
+from .message import Message
+
+_LOG = logging.getLogger(__name__)
+
+MESSAGE_ID_PATTERN = re.compile(r'<[^<>\s]+>')
+
+_Key = t.Union[str, t.Tuple[str, t.Any]]
+
+
+def parse_message_ids(value: t.Optional[str]) -> t.List[str]:
+    """Extract Message-Ids from a value of References or In-Reply-To header."""
+    if value is None:
+        return []
+    return MESSAGE_ID_PATTERN.findall(value)
+
+
+class ThreadIndex:
+    """Incrementally maintained index of threads, based on the JWZ threading algorithm.
+
+    See https://www.jwz.org/doc/threading.html for details of the algorithm. Every Message-Id
+    seen either in a message or in its References/In-Reply-To headers gets a container,
+    and containers are linked into parent-child trees as in the algorithm. Messages with
+    the same server-side thread id (like Gmail X-GM-THRID), or reported in the same thread
+    by IMAP THREAD command, are put in the same thread even if their headers don't link them.
+
+    Thread membership is kept in a disjoint-set forest with union by size and path compression,
+    so finding a thread of a message takes amortized constant time. Grouping of messages
+    by subject (step 5 of the algorithm) is not done, and threads are never split:
+    removing a message removes it from its thread, but the thread stays joined. Containers
+    no longer needed by any message in the index are dropped when messages are removed.
+    """
+
+    def __init__(self):
+        self._parents = {}  # type: t.Dict[_Key, _Key]
+        self._set_parents = {}  # type: t.Dict[_Key, _Key]
+        self._set_members = {}  # type: t.Dict[_Key, t.Dict[_Key, None]]
+        self._messages = {}  # type: t.Dict[_Key, t.List[Message]]
+
+    @staticmethod
+    def _key_of(message: Message) -> _Key:
+        if message.message_id is None:
+            return ('message', id(message))
+        return message.message_id
+
+    def _find(self, key: _Key) -> _Key:
+        if key not in self._set_parents:
+            self._set_parents[key] = key
+            self._set_members[key] = {key: None}
+            return key
+        root = key
+        while self._set_parents[root] != root:
+            root = self._set_parents[root]
+        while self._set_parents[key] != root:
+            self._set_parents[key], key = root, self._set_parents[key]
+        return root
+
+    def _union(self, key1: _Key, key2: _Key) -> _Key:
+        root1, root2 = self._find(key1), self._find(key2)
+        if root1 == root2:
+            return root1
+        if len(self._set_members[root1]) < len(self._set_members[root2]):
+            root1, root2 = root2, root1
+        self._set_parents[root2] = root1
+        self._set_members[root1].update(self._set_members.pop(root2))
+        return root1
+
+    def _is_ancestor(self, ancestor: _Key, key: _Key) -> bool:
+        while key is not None:
+            if key == ancestor:
+                return True
+            key = self._parents.get(key)
+        return False
+
+    def _link(self, parent: _Key, child: _Key, overwrite: bool) -> None:
+        if parent == child or (child in self._parents and not overwrite):
+            return
+        if self._is_ancestor(child, parent):
+            _LOG.debug('%s: not linking %s to %s, as that would create a loop', self, child, parent)
+            return
+        self._parents[child] = parent
+        self._union(parent, child)
+
+    def add_message(self, message: Message, thread_id: t.Optional[t.Any] = None) -> None:
+        """Add message to the index, optionally with a server-side thread id.
+
+        If thread id is not given, message.thread_id is used, if set.
+        """
+        key = self._key_of(message)
+        self._find(key)
+        self._messages.setdefault(key, []).append(message)
+        references = parse_message_ids(message.references)
+        in_reply_to = parse_message_ids(message.in_reply_to)
+        if in_reply_to and (not references or references[-1] != in_reply_to[0]):
+            references.append(in_reply_to[0])
+        for parent, child in zip(references, references[1:]):
+            self._link(parent, child, overwrite=False)
+        if references:
+            self._link(references[-1], key, overwrite=True)
+        if thread_id is None:
+            thread_id = message.thread_id
+        if thread_id is not None:
+            self._union(('thread', thread_id), key)
+
+    def add_thread(self, messages: t.Iterable[Message]) -> None:
+        """Put messages in one thread, for example according to IMAP THREAD response."""
+        keys = [self._key_of(message) for message in messages]
+        for key in keys[1:]:
+            self._union(keys[0], key)
+
+    def remove_message(self, message: Message) -> None:
+        """Remove message from the index, and prune containers its thread no longer needs."""
+        key = self._key_of(message)
+        messages = self._messages.get(key, [])
+        if message in messages:
+            messages.remove(message)
+        if messages:
+            return
+        self._messages.pop(key, None)
+        if key in self._set_parents:
+            self._prune(self._find(key))
+
+    def _prune(self, root: _Key) -> None:
+        """Rebuild the thread with a given root, keeping only containers that are still needed.
+
+        Containers of messages in the index and of their ancestors are kept, and so are
+        server-side thread ids, unless no message of the thread is left.
+        """
+        members = self._set_members.pop(root)
+        needed = {}  # type: t.Dict[_Key, None]
+        for member in members:
+            key = member  # type: t.Optional[_Key]
+            if key not in self._messages:
+                continue
+            while key is not None and key not in needed:
+                needed[key] = None
+                key = self._parents.get(key)
+        if needed:
+            needed.update(
+                (member, None) for member in members
+                if isinstance(member, tuple) and member[0] == 'thread')
+        for member in members:
+            if member not in needed:
+                del self._set_parents[member]
+                self._parents.pop(member, None)
+        if not needed:
+            return
+        root = next(iter(needed))
+        for member in needed:
+            self._set_parents[member] = root
+        self._set_members[root] = needed
+
+    def parent_of(self, message: Message) -> t.Optional[Message]:
+        """Find the closest ancestor of the message that is in the index."""
+        key = self._parents.get(self._key_of(message))
+        while key is not None:
+            if key in self._messages:
+                return self._messages[key][0]
+            key = self._parents.get(key)
+        return None
+
+    def thread_of(self, message: Message) -> t.List[Message]:
+        """List all messages in the same thread as the given message, including itself."""
+        key = self._key_of(message)
+        if key not in self._set_parents:
+            return [message]
+        return [
+            thread_message for member in self._set_members[self._find(key)]
+            for thread_message in self._messages.get(member, [])]
+
+    def __len__(self):
+        return len(self._messages)
@@ -0,0 +1,204 @@
+"""Transfer of messages between IMAP servers."""
+
+import logging
+import mmap
+import queue
+import tempfile
+import threading
+import typing as t
+
+import timing
+
+from .action_journal import ActionJournal
+from .imap_cache import UID_PATTERN, SIZE_PATTERN
+from .imap_connection import IMAPConnection
+
+_LOG = logging.getLogger(__name__)
+_TIME = timing.get_timing_group(__name__)
+
+BATCH_SIZE = 50
+"""Maximum number of messages fetched and appended together."""
+
+BATCH_BYTES = 16 * 1024 * 1024
+"""Maximum total size in bytes of messages fetched together, unless a single message is larger."""
+
+SPOOL_THRESHOLD = 1024 * 1024
+"""Size in bytes above which fetched messages are kept in temporary files until appended."""
+
+FETCHED_BATCHES = 2
+"""Maximum number of fetched batches waiting to be appended."""
+
+
+class TransferStatistics(t.NamedTuple):
+    """Outcome of a transfer."""
+
+    messages: int
+    bytes: int
+    spooled: int
+    """Number of messages that were kept in temporary files."""
+    elapsed: float
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+
+_FetchedMessage = t.Tuple[t.Tuple[bytes, t.Union[bytes, mmap.mmap]], t.Optional[t.BinaryIO]]
+
+
+def _release(messages: t.Sequence[_FetchedMessage]) -> None:
+    for (_, body), spool_file in messages:
+        if spool_file is not None:
+            body.close()
+            spool_file.close()
+
+
+class MessageTransfer:
+    """Move messages from a folder on one IMAP server to a folder on another.
+
+    Sizes of messages are fetched first, to split them into batches of at most batch_size
+    messages and batch_bytes bytes. Batches are fetched in a background thread while
+    the previous ones are appended, and messages larger than spool_threshold are kept
+    in temporary files (memory-mapped for APPEND) instead of in memory. Each batch
+    is appended using one MULTIAPPEND command if the target supports it.
+
+    Originals are deleted using one STORE command, after the target confirmed all appends.
+    If an append fails, only originals of messages from the batches confirmed before are deleted.
+    If there is a journal, every step is recorded in it, so that the transfer can be completed
+    after a crash, see ActionJournal.
+    """
+
+    def __init__(
+            self, source: IMAPConnection, source_folder: str, target: IMAPConnection,
+            target_folder: str, extra_flags: t.Sequence[str] = (), batch_size: int = BATCH_SIZE,
+            batch_bytes: int = BATCH_BYTES, spool_threshold: int = SPOOL_THRESHOLD,
+            journal: t.Optional[ActionJournal] = None):
+        assert batch_size >= 1, batch_size
+        self.source = source
+        self.source_folder = source_folder
+        self.target = target
+        self.target_folder = target_folder
+        self.extra_flags = extra_flags
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.spool_threshold = spool_threshold
+        self.journal = journal
+
+    def _plan_batches(self, message_ids: t.Sequence[int]) -> t.List[t.List[int]]:
+        sizes = {}
+        for metadata, _ in self.source.retrieve_messages_parts(
+                list(message_ids), ['UID', 'RFC822.SIZE'], self.source_folder):
+            uid_match = UID_PATTERN.search(metadata)
+            size_match = SIZE_PATTERN.search(metadata)
+            if uid_match is not None and size_match is not None:
+                sizes[int(uid_match.group(1))] = int(size_match.group(1))
+        batches = []  # type: t.List[t.List[int]]
+        batch_bytes = 0
+        for message_id in message_ids:
+            size = sizes.get(message_id, 0)
+            if batches and len(batches[-1]) < self.batch_size \
+                    and batch_bytes + size <= self.batch_bytes:
+                batches[-1].append(message_id)
+                batch_bytes += size
+            else:
+                batches.append([message_id])
+                batch_bytes = size
+        return batches
+
+    def _spool(self, message_parts: t.Tuple[bytes, bytes]) -> _FetchedMessage:
+        metadata, body = message_parts
+        if len(body) <= self.spool_threshold:
+            return message_parts, None
+        spool_file = tempfile.TemporaryFile()
+        spool_file.write(body)
+        spool_file.flush()
+        return (metadata, mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)), spool_file
+
+    def _fetch(self, batches: t.Sequence[t.List[int]], fetched: queue.Queue,
+               stop: threading.Event) -> None:
+        """Fetch batches one by one, and finally put None, or the error if fetching failed."""
+        try:
+            for batch in batches:
+                if stop.is_set():
+                    break
+                messages_parts = self.source.retrieve_raw_messages(batch, self.source_folder)
+                fetched.put((batch, [self._spool(parts) for parts in messages_parts]))
+                del messages_parts
+        except Exception as err:
+            fetched.put(err)
+            return
+        fetched.put(None)
+
+    def run(self, message_ids: t.Sequence[int]) -> TransferStatistics:
+        """Move given messages and return statistics of the transfer."""
+        if not message_ids:
+            return TransferStatistics(0, 0, 0, 0.0)
+        transferred = []  # type: t.List[int]
+        transferred_bytes = 0
+        spooled = 0
+        with _TIME.measure('transfer') as timer:
+            batches = self._plan_batches(message_ids)
+            entry_id = None
+            if self.journal is not None:
+                entry_id = self.journal.begin(
+                    self.source, self.source_folder, self.source.uidvalidity, message_ids,
+                    self.target, self.target_folder)
+            fetched = queue.Queue(FETCHED_BATCHES)  # type: queue.Queue
+            stop = threading.Event()
+            fetcher = threading.Thread(
+                target=self._fetch, args=(batches, fetched, stop), name=f'{self}', daemon=True)
+            fetcher.start()
+            fetching = True
+            try:
+                while True:
+                    item = fetched.get()
+                    if item is None or isinstance(item, Exception):
+                        fetching = False
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    batch, messages = item
+                    batch_bytes = sum(len(body) for (_, body), _ in messages)
+                    try:
+                        self.target.add_messages(
+                            [parts for parts, _ in messages], self.target_folder,
+                            self.extra_flags)
+                    finally:
+                        _release(messages)
+                    if entry_id is not None:
+                        self.journal.record_copied(entry_id, batch)
+                    transferred += batch
+                    transferred_bytes += batch_bytes
+                    spooled += sum(spool_file is not None for _, spool_file in messages)
+            except BaseException:
+                stop.set()
+                while fetching:
+                    item = fetched.get()
+                    if item is None or isinstance(item, Exception):
+                        break
+                    _release(item[1])
+                raise
+            finally:
+                fetcher.join()
+                if transferred:
+                    self.source.delete_messages(transferred, self.source_folder)
+            # after a failure, outcome of the last append is unknown, so it is left for recovery
+            if entry_id is not None:
+                self.journal.end(entry_id)
+        statistics = TransferStatistics(
+            len(transferred), transferred_bytes, spooled, timer.elapsed)
+        _LOG.info(
+            '%s: moved %i messages (%i bytes, %i spooled) in %i batches in %fs,'
+            ' %.1f messages/s, %.1f KiB/s', self, statistics.messages, statistics.bytes,
+            statistics.spooled, len(batches), statistics.elapsed,
+            statistics.messages_per_second, statistics.bytes_per_second / 1024)
+        return statistics
+
+    def __str__(self):
+        return (f'{type(self).__name__}({self.source} "{self.source_folder}"'
+                f' -> {self.target} "{self.target_folder}")')
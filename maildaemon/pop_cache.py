@@ -1,11 +1,14 @@
 """Cache for messages accessed via POP connections."""
 
+import contextlib
+import email.message
 import email.parser
 import logging
 import typing as t
 
 from .message import Message
 from .folder import Folder
+from .message_store import StoredMessage
 from .email_cache import EmailCache
 from .pop_connection import POPConnection
 
@@ -18,64 +21,205 @@ class POPCache(EmailCache, POPConnection):
     def __init__(self, domain: str, port: t.Optional[int] = None, ssl: bool = True):
         EmailCache.__init__(self)
         POPConnection.__init__(self, domain, port, ssl)
+        self._message_uidls = {}  # type: t.Dict[int, str]
+        self._message_sizes = {}  # type: t.Dict[int, int]
+        self.headers_only = False
+        """If True, only headers of new messages are retrieved, like in IMAPCache."""
         # self.folders = ['INBOX']  # type: t.List[str]
         # self.message_ids = {'INBOX': []}  # type: t.Mapping[str, t.List[int]]
         # self.messages = {}  # type: t.Mapping[t.Tuple[str, int], Message]
 
     def update_folders(self):
         if not self.folders:
-            self.folders['INBOX'] = Folder(self, 'INBOX')
+            self.folders['INBOX'] = Folder(self, 'INBOX', threads=self.threads)
         assert len(self.folders) == 1, len(self.folders)
         assert 'INBOX' in self.folders, self.folders
 
-    def retrieve_messages(self, message_ids: t.List[int]) -> t.List[Message]:
-        messages = []
+    def retrieve_messages(
+            self, message_ids: t.List[int], headers_only: bool = False) -> t.List[Message]:
+        return [message for message, _ in self._retrieve_messages(message_ids, headers_only)]
+
+    def _retrieve_messages(
+            self, message_ids: t.List[int], headers_only: bool = False,
+            keep_raw: bool = False) -> t.Iterator[t.Tuple[Message, t.Optional[bytes]]]:
+        """Retrieve messages together with raw messages, which are None unless keep_raw is True.
+
+        Without the body store, messages are parsed while they are received, and commands
+        are pipelined if the server supports it. Otherwise, the body store is consulted
+        for each message separately.
+        """
+        if self.body_store is None:
+            with contextlib.closing(self.retrieve_messages_streamed(
+                    message_ids, headers_only, keep_raw)) as streamed_messages:
+                for streamed in streamed_messages:
+                    message = self._make_message(
+                        streamed.message_id, streamed.email_message, streamed.size, headers_only)
+                    yield message, streamed.raw_message
+            return
         for message_id in message_ids:
-            message = self.retrieve_message(message_id)
-            messages.append(message)
-        return messages
-
-    def retrieve_message(self, message_id: int) -> Message:
+            message_lines, message_headers_only = self._retrieve_message_lines(
+                message_id, headers_only)
+            message = self._parse_message_lines(message_id, message_lines, message_headers_only)
+            yield message, b'\n'.join(message_lines) + b'\n' if keep_raw else None
+
+    def retrieve_message(self, message_id: int, headers_only: bool = False) -> Message:
+        """Retrieve and parse a message, or only its headers (via TOP) if headers_only is True.
+
+        Complete message is retrieved later on, if it is needed, see Message.retrieve_body().
+        """
+        message_lines, headers_only = self._retrieve_message_lines(message_id, headers_only)
+        return self._parse_message_lines(message_id, message_lines, headers_only)
+
+    def _retrieve_message_lines(
+            self, message_id: int, headers_only: bool = False) -> t.Tuple[t.List[bytes], bool]:
+        """Retrieve lines of a message, from the body store if it is there.
+
+        The body store is consulted using size from LIST and headers from TOP, and
+        messages retrieved from the server are added to it, with CRLF line endings.
+        Even if only headers are requested, complete message is returned if it is found
+        in the body store.
+
+        Return the lines and whether they are only the headers.
+        """
+        if self.body_store is None:
+            if headers_only:
+                return self.retrieve_message_header_lines(message_id), True
+            return self.retrieve_message_lines(message_id), False
+        size = self._message_sizes.get(message_id)
+        if size is not None or headers_only:
+            header_lines = self.retrieve_message_header_lines(message_id)
+            if size is not None:
+                raw_message = self.body_store.find(size, b'\r\n'.join(header_lines) + b'\r\n')
+                if raw_message is not None:
+                    return raw_message.split(b'\r\n')[:-1], False
+            if headers_only:
+                return header_lines, True
         message_lines = self.retrieve_message_lines(message_id)
+        self.body_store.put(b'\r\n'.join(message_lines) + b'\r\n')
+        return message_lines, False
 
+    def _parse_message_lines(
+            self, message_id: int, message_lines: t.List[bytes], headers_only: bool) -> Message:
         bytes_feed_parser = email.parser.BytesFeedParser()
         for message_line in message_lines:
             bytes_feed_parser.feed(message_line + b'\n')
         email_message = bytes_feed_parser.close()
+        return self._make_message(
+            message_id, email_message, sum(len(line) + 1 for line in message_lines), headers_only)
 
+    def _make_message(
+            self, message_id: int, email_message: email.message.Message, size: int,
+            headers_only: bool) -> Message:
         if email_message.defects:
             for defect in email_message.defects:
                 _LOG.error('%s: message #%i has defect: %s', self, message_id, defect)
 
-        return Message(email_message, self, None, message_id)
+        message = Message(email_message, self, None, message_id)
+        message.headers_only = headers_only
+        if not headers_only:
+            self._track_message(message, size)
+        return message
+
+    def snapshot_uid(self, message: Message) -> t.Optional[str]:
+        return self._message_uidls.get(message._origin_id)
+
+    def _retrieve_raw_message(
+            self, message: Message, headers_only: t.Optional[bool] = None) -> bytes:
+        if headers_only is None:
+            headers_only = message.headers_only
+        message_uidl = self._message_uidls.get(message._origin_id)
+        if self.message_store is not None and message_uidl is not None:
+            stored_message = self.message_store.load_message(
+                self.account, 'INBOX', 0, message_uidl)
+            if stored_message is not None and stored_message.body is not None:
+                return stored_message.body
+            if stored_message is not None and headers_only:
+                return stored_message.headers
+        message_lines, _ = self._retrieve_message_lines(message._origin_id, headers_only)
+        return b'\n'.join(message_lines) + b'\n'
 
     def update_messages_in(self, folder: Folder):
+        """Bring messages in the folder up to date with the server, identifying them by UIDL.
+
+        Only messages with unseen UIDLs are retrieved, and cached messages whose UIDL is gone
+        are dropped. Message numbers of cached messages are updated, since they change between
+        sessions. If the folder is empty, known messages are first loaded from the message store,
+        if any, or from the snapshot, if any, so that the set of seen UIDLs survives restarts.
+        """
         assert folder.name == 'INBOX', folder
 
-        message_ids = self.retrieve_message_ids()
-        # new_message_ids = []
-
-        # for message_id in self.message_ids['INBOX']:
-        #     if message_id not in message_ids:
-        #         _LOG.warning('%s: message #%i was deleted', self, message_id)
-        #         self.message_ids['INBOX'].remove(message_id)
-        #         del self.messages['INBOX', message_id]
-
-        # for message_id in message_ids:
-        #     if message_id not in self.message_ids['INBOX']:
-        #         _LOG.info('%s: new message #%i found', self, message_id)
-        #         self.message_ids['INBOX'].append(message_id)
-        #         new_message_ids.append(message_id)
-
-        # new_messages = self.retrieve_messages(new_message_ids)
-
-        messages = self.retrieve_messages(message_ids)
-        for message in messages:
-            folder.add_message(message)
-
-        # for new_message_id, new_message in zip(new_message_ids, new_messages):
-        #     if ('INBOX', new_message_id) in self.messages:
-        #         _LOG.error('%s: message #%i is not really new\ncurrent:\n%s\nnew:\n%s',
-        #                    self, new_message_id, repr(self.messages['INBOX', new_message_id]),
-        #                    repr(new_message))
-        #     self.messages['INBOX', new_message_id] = new_message
+        if self.body_store is not None:
+            self._message_sizes = self.retrieve_message_sizes()
+        message_uidls = self.retrieve_message_uidls()
+        current_message_ids = {uidl: message_id for message_id, uidl in message_uidls.items()}
+        cached_messages = {
+            self._message_uidls[message._origin_id]: message for message in folder.messages}
+        self._message_uidls = message_uidls
+
+        stored_messages = {}  # type: t.Mapping[str, StoredMessage]
+        if not cached_messages:
+            if self.message_store is not None:
+                stored_messages = self.message_store.load_messages(self.account, folder.name, 0)
+            elif self.snapshot is not None:
+                stored_messages = self.snapshot.load_messages(self.account, folder.name, 0)
+
+        removed_uidls = [uidl for uidl in cached_messages if uidl not in current_message_ids]
+        for uidl in removed_uidls:
+            folder.remove_message(cached_messages.pop(uidl))
+        folder.renumber_messages({
+            message._origin_id: current_message_ids[uidl]
+            for uidl, message in cached_messages.items()
+            if message._origin_id != current_message_ids[uidl]})
+
+        new_message_ids = []
+        for message_id, message_uidl in message_uidls.items():
+            if message_uidl in cached_messages:
+                continue
+            if message_uidl in stored_messages:
+                folder.add_message(self._load_stored_message(
+                    folder, message_id, message_uidl, stored_messages[message_uidl]))
+            else:
+                new_message_ids.append(message_id)
+        with contextlib.closing(self._retrieve_messages(
+                new_message_ids, self.headers_only,
+                keep_raw=self.message_store is not None)) as new_messages:
+            for message, raw_message in new_messages:
+                message_uidl = message_uidls[message._origin_id]
+                if self.message_store is not None:
+                    self.message_store.save_message(
+                        self.account, folder.name, 0, message_uidl, message, raw_message)
+                if self.full_text_index is not None:
+                    self.full_text_index.add_message(
+                        self.account, folder.name, message_uidl, message)
+                folder.add_message(message)
+        new_count = len(new_message_ids)
+
+        removed_uidls += [uidl for uidl in stored_messages if uidl not in current_message_ids]
+        if self.message_store is not None:
+            self.message_store.remove_messages(self.account, folder.name, 0, removed_uidls)
+            self.message_store.flush()
+        if self.body_store is not None:
+            self.body_store.flush()
+        if self.full_text_index is not None:
+            self.full_text_index.remove_messages(self.account, folder.name, removed_uidls)
+            self.full_text_index.flush()
+        _LOG.info('%s: %i messages cached, %i loaded, %i retrieved, %i removed',
+                  self, len(cached_messages),
+                  len(message_uidls) - len(cached_messages) - new_count, new_count,
+                  len(removed_uidls))
+
+    def _load_stored_message(
+            self, folder: Folder, message_id: int, message_uidl: str,
+            stored_message: StoredMessage) -> Message:
+        """Create message from the message store or from the snapshot."""
+        raw_message = stored_message.headers if stored_message.body is None \
+            else stored_message.body
+        message = Message(email.message_from_bytes(raw_message), self, None, message_id)
+        message.flags.update(stored_message.flags)
+        message.headers_only = stored_message.body is None
+        if not message.headers_only:
+            self._track_message(message, len(raw_message))
+        if self.full_text_index is not None:
+            self.full_text_index.add_message(
+                self.account, folder.name, message_uidl, message, replace=False)
+        return message
@@ -1,18 +1,40 @@
 """POP connection handling."""
 
+import contextlib
+import email.message
+import email.parser
 import logging
 import poplib
+import socket
 import typing as t
 
 import colorama
+import timing
 
 # from .message import Message
 from .connection import Connection
 
 _LOG = logging.getLogger(__name__)
+_TIME = timing.get_timing_group(__name__)
 
 TIMEOUT = 10
 
+PIPELINE_BATCH_SIZE = 50
+"""Maximum number of commands sent back to back when server supports pipelining (RFC 2449).
+
+Replies are read only after the whole batch is sent, so it is kept small enough for
+the commands to fit in socket buffers.
+"""
+
+
+class StreamedMessage(t.NamedTuple):
+    """Message parsed while its lines were being received."""
+
+    message_id: int
+    email_message: email.message.Message
+    raw_message: t.Optional[bytes]
+    size: int
+
 
 class POPConnection(Connection):
     """For handling POP connections."""
@@ -24,6 +46,7 @@ class POPConnection(Connection):
         super().__init__(domain, port, ssl)
 
         self._link: t.Union[poplib.POP3, poplib.POP3_SSL]
+        self._capabilities = None  # type: t.Optional[t.Dict[str, t.List[str]]]
         if self.ssl:
             self._link = poplib.POP3_SSL(self.domain, self.port, timeout=TIMEOUT)
         else:
@@ -95,6 +118,171 @@ class POPConnection(Connection):
 
         return status.startswith(b'+OK')
 
+    @property
+    def capabilities(self) -> t.Dict[str, t.List[str]]:
+        """Capabilities of the server advertised via CAPA command (RFC 2449), if any."""
+        if self._capabilities is None:
+            try:
+                self._capabilities = self._link.capa()
+            except poplib.error_proto:
+                _LOG.warning('%s: capa() failed', self)
+                self._capabilities = {}
+            else:
+                _LOG.info('%s%s%s: capa() capabilities: %s',
+                          colorama.Style.DIM, self, colorama.Style.RESET_ALL,
+                          sorted(self._capabilities))
+        return self._capabilities
+
+    def _send_commands(self, commands: t.Sequence[str]) -> None:
+        """Send commands to the server back to back, without waiting for replies."""
+        self._link.sock.sendall(b''.join(f'{command}\r\n'.encode() for command in commands))
+
+    def _read_multiline(self, feed: t.Callable[[bytes], None]) -> int:
+        """Feed lines of multi-line reply as they are received, with byte-stuffing removed.
+
+        Lines are passed with LF line endings, so that the result is the same as when lines
+        returned by poplib are joined. Return number of passed octets.
+        """
+        readline = self._link.file.readline
+        octets = 0
+        while True:
+            line = readline(poplib._MAXLINE + 1)
+            if len(line) > poplib._MAXLINE:
+                raise poplib.error_proto('line too long')
+            if not line:
+                raise poplib.error_proto('-ERR EOF')
+            if line in (b'.\r\n', b'.\n'):
+                return octets
+            if line.startswith(b'..'):
+                line = line[1:]
+            if line.endswith(b'\r\n'):
+                line = line[:-2] + b'\n'
+            octets += len(line)
+            feed(line)
+
+    def _run_commands(
+            self, commands: t.Sequence[str], read_reply: t.Callable[[int], t.Any],
+            multiline: bool = False) -> t.Iterator[t.Any]:
+        """Send commands and read their replies, in batches if the server supports pipelining.
+
+        Otherwise, every command is sent only after reply to the previous one was read.
+
+        Reply of each successful command is read by read_reply() after its status line.
+        Error replies (-ERR) are logged and None is yielded instead, so that the rest of the batch
+        is read as usual. If iteration is stopped early, replies already requested are read
+        and discarded (with multi-line bodies if multiline is True), so that they are not
+        mistaken for replies to later commands. If the link cannot be brought back to a known
+        state, it is shut down, and is_alive() is False from then on.
+        """
+        if not commands:
+            return
+        batch_size = PIPELINE_BATCH_SIZE if 'PIPELINING' in self.capabilities else 1
+        for i in range(0, len(commands), batch_size):
+            batch_end = min(i + batch_size, len(commands))
+            self._send_commands(commands[i:batch_end])
+            for index in range(i, batch_end):
+                try:
+                    status, _ = self._link._getline()
+                    if status.startswith(b'+OK'):
+                        reply = read_reply(index)
+                    else:
+                        _LOG.warning('%s: %s failed: %s', self, commands[index], status)
+                        reply = None
+                except BaseException:
+                    self._shut_down_link()
+                    raise
+                try:
+                    yield reply
+                except BaseException:
+                    self._discard_replies(batch_end - index - 1, multiline)
+                    raise
+
+    def _discard_replies(self, count: int, multiline: bool) -> None:
+        """Read and ignore given number of pending replies."""
+        try:
+            for _ in range(count):
+                status, _ = self._link._getline()
+                if multiline and status.startswith(b'+OK'):
+                    self._read_multiline(lambda _: None)
+        except (poplib.error_proto, OSError):
+            _LOG.exception('%s: failed to discard %i pending replies', self, count)
+            self._shut_down_link()
+
+    def _shut_down_link(self) -> None:
+        """Make the link unusable, because replies to sent commands could not be read."""
+        _LOG.warning('%s: shutting down link with unknown state', self)
+        try:
+            self._link.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def retrieve_messages_streamed(
+            self, message_ids: t.Sequence[int], headers_only: bool = False,
+            keep_raw: bool = False) -> t.Iterator[StreamedMessage]:
+        """Retrieve messages (or only headers via TOP) and parse them while they are received.
+
+        Commands are pipelined if the server supports it. Raw message is kept only if keep_raw
+        is True, otherwise it is None. Messages which the server refuses to send, e.g. because
+        another session deleted them, are skipped. The iterator must be exhausted or closed
+        before other commands are issued, because replies to pipelined commands are read
+        only when iterating.
+        """
+        commands = [f'TOP {message_id} 0' if headers_only else f'RETR {message_id}'
+                    for message_id in message_ids]
+
+        def read_reply(index: int) -> StreamedMessage:
+            parser = email.parser.BytesFeedParser()
+            if keep_raw:
+                chunks = []  # type: t.List[bytes]
+
+                def feed(line: bytes) -> None:
+                    parser.feed(line)
+                    chunks.append(line)
+            else:
+                feed = parser.feed
+            octets = self._read_multiline(feed)
+            return StreamedMessage(
+                message_ids[index], parser.close(), b''.join(chunks) if keep_raw else None,
+                octets)
+
+        try:
+            with _TIME.measure('retrieve_messages_streamed') as timer:
+                with contextlib.closing(
+                        self._run_commands(commands, read_reply, multiline=True)) as replies:
+                    for streamed in replies:
+                        if streamed is not None:
+                            yield streamed
+        except (poplib.error_proto, OSError) as err:
+            _LOG.exception('%s: %s failed', self, 'top()' if headers_only else 'retr()')
+            raise RuntimeError('retrieve_messages_streamed() failed') from err
+        _LOG.info('%s%s%s: retrieved %i messages in %fs',
+                  colorama.Style.DIM, self, colorama.Style.RESET_ALL, len(message_ids),
+                  timer.elapsed)
+
+    def delete_messages(self, message_ids: t.Sequence[int]) -> None:
+        """Mark messages as deleted, they are deleted by the server when session ends.
+
+        Commands are pipelined if the server supports it. If some messages cannot be deleted,
+        the others still are, and an error listing the failed ones is raised afterwards.
+        """
+        failed_ids = []  # type: t.List[int]
+        try:
+            for index, status in enumerate(self._run_commands(
+                    [f'DELE {message_id}' for message_id in message_ids], lambda _: b'+OK')):
+                if status is None:
+                    failed_ids.append(message_ids[index])
+        except (poplib.error_proto, OSError) as err:
+            _LOG.exception('%s: dele(%s) failed', self, message_ids)
+            raise RuntimeError('delete_messages() failed') from err
+        if failed_ids:
+            raise RuntimeError(f'delete_messages() failed for messages {failed_ids}')
+        _LOG.info('%s%s%s: dele(%s) completed',
+                  colorama.Style.DIM, self, colorama.Style.RESET_ALL, message_ids)
+
+    def delete_message(self, message_id: int, folder: t.Optional[str] = None) -> None:
+        assert folder in (None, 'INBOX'), folder
+        self.delete_messages([message_id])
+
     # def stat(self) -> None:
     #     message_count, messages_size = self._link.stat()
     #     _LOG.debug('messages_count: %s', message_count)
@@ -105,7 +293,7 @@ class POPConnection(Connection):
         status = b''
         try:
             status = self._link.noop()
-        except poplib.error_proto:
+        except (poplib.error_proto, OSError):
             _LOG.exception('%s: noop() failed', self)
         else:
             _LOG.info('%s%s%s: noop() status: %s',
@@ -133,6 +321,57 @@ class POPConnection(Connection):
 
         return [int(message_id.decode().split()[0]) for message_id in message_ids]
 
+    def retrieve_message_sizes(self) -> t.Dict[int, int]:
+        """Retrieve sizes of messages in octets, as given by LIST command.
+
+        Return mapping from message ID to its size.
+        """
+        status = b''
+        try:
+            status, message_sizes, octets = self._link.list()
+        except poplib.error_proto as err:
+            _LOG.exception('%s: list() failed', self)
+            raise RuntimeError('retrieve_message_sizes() failed') from err
+        else:
+            _LOG.info(
+                '%s%s%s: list() status: %s, len(message_sizes): %i, octets: %s',
+                colorama.Style.DIM, self, colorama.Style.RESET_ALL, status, len(message_sizes),
+                octets)
+
+        if not status.startswith(b'+OK'):
+            raise RuntimeError('retrieve_message_sizes() failed')
+
+        sizes = {}
+        for message_size in message_sizes:
+            message_id, size = message_size.decode().split()
+            sizes[int(message_id)] = int(size)
+        return sizes
+
+    def retrieve_message_uidls(self) -> t.Dict[int, str]:
+        """Retrieve unique IDs (UIDL) of messages, which are stable across sessions.
+
+        Return mapping from message ID to its unique ID.
+        """
+        status = b''
+        try:
+            status, uidls, octets = self._link.uidl()
+        except poplib.error_proto as err:
+            _LOG.exception('%s: uidl() failed', self)
+            raise RuntimeError('retrieve_message_uidls() failed') from err
+        else:
+            _LOG.info(
+                '%s%s%s: uidl() status: %s, len(uidls): %i, octets: %s',
+                colorama.Style.DIM, self, colorama.Style.RESET_ALL, status, len(uidls), octets)
+
+        if not status.startswith(b'+OK'):
+            raise RuntimeError('retrieve_message_uidls() failed')
+
+        message_uidls = {}
+        for uidl in uidls:
+            message_id, unique_id = uidl.decode().split()
+            message_uidls[int(message_id)] = unique_id
+        return message_uidls
+
     def retrieve_message_lines(self, message_id: int) -> t.List[bytes]:
         """Retrieve raw contents of a message with a given ID as list of byte lines."""
         status = b''
@@ -152,6 +391,28 @@ class POPConnection(Connection):
 
         return message_lines
 
+    def retrieve_message_header_lines(self, message_id: int) -> t.List[bytes]:
+        """Retrieve only headers of a message with a given ID as list of byte lines.
+
+        Use TOP command with zero lines of body.
+        """
+        status = b''
+        try:
+            status, header_lines, octets = self._link.top(message_id, 0)
+        except poplib.error_proto as err:
+            _LOG.exception('%s: top(%i, 0) failed', self, message_id)
+            raise RuntimeError('retrieve_message_header_lines() failed') from err
+        else:
+            _LOG.debug(
+                '%s%s%s: top(%i, 0) status: %s, len(header_lines): %s, octets: %s',
+                colorama.Style.DIM, self, colorama.Style.RESET_ALL,
+                message_id, status, len(header_lines), octets)
+
+        if not status.startswith(b'+OK'):
+            raise RuntimeError('retrieve_message_header_lines() failed')
+
+        return header_lines
+
     def disconnect(self) -> None:
 
         status = b''
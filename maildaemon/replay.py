@@ -0,0 +1,116 @@
+"""Offline replay of message filters over a corpus of messages stored in files."""
+
+import email
+import logging
+import mailbox
+import pathlib
+import time
+import typing as t
+
+from .message import Message
+from .message_filter import MessageFilter
+
+_LOG = logging.getLogger(__name__)
+
+MAILDIR_FLAGS = {'D': 'Draft', 'F': 'Flagged', 'R': 'Answered', 'S': 'Seen', 'T': 'Deleted'}
+"""Mapping from Maildir info flags to IMAP system flags."""
+
+MBOX_FLAGS = {'A': 'Answered', 'D': 'Deleted', 'F': 'Flagged', 'R': 'Seen'}
+"""Mapping from characters of mbox Status and X-Status headers to IMAP system flags."""
+
+MESSAGE_FILE_SUFFIXES = ('.eml', '.txt')
+"""Suffixes of files considered when loading messages from a directory that is not a Maildir."""
+
+
+def _flags_of_mailbox_message(mailbox_message: mailbox.Message) -> t.Set[str]:
+    if isinstance(mailbox_message, mailbox.MaildirMessage):
+        return {MAILDIR_FLAGS[flag] for flag in mailbox_message.get_flags()
+                if flag in MAILDIR_FLAGS}
+    if isinstance(mailbox_message, mailbox.mboxMessage):
+        return {MBOX_FLAGS[flag] for flag in mailbox_message.get_flags() if flag in MBOX_FLAGS}
+    return set()
+
+
+def iterate_raw_messages(path: pathlib.Path) -> t.Iterator[t.Tuple[bytes, t.Set[str]]]:
+    """Iterate over raw contents and flags of messages stored at the given path.
+
+    The path can be a Maildir directory, an mbox file, a single message file,
+    or a directory of message files (like test/examples/message*.txt),
+    see MESSAGE_FILE_SUFFIXES.
+    """
+    if path.is_dir():
+        if all(path.joinpath(subdir).is_dir() for subdir in ('cur', 'new', 'tmp')):
+            archive = mailbox.Maildir(path, create=False)
+        else:
+            for message_path in sorted(path.iterdir()):
+                if message_path.is_file() and message_path.suffix in MESSAGE_FILE_SUFFIXES:
+                    yield message_path.read_bytes(), set()
+            return
+    else:
+        with path.open('rb') as message_file:
+            is_mbox = message_file.read(5) == b'From '
+        if not is_mbox:
+            yield path.read_bytes(), set()
+            return
+        archive = mailbox.mbox(path, create=False)
+    try:
+        for key in archive.iterkeys():
+            yield archive.get_bytes(key), _flags_of_mailbox_message(archive[key])
+    finally:
+        archive.close()
+
+
+def load_messages(path: pathlib.Path) -> t.List[Message]:
+    """Load messages stored at the given path, see iterate_raw_messages()."""
+    messages = []
+    for i, (raw_message, flags) in enumerate(iterate_raw_messages(path)):
+        email_message = email.message_from_bytes(raw_message)
+        if email_message.defects:
+            _LOG.error('%s: message #%i has defects: %s', path, i, email_message.defects)
+        message = Message(email_message, None, str(path), i)
+        message.flags.update(flags)
+        messages.append(message)
+    return messages
+
+
+def replay_filters(
+        filters: t.Sequence[MessageFilter], messages: t.Sequence[Message]) -> t.Dict[str, t.Any]:
+    """Evaluate filters on messages like DaemonGroup.apply_filters() does, but without actions.
+
+    Every filter is evaluated against every message, regardless of the connections
+    the filter is limited to. Return a report with throughput, statistics of each filter
+    and a list of actions that would be executed.
+    """
+    fired = []
+    start = time.perf_counter()
+    for message in messages:
+        if message.is_deleted:
+            continue
+        for message_filter in filters:
+            if not message_filter.applies_to(message):
+                continue
+            fired.append((message, message_filter, message_filter.str_actions()))
+            break
+    elapsed = time.perf_counter() - start
+    return {
+        'messages': len(messages),
+        'elapsed': elapsed,
+        'messages_per_second': len(messages) / elapsed if elapsed > 0 else float('inf'),
+        'filters': [message_filter.summarize_statistics() for message_filter in filters],
+        'fired': fired}
+
+
+def replay_filters_from_config(config: dict, path: pathlib.Path) -> t.Dict[str, t.Any]:
+    """Construct filters from configuration and replay them over messages from the given path.
+
+    No connections are established. Actions are never executed during replay,
+    so connection names stand in for connection objects in the filters.
+    """
+    named_connections = {name: name for name in config.get('connections', {})}
+    filters = [
+        MessageFilter.from_dict(filter_data, named_connections, filter_name)
+        for filter_name, filter_data in config.get('filters', {}).items()]
+    messages = load_messages(path)
+    _LOG.warning('replaying %i filters over %i messages from %s',
+                 len(filters), len(messages), path)
+    return replay_filters(filters, messages)
@@ -1,7 +1,12 @@
 """For handling SMTP connections."""
 
+import collections
+import email.generator
 import email.message
+import email.utils
+import io
 import logging
+import pathlib
 import smtplib
 import typing as t
 
@@ -11,6 +16,49 @@ _LOG = logging.getLogger(__name__)
 
 TIMEOUT = 10
 
+CHUNK_SIZE = 64 * 1024
+"""Size in bytes of message chunks sent using BDAT command."""
+
+
+class RawMessage(t.NamedTuple):
+    """Message in its wire format with its envelope, e.g. a forwarded message.
+
+    The message is either a sequence of chunks, which are sent one after another,
+    or a file.
+    """
+
+    from_address: str
+    to_addresses: t.Tuple[str, ...]
+    chunks: t.Sequence[bytes] = ()
+    path: t.Optional[pathlib.Path] = None
+
+    def open(self) -> t.BinaryIO:
+        if self.path is not None:
+            return self.path.open('rb')
+        return t.cast(t.BinaryIO, ChunksReader(self.chunks))
+
+
+class ChunksReader(io.RawIOBase):
+    """Read a sequence of chunks as if it was one file, without joining them."""
+
+    def __init__(self, chunks: t.Iterable[bytes]):
+        super().__init__()
+        self._chunks = collections.deque(memoryview(chunk) for chunk in chunks)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self._chunks and not self._chunks[0]:
+            self._chunks.popleft()
+        if not self._chunks:
+            return 0
+        chunk = self._chunks[0]
+        size = min(len(buffer), len(chunk))
+        buffer[:size] = chunk[:size]
+        self._chunks[0] = chunk[size:]
+        return size
+
 
 class SMTPConnection(Connection):
     """For handling SMTP connections."""
@@ -72,19 +120,195 @@ class SMTPConnection(Connection):
 
         return status in range(200, 300)
 
-    def send_message(self, message: email.message.Message) -> None:
-        """Send an e-mail using SMTP."""
+    def send_message(
+            self, message: t.Union[email.message.Message, RawMessage],
+            to_addresses: t.Optional[t.Sequence[str]] = None) -> None:
+        """Send an e-mail using SMTP.
+
+        :param to_addresses: optional, recipients of the message; by default they are taken
+          from To, Cc and Bcc headers, or from the envelope of a raw message
+
+        If some recipients were refused, the raised RuntimeError is caused by
+        smtplib.SMTPRecipientsRefused, which maps them to SMTP codes and responses.
+        Other recipients did receive the message.
+        """
+        if isinstance(message, RawMessage):
+            with message.open() as raw_message:
+                self.send_raw_message(
+                    raw_message, message.from_address,
+                    message.to_addresses if to_addresses is None else to_addresses)
+            return
         status = None
         try:
-            status = self._link.send_message(message)
-        except smtplib.SMTPException as err:
+            envelope = self._envelope(message, to_addresses)
+            if envelope is None:
+                status = self._link.send_message(message, to_addrs=to_addresses)
+            else:
+                status = self._send(*envelope, _flatten(message))
+        except (smtplib.SMTPException, OSError) as err:
             _LOG.exception('%s: send_message(%s) failed', self, '***')
             raise RuntimeError('send_message() failed') from err
         else:
             _LOG.info('%s: send_message(%s) status: %s', self, '***', status)
 
-        if not isinstance(status, dict) or len(status) > 0:
+        if not isinstance(status, dict):
             raise RuntimeError('send_message() failed')
+        if status:
+            raise RuntimeError('send_message() failed') from smtplib.SMTPRecipientsRefused(status)
+
+    def send_raw_message(
+            self, raw_message: t.Union[bytes, t.BinaryIO], from_address: str,
+            to_addresses: t.Sequence[str]) -> None:
+        """Send a message that is already in its wire format, i.e. with CRLF line endings.
+
+        The message can be given as bytes or as a binary file, which is read in chunks
+        if the server supports CHUNKING. Errors are raised like in send_message().
+        """
+        status = None
+        try:
+            self._link.ehlo_or_helo_if_needed()
+            if self.supports('pipelining') or self.supports('chunking'):
+                status = self._send(from_address, to_addresses, raw_message)
+            else:
+                if not isinstance(raw_message, bytes):
+                    raw_message = raw_message.read()
+                status = self._link.sendmail(from_address, to_addresses, raw_message)
+        except (smtplib.SMTPException, OSError) as err:
+            _LOG.exception('%s: send_raw_message(%s) failed', self, '***')
+            raise RuntimeError('send_raw_message() failed') from err
+        else:
+            _LOG.info('%s: send_raw_message(%s) status: %s', self, '***', status)
+
+        if status:
+            raise RuntimeError('send_raw_message() failed') \
+                from smtplib.SMTPRecipientsRefused(status)
+
+    def supports(self, extension: str) -> bool:
+        """Check if the server advertised given ESMTP extension in its reply to EHLO."""
+        return extension.lower() in self._link.esmtp_features
+
+    def _envelope(
+            self, message: email.message.Message, to_addresses: t.Optional[t.Sequence[str]]
+            ) -> t.Optional[t.Tuple[str, t.List[str]]]:
+        """Determine sender and recipients of the message, like smtplib.SMTP.send_message().
+
+        Return None if neither PIPELINING nor CHUNKING can be used and the message should be
+        sent by smtplib instead, e.g. for resent messages or internationalized addresses.
+        """
+        self._link.ehlo_or_helo_if_needed()
+        if not (self.supports('pipelining') or self.supports('chunking')) \
+                or 'Resent-Date' in message:
+            return None
+        sender = message['Sender'] if 'Sender' in message else message['From']
+        if sender is None:
+            return None
+        from_address = email.utils.getaddresses([sender])[0][1]
+        if to_addresses is None:
+            fields = [value for header in ('To', 'Cc', 'Bcc')
+                      for value in message.get_all(header, [])]
+            to_addresses = [address for _, address in email.utils.getaddresses(fields)]
+        addresses = [from_address, *to_addresses]
+        if not all(addresses) or not all(address.isascii() for address in addresses):
+            return None
+        return from_address, list(to_addresses)
+
+    def _send(
+            self, from_address: str, to_addresses: t.Sequence[str],
+            raw_message: t.Union[bytes, t.BinaryIO]) -> t.Dict[str, t.Tuple[int, bytes]]:
+        """Send the message using PIPELINING and CHUNKING, whichever the server supports.
+
+        With PIPELINING, MAIL FROM and all RCPT TO commands are sent at once, and their replies
+        are read afterwards. With CHUNKING, the message is sent using BDAT commands,
+        in chunks of CHUNK_SIZE bytes, without any dot-stuffing.
+
+        Return recipients that were refused, like smtplib.SMTP.sendmail().
+        """
+        link = self._link
+        options = []
+        if isinstance(raw_message, bytes) and self.supports('size'):
+            options.append(f'SIZE={len(raw_message)}')
+        commands = [f'mail FROM:{smtplib.quoteaddr(from_address)} {" ".join(options)}'.rstrip()]
+        commands += [f'rcpt TO:{smtplib.quoteaddr(address)}' for address in to_addresses]
+        if self.supports('pipelining'):
+            link.send(''.join(f'{command}\r\n' for command in commands))
+            replies = [link.getreply() for _ in commands]
+        else:
+            replies = []
+            for command in commands:
+                link.putcmd(command)
+                replies.append(link.getreply())
+                if len(replies) == 1 and replies[0][0] != 250:
+                    break
+        (code, response), *recipient_replies = replies
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPSenderRefused(code, response, from_address)
+        refused = {
+            address: reply for address, reply in zip(to_addresses, recipient_replies)
+            if reply[0] not in (250, 251)}
+        if len(refused) == len(to_addresses):
+            self._abort(code)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if self.supports('chunking'):
+            code, response = self._send_chunks(raw_message)
+        else:
+            if not isinstance(raw_message, bytes):
+                raw_message = raw_message.read()
+            code, response = link.data(raw_message)
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def _send_chunks(self, raw_message: t.Union[bytes, t.BinaryIO]) -> t.Tuple[int, bytes]:
+        """Send the message using BDAT commands and return the first failed or the last reply.
+
+        With PIPELINING, replies are read only after the last chunk.
+        """
+        link = self._link
+        pipelining = self.supports('pipelining')
+        replies = []
+        size = CHUNK_SIZE
+        for chunk in _chunks(raw_message):
+            size = len(chunk)
+            last = size < CHUNK_SIZE
+            link.send(f'BDAT {size}{" LAST" if last else ""}\r\n'.encode())
+            link.send(chunk)
+            if pipelining:
+                replies.append(None)
+                continue
+            code, response = link.getreply()
+            if code != 250 or last:
+                return code, response
+        if size == CHUNK_SIZE:
+            link.send(b'BDAT 0 LAST\r\n')
+            replies.append(None)
+        replies = [link.getreply() for _ in replies]
+        return next((reply for reply in replies if reply[0] != 250), replies[-1])
+
+    def _abort(self, code: int) -> None:
+        """Reset the session after a failed transaction, unless the server closes it anyway."""
+        if code == 421:
+            self._link.close()
+            return
+        try:
+            self._link.rset()
+        except smtplib.SMTPException:
+            _LOG.warning('%s: rset() failed', self)
+
+    def reset(self) -> None:
+        """Abort the current mail transaction using RSET, e.g. after a failed delivery."""
+        status = 0
+        try:
+            status, response = self._link.rset()
+        except (smtplib.SMTPException, OSError) as err:
+            _LOG.exception('%s: rset() failed', self)
+            raise RuntimeError('reset() failed') from err
+        else:
+            _LOG.info('%s: rset() status: %s, response: %s', self, status, response.decode())
+
+        if status not in range(200, 300):
+            raise RuntimeError('reset() failed')
 
     def disconnect(self) -> None:
         status = 0
@@ -98,3 +322,41 @@ class SMTPConnection(Connection):
 
         if status not in range(200, 300):
             raise RuntimeError('disconnect() failed')
+
+
+def _chunks(raw_message: t.Union[bytes, t.BinaryIO]) -> t.Iterator[memoryview]:
+    """Split the message into chunks of at most CHUNK_SIZE bytes without copying it.
+
+    Chunks of a buffer are its slices, and chunks of a file are read into one reused buffer,
+    so each chunk is valid only until the next one is taken.
+    """
+    if isinstance(raw_message, bytes):
+        view = memoryview(raw_message)
+        for offset in range(0, len(view), CHUNK_SIZE):
+            yield view[offset:offset + CHUNK_SIZE]
+        return
+    buffer = memoryview(bytearray(CHUNK_SIZE))
+    while True:
+        size = 0
+        while size < CHUNK_SIZE:
+            read = raw_message.readinto(buffer[size:])
+            if not read:
+                break
+            size += read
+        if not size:
+            return
+        yield buffer[:size]
+
+
+def _flatten(message: email.message.Message) -> bytes:
+    """Convert the message to its wire format without Bcc headers, like smtplib does."""
+    message_copy = message
+    if 'Bcc' in message or 'Resent-Bcc' in message:
+        message_copy = email.message_from_bytes(message.as_bytes(), policy=message.policy)
+        del message_copy['Bcc']
+        del message_copy['Resent-Bcc']
+    with io.BytesIO() as raw_message:
+        generator = email.generator.BytesGenerator(
+            raw_message, policy=message.policy.clone(linesep='\r\n'))
+        generator.flatten(message_copy, linesep='\r\n')
+        return raw_message.getvalue()
@@ -1,38 +1,167 @@
 """Daemon working with SMTP connections."""
 
 import email.message
+import logging
 import typing as t
 
 from .message import Message
 from .daemon import Daemon
-from .smtp_connection import SMTPConnection
+from .forwarding import forward_chunks
+from .smtp_connection import RawMessage, SMTPConnection
+from .smtp_spool import SpoolEntry
+
+if t.TYPE_CHECKING:
+    from .smtp_pool import SMTPPool
+    from .smtp_spool import SMTPSpool
+
+_LOG = logging.getLogger(__name__)
+
+SPOOL_BATCH_SIZE = 100
+"""Maximum number of messages loaded from the spool and sent together."""
 
 
 class SMTPDaemon(Daemon, SMTPConnection):
-    """Daemon working with SMTP connections."""
+    """Daemon working with SMTP connections.
+
+    Messages are queued in the outbox and sent on update. If there is a spool, the outbox
+    is kept on disk and messages that failed are retried later, see SMTPSpool. If there is
+    a pool, messages are sent in parallel over many sessions, see SMTPPool.
+    """
 
     def __init__(self, domain: str, port: t.Optional[int] = None, ssl: bool = True):
         Daemon.__init__(self)
         SMTPConnection.__init__(self, domain, port, ssl)
 
-        self._outbox: t.List[t.Union[Message, email.message.Message]] = []
+        self._outbox: t.List[t.Union[Message, email.message.Message, RawMessage]] = []
+        self.spool: t.Optional['SMTPSpool'] = None
+        self.pool: t.Optional['SMTPPool'] = None
+
+    def open_session(self) -> SMTPConnection:
+        """Create another (not yet connected) session with the same server, e.g. for a pool."""
+        session = SMTPConnection(self.domain, self._port, self.ssl)
+        session.login = self.login
+        session.password = self.password
+        return session
+
+    @property
+    def from_address(self) -> str:
+        """Address used as the sender of forwarded messages."""
+        if '@' in self.login:
+            return self.login
+        return f'{self.login}@{self.domain}'
 
     @property
     def outbox(self):
+        if self.spool is not None:
+            return self.spool.entries
         return self._outbox
 
     def add_to_outbox(self, message: t.Union[Message, email.message.Message]) -> None:
+        if self.spool is not None:
+            if isinstance(message, Message):
+                message = message.email_message
+            self.spool.add(message)
+            return
         self._outbox.append(message)
 
-    def send_message(self, message: t.Union[Message, email.message.Message]) -> None:
-        if isinstance(message, email.message.Message):
-            super().send_message(message)
+    def forward_message(
+            self, raw_message: bytes, to_address: str, as_attachment: bool = False) -> None:
+        """Queue the raw message for forwarding, resent as it is or attached to a new message.
+
+        The forwarded message is queued as chunks, one of which is the original message,
+        and with a spool they are written directly to disk.
+        """
+        chunks = forward_chunks(raw_message, self.from_address, to_address, as_attachment)
+        if self.spool is not None:
+            self.spool.add_raw(chunks, [to_address], self.from_address)
+            return
+        self._outbox.append(RawMessage(self.from_address, (to_address,), chunks))
+
+    def send_message(
+            self, message: t.Union[Message, email.message.Message, RawMessage],
+            to_addresses: t.Optional[t.Sequence[str]] = None) -> None:
+        if isinstance(message, (email.message.Message, RawMessage)):
+            super().send_message(message, to_addresses)
             return
         message.send_via(self)
 
+    def _send_messages(
+            self, messages: t.Sequence[t.Tuple[
+                t.Union[email.message.Message, RawMessage], t.Optional[t.Sequence[str]]]]
+            ) -> t.Iterator[t.Tuple[int, t.Optional[RuntimeError]]]:
+        """Send messages via the pool if there is one, or one by one otherwise.
+
+        Yield index of each message and an error if sending it failed.
+        """
+        if self.pool is not None:
+            yield from self.pool.send_messages(messages)
+            return
+        for index, (message, to_addresses) in enumerate(messages):
+            try:
+                self.send_message(message, to_addresses)
+            except RuntimeError as err:
+                yield index, err
+                continue
+            yield index, None
+
     def update(self):
-        if not self._outbox:
+        """Send queued messages, removing each from the outbox as soon as it is sent."""
+        if self.spool is not None:
+            self._update_spool()
+            return
+        if self.pool is None:
+            while self._outbox:
+                self.send_message(self._outbox[0])
+                del self._outbox[0]
+            return
+        messages = [
+            message.email_message if isinstance(message, Message) else message
+            for message in self._outbox]
+        failed = {}  # type: t.Dict[int, RuntimeError]
+        for index, error in self._send_messages([(message, None) for message in messages]):
+            if error is not None:
+                failed[index] = error
+        self._outbox = [self._outbox[index] for index in sorted(failed)]
+        self._log_pool_statistics()
+        if failed:
+            raise RuntimeError(f'{len(failed)} messages failed') from failed[min(failed)]
+
+    def _update_spool(self) -> None:
+        entries = self.spool.due()
+        if not entries:
             return
-        for message in self._outbox:
-            self.send_message(message)
-        self._outbox.clear()
+        for i in range(0, len(entries), SPOOL_BATCH_SIZE):
+            batch = entries[i:i + SPOOL_BATCH_SIZE]
+            messages = [(self._load_spooled_message(entry), entry.recipients) for entry in batch]
+            for index, error in self._send_messages(messages):
+                if error is None:
+                    self.spool.complete(batch[index])
+                else:
+                    self.spool.record_failure(batch[index], error)
+        _LOG.info('%s: %s has %i messages queued; delivered %i, deferred %i, failed %i so far',
+                  self, self.spool, len(self.spool), self.spool.delivered, self.spool.deferred,
+                  self.spool.failed)
+        self._log_pool_statistics()
+
+    def _load_spooled_message(
+            self, entry: SpoolEntry) -> t.Union[email.message.Message, RawMessage]:
+        if entry.sender is None:
+            return self.spool.load_message(entry)
+        # message in its wire format is sent directly from the spool file
+        return RawMessage(entry.sender, entry.recipients, path=self.spool.message_path(entry))
+
+    def _log_pool_statistics(self) -> None:
+        if self.pool is None:
+            return
+        statistics = self.pool.summarize_statistics()
+        _LOG.info(
+            '%s: sent %i, failed %i, %.1f messages/s, mean latency %fs, sessions opened %i,'
+            ' reset %i, dropped %i', self.pool, statistics['sent'], statistics['failed'],
+            statistics['messages_per_second'], statistics['mean_latency'],
+            statistics['sessions_opened'], statistics['sessions_reset'],
+            statistics['sessions_dropped'])
+
+    def disconnect(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+        super().disconnect()
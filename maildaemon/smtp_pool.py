@@ -0,0 +1,206 @@
+"""Pool of SMTP sessions delivering messages in parallel."""
+
+import collections
+import concurrent.futures
+import email.message
+import logging
+import queue
+import threading
+import time
+import typing as t
+
+from .latency_statistics import LatencyStatistics
+from .smtp_connection import RawMessage, SMTPConnection
+
+_LOG = logging.getLogger(__name__)
+
+SESSION_WAIT = 1.0
+"""Time in seconds after which a thread waiting for an idle session checks if it can open one."""
+
+STATISTICS_COUNTERS = ('sent', 'failed', 'sessions_opened', 'sessions_reset', 'sessions_dropped')
+
+
+class TokenBucket:
+    """Rate limit, allowing bursts of at most "burst" operations and "rate" operations per second
+    on average.
+
+    It is safe to use from many threads.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        assert rate > 0, rate
+        assert burst >= 1, burst
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Take a token if there is one and return 0, otherwise return time until there is one."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """Wait until an operation is allowed."""
+        while True:
+            delay = self._take()
+            if delay == 0:
+                return
+            time.sleep(delay)
+
+
+class SMTPPool:
+    """Sessions with one SMTP relay, each reused for many messages.
+
+    Sessions are opened when needed, up to the pool size, and messages are delivered
+    by as many threads. After a failed delivery, the session is reset via RSET. If that fails
+    too, e.g. after a timeout, or if the delivery failed with an unexpected error, the session
+    is dropped and a new one is opened when needed.
+    Deliveries can be rate-limited using a token bucket shared by all sessions.
+    """
+
+    def __init__(
+            self, session_factory: t.Callable[[], SMTPConnection], size: int = 1,
+            rate_limit: t.Optional[TokenBucket] = None, name: str = 'smtp'):
+        assert size >= 1, size
+        self._session_factory = session_factory
+        self.size = size
+        self.rate_limit = rate_limit
+        self.name = name
+        self._idle = queue.SimpleQueue()  # type: queue.SimpleQueue
+        self._sessions = []  # type: t.List[SMTPConnection]
+        self._sessions_count = 0  # includes sessions being opened
+        self._lock = threading.Lock()
+        self.statistics = collections.Counter({counter: 0 for counter in STATISTICS_COUNTERS})
+        self.latencies = LatencyStatistics()
+
+    def _acquire_session(self) -> SMTPConnection:
+        """Take an idle session, or open a new one if there are fewer than size sessions."""
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                open_session = self._sessions_count < self.size
+                if open_session:
+                    self._sessions_count += 1
+            if open_session:
+                break
+            try:
+                return self._idle.get(timeout=SESSION_WAIT)
+            except queue.Empty:
+                continue  # sessions might have been dropped in the meantime
+        try:
+            session = self._session_factory()
+            session.connect()
+        except (RuntimeError, OSError) as err:
+            with self._lock:
+                self._sessions_count -= 1
+            _LOG.exception('%s: failed to open session', self)
+            raise RuntimeError('failed to open session') from err
+        with self._lock:
+            self._sessions.append(session)
+            self.statistics['sessions_opened'] += 1
+        return session
+
+    def _drop_session(self, session: SMTPConnection) -> None:
+        with self._lock:
+            self._sessions.remove(session)
+            self._sessions_count -= 1
+            self.statistics['sessions_dropped'] += 1
+
+    def _count(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self.statistics[counter] += value
+
+    def send_message(
+            self, message: t.Union[email.message.Message, RawMessage],
+            to_addresses: t.Optional[t.Sequence[str]] = None) -> None:
+        """Send message using an idle session, waiting for one if needed."""
+        if self.rate_limit is not None:
+            self.rate_limit.acquire()
+        session = self._acquire_session()
+        start = time.perf_counter()
+        try:
+            session.send_message(message, to_addresses)
+        except RuntimeError:
+            self._count('failed')
+            try:
+                session.reset()
+            except RuntimeError:
+                _LOG.warning('%s: dropping session %s', self, session)
+                self._drop_session(session)
+            else:
+                self._count('sessions_reset')
+                self._idle.put(session)
+            raise
+        except BaseException:
+            # state of the session is unknown, e.g. a command might have been sent partially
+            self._count('failed')
+            _LOG.warning('%s: dropping session %s after unexpected error', self, session)
+            self._drop_session(session)
+            raise
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.statistics['sent'] += 1
+            self.latencies.record('send_message', elapsed)
+        self._idle.put(session)
+
+    def send_messages(
+            self, messages: t.Sequence[t.Tuple[
+                t.Union[email.message.Message, RawMessage], t.Optional[t.Sequence[str]]]]
+            ) -> t.Iterator[t.Tuple[int, t.Optional[RuntimeError]]]:
+        """Send messages in parallel, each to given recipients (or to ones from its headers).
+
+        Yield index of each message and an error if sending it failed, as soon as it completes.
+        """
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(self.size) as executor:
+            futures = {executor.submit(self.send_message, message, to_addresses): index
+                       for index, (message, to_addresses) in enumerate(messages)}
+            for future in concurrent.futures.as_completed(futures):
+                error = future.exception()
+                if error is not None and not isinstance(error, RuntimeError):
+                    raise error
+                yield futures[future], error
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.record('send_messages', elapsed)
+        _LOG.info('%s: %i messages handled by %i sessions in %fs',
+                  self, len(messages), len(self._sessions), elapsed)
+
+    def summarize_statistics(self) -> t.Dict[str, t.Any]:
+        """Return counters of this pool, its throughput in sent messages per second
+        and mean latency of sending a message.
+        """
+        with self._lock:
+            latencies = self.latencies.summarize()
+            statistics = dict(self.statistics)
+        elapsed = latencies.get('send_messages', {'total': 0.0})['total']
+        return {
+            'name': self.name, **statistics,
+            'messages_per_second': statistics['sent'] / elapsed if elapsed else 0.0,
+            'mean_latency': latencies.get('send_message', {'mean': 0.0})['mean']}
+
+    def close(self) -> None:
+        """Disconnect all sessions."""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+            self._sessions_count -= len(sessions)
+        for session in sessions:
+            try:
+                session.disconnect()
+            except RuntimeError:
+                _LOG.warning('%s: failed to disconnect session %s', self, session)
+        self._idle = queue.SimpleQueue()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.name}, size={self.size})'
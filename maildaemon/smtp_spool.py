@@ -0,0 +1,274 @@
+"""Persistent queue of outgoing messages, with retries scheduled per recipient domain."""
+
+import email
+import email.message
+import email.utils
+import json
+import logging
+import os
+import pathlib
+import smtplib
+import time
+import typing as t
+import uuid
+
+_LOG = logging.getLogger(__name__)
+
+BASE_DELAY = 60.0
+"""Delay in seconds before the first retry of delivery to a domain after a transient failure.
+
+Every following failure doubles the delay, up to MAX_DELAY.
+"""
+
+MAX_DELAY = 4 * 60 * 60.0
+
+MAX_AGE = 5 * 24 * 60 * 60.0
+"""Time in seconds after which a message that still has transient failures is given up on."""
+
+
+class SpoolEntry(t.NamedTuple):
+    """State of a message in the spool."""
+
+    entry_id: str
+    recipients: t.Tuple[str, ...]
+    """Recipients that did not receive the message yet."""
+    queued: float
+    attempts: int = 0
+    last_error: t.Optional[str] = None
+    sender: t.Optional[str] = None
+    """Envelope sender of a message queued in its wire format, None if it is taken from headers."""
+
+
+def recipients_of(message: email.message.Message) -> t.List[str]:
+    """Addresses from To, Cc and Bcc headers, like smtplib.SMTP.send_message() uses."""
+    fields = [value for header in ('To', 'Cc', 'Bcc') for value in message.get_all(header, [])]
+    return [address for _, address in email.utils.getaddresses(fields) if address]
+
+
+def domain_of(address: str) -> str:
+    return address.rpartition('@')[2].lower()
+
+
+def classify_failure(
+        error: BaseException, recipients: t.Sequence[str]) -> t.Dict[str, t.Optional[int]]:
+    """Map recipients for which delivery failed to SMTP codes, or None if there is no code.
+
+    Error raised by SMTPConnection.send_message() is classified by its cause. Recipients
+    that are not in the result did receive the message.
+    """
+    cause = error if error.__cause__ is None else error.__cause__
+    if isinstance(cause, smtplib.SMTPRecipientsRefused):
+        return {recipient: code for recipient, (code, _) in cause.recipients.items()}
+    if isinstance(cause, smtplib.SMTPResponseException):
+        return {recipient: cause.smtp_code for recipient in recipients}
+    return {recipient: None for recipient in recipients}
+
+
+def is_permanent(code: t.Optional[int]) -> bool:
+    """Check if SMTP code means a permanent (5xx) failure.
+
+    Transient (4xx) failures and failures without a code, e.g. lost connections, are retried.
+    """
+    return code is not None and 500 <= code < 600
+
+
+def _serialize_state(entry: SpoolEntry) -> bytes:
+    return json.dumps({
+        'recipients': entry.recipients, 'queued': entry.queued, 'attempts': entry.attempts,
+        'last_error': entry.last_error, 'sender': entry.sender}).encode()
+
+
+def _write_atomically(path: pathlib.Path, data: t.Union[bytes, t.Iterable[bytes]]) -> None:
+    temporary_path = path.with_name(f'{path.name}.tmp')
+    with temporary_path.open('wb') as spool_file:
+        if isinstance(data, bytes):
+            spool_file.write(data)
+        else:
+            spool_file.writelines(data)
+        spool_file.flush()
+        os.fsync(spool_file.fileno())
+    os.replace(temporary_path, path)
+
+
+class SMTPSpool:
+    """Directory of outgoing messages, each kept until it is delivered to all its recipients.
+
+    Every message is stored as "<id>.eml" next to "<id>.json" with its state, in "queue"
+    subdirectory. State is written only after the message, so a message without state
+    is an incomplete entry left by a crash, and it is dropped when the spool is opened.
+    Messages that permanently failed are moved to "failed" subdirectory.
+
+    After a transient failure, delivery to every domain of the failed recipients is retried
+    with exponential backoff. Backoff of domains is kept in "domains.json".
+    """
+
+    def __init__(
+            self, path: pathlib.Path, base_delay: float = BASE_DELAY,
+            max_delay: float = MAX_DELAY, max_age: float = MAX_AGE):
+        self._path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+        self._queue_path = path.joinpath('queue')
+        self._failed_path = path.joinpath('failed')
+        self._domains_path = path.joinpath('domains.json')
+        self._queue_path.mkdir(parents=True, exist_ok=True)
+        self._failed_path.mkdir(exist_ok=True)
+        self._entries = {}  # type: t.Dict[str, SpoolEntry]
+        # number of consecutive failures and time of next attempt, for each domain
+        self._domains = {}  # type: t.Dict[str, t.Tuple[int, float]]
+        self._load()
+        self.delivered = 0
+        self.failed = 0
+        self.deferred = 0
+
+    def _load(self) -> None:
+        for message_path in self._queue_path.glob('*.eml'):
+            state_path = message_path.with_suffix('.json')
+            if not state_path.is_file():
+                _LOG.warning('%s: dropping incomplete entry %s', self, message_path.stem)
+                message_path.unlink()
+                continue
+            state = json.loads(state_path.read_text())
+            self._entries[message_path.stem] = SpoolEntry(
+                message_path.stem, tuple(state['recipients']), state['queued'],
+                state['attempts'], state['last_error'], state.get('sender'))
+        for state_path in self._queue_path.glob('*.json'):
+            if state_path.stem not in self._entries:
+                state_path.unlink()
+        for temporary_path in self._queue_path.glob('*.tmp'):
+            temporary_path.unlink()
+        if self._domains_path.is_file():
+            self._domains = {
+                domain: (failures, next_attempt) for domain, (failures, next_attempt)
+                in json.loads(self._domains_path.read_text()).items()}
+        if self._entries:
+            _LOG.info('%s: found %i queued messages', self, len(self._entries))
+
+    def _save_state(self, entry: SpoolEntry) -> None:
+        _write_atomically(
+            self._queue_path.joinpath(f'{entry.entry_id}.json'), _serialize_state(entry))
+        self._entries[entry.entry_id] = entry
+
+    def _save_domains(self) -> None:
+        _write_atomically(self._domains_path, json.dumps(self._domains).encode())
+
+    def add(self, message: email.message.Message,
+            recipients: t.Optional[t.Sequence[str]] = None) -> SpoolEntry:
+        """Queue the message for delivery, by default to recipients from its headers."""
+        if recipients is None:
+            recipients = recipients_of(message)
+        return self.add_raw(message.as_bytes(), recipients)
+
+    def add_raw(
+            self, raw_message: t.Union[bytes, t.Iterable[bytes]], recipients: t.Sequence[str],
+            sender: t.Optional[str] = None) -> SpoolEntry:
+        """Queue raw message for delivery to given recipients.
+
+        The message can be given as chunks, which are written one after another. If there is
+        a sender, the message is in its wire format and it will be sent as it is.
+        """
+        assert recipients, recipients
+        entry = SpoolEntry(uuid.uuid4().hex, tuple(recipients), time.time(), sender=sender)
+        _write_atomically(self._queue_path.joinpath(f'{entry.entry_id}.eml'), raw_message)
+        self._save_state(entry)
+        _LOG.debug('%s: queued %s for %s', self, entry.entry_id, entry.recipients)
+        return entry
+
+    def due(self, now: t.Optional[float] = None) -> t.List[SpoolEntry]:
+        """Entries which can be delivered now, i.e. no domain of their recipients is backing off.
+
+        Entries are ordered from the oldest.
+        """
+        if now is None:
+            now = time.time()
+        entries = [
+            entry for entry in self._entries.values()
+            if all(self._domains.get(domain_of(recipient), (0, now))[1] <= now
+                   for recipient in entry.recipients)]
+        return sorted(entries, key=lambda entry: entry.queued)
+
+    def message_path(self, entry: SpoolEntry) -> pathlib.Path:
+        return self._queue_path.joinpath(f'{entry.entry_id}.eml')
+
+    def load_message(self, entry: SpoolEntry) -> email.message.Message:
+        return email.message_from_bytes(self.message_path(entry).read_bytes())
+
+    def complete(self, entry: SpoolEntry) -> None:
+        """Remove the entry, after the message was delivered to all its remaining recipients."""
+        self._remove(entry)
+        self.delivered += 1
+        self._reset_domains(entry.recipients)
+
+    def record_failure(
+            self, entry: SpoolEntry, error: BaseException,
+            now: t.Optional[float] = None) -> None:
+        """Update the entry after delivery failed, for some or for all of its recipients.
+
+        Recipients that permanently failed are dropped, and the message is moved to "failed"
+        subdirectory if there are no other recipients. Otherwise, delivery to the remaining
+        recipients is retried later, unless the message is older than max_age.
+        """
+        if now is None:
+            now = time.time()
+        codes = classify_failure(error, entry.recipients)
+        permanent = [recipient for recipient, code in codes.items() if is_permanent(code)]
+        transient = [recipient for recipient in entry.recipients
+                     if recipient in codes and recipient not in permanent]
+        delivered = [recipient for recipient in entry.recipients if recipient not in codes]
+        self._reset_domains(delivered)
+        message = f'{error}: {error.__cause__}' if error.__cause__ is not None else str(error)
+        if permanent:
+            _LOG.error('%s: delivery of %s to %s failed permanently: %s',
+                       self, entry.entry_id, permanent, message)
+        if transient and now - entry.queued > self.max_age:
+            _LOG.error('%s: giving up delivery of %s to %s after %i attempts: %s',
+                       self, entry.entry_id, transient, entry.attempts + 1, message)
+            permanent += transient
+            transient = []
+        if not transient:
+            self._fail(entry._replace(
+                recipients=tuple(permanent), attempts=entry.attempts + 1, last_error=message))
+            return
+        for domain in {domain_of(recipient) for recipient in transient}:
+            failures, _ = self._domains.get(domain, (0, now))
+            delay = min(self.base_delay * 2 ** failures, self.max_delay)
+            self._domains[domain] = (failures + 1, now + delay)
+        self._save_domains()
+        self._save_state(entry._replace(
+            recipients=tuple(transient), attempts=entry.attempts + 1, last_error=message))
+        self.deferred += 1
+        _LOG.warning('%s: delivery of %s to %s deferred: %s',
+                     self, entry.entry_id, transient, message)
+
+    def _fail(self, entry: SpoolEntry) -> None:
+        os.replace(self._queue_path.joinpath(f'{entry.entry_id}.eml'),
+                   self._failed_path.joinpath(f'{entry.entry_id}.eml'))
+        _write_atomically(
+            self._failed_path.joinpath(f'{entry.entry_id}.json'), _serialize_state(entry))
+        self._queue_path.joinpath(f'{entry.entry_id}.json').unlink()
+        del self._entries[entry.entry_id]
+        self.failed += 1
+
+    def _remove(self, entry: SpoolEntry) -> None:
+        self._queue_path.joinpath(f'{entry.entry_id}.json').unlink()
+        self._queue_path.joinpath(f'{entry.entry_id}.eml').unlink()
+        del self._entries[entry.entry_id]
+
+    def _reset_domains(self, recipients: t.Iterable[str]) -> None:
+        domains = {domain_of(recipient) for recipient in recipients} & self._domains.keys()
+        if not domains:
+            return
+        for domain in domains:
+            del self._domains[domain]
+        self._save_domains()
+
+    @property
+    def entries(self) -> t.List[SpoolEntry]:
+        return sorted(self._entries.values(), key=lambda entry: entry.queued)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._path})'
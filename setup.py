@@ -22,6 +22,7 @@ class Package(boilerplates.setup.Package):
         'Typing :: Typed']
     keywords = ['e-mail', 'filter', 'daemon', 'imap', 'pop', 'smtp']
     entry_points = {'console_scripts': ['maildaemon = maildaemon.__main__:main']}
+    extras_require = {'re2': ['google-re2 ~= 1.1'], 'columns': ['numpy ~= 2.0']}
 
 
 if __name__ == '__main__':
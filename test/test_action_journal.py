@@ -0,0 +1,104 @@
+"""Tests for write-ahead journal of moves."""
+
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+
+from maildaemon.action_journal import ActionJournal
+from maildaemon.message_transfer import MessageTransfer
+
+from .test_message_transfer import _FakeSource, _FakeTarget
+
+
+def _make_connection(account: str, uids=(), uidvalidity: int = 1):
+    connection = unittest.mock.Mock()
+    connection.account = account
+    connection.uidvalidity = uidvalidity
+    connection.retrieve_message_ids.return_value = list(uids)
+    return connection
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._directory.name, 'journal.jsonl')
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_persistence(self):
+        source, target = _make_connection('a'), _make_connection('b')
+        journal = ActionJournal(self.path)
+        completed = journal.begin(source, 'INBOX', 1, [1], target, 'Archive')
+        journal.end(completed)
+        interrupted = journal.begin(source, 'INBOX', 1, [2, 3, 4], target, 'Archive')
+        journal.record_copied(interrupted, [2])
+        journal.close()
+        with self.path.open('a') as journal_file:
+            journal_file.write('{"op": "end", "id"')
+        journal = ActionJournal(self.path)
+        entry, = journal.pending
+        self.assertEqual(entry.entry_id, interrupted)
+        self.assertEqual(entry.uids, (2, 3, 4))
+        self.assertEqual(entry.copied, {2})
+        self.assertEqual(len(self.path.read_text().splitlines()), 2)
+        journal.close()
+
+    def test_recover(self):
+        source = _make_connection('a', uids=[2, 3, 4])
+        source.retrieve_messages_parts.return_value = [
+            (b'3 (UID 3 BODY[HEADER.FIELDS (MESSAGE-ID)] {20}', b'Message-Id: <3@a>\r\n\r\n'),
+            (b'4 (UID 4 BODY[HEADER.FIELDS (MESSAGE-ID)] {20}', b'Message-Id: <4@a>\r\n\r\n')]
+        target = _make_connection('b')
+        target.retrieve_message_ids.side_effect = \
+            lambda folder, criteria: [7] if criteria[-1] == '"<3@a>"' else []
+        journal = ActionJournal(self.path)
+        entry_id = journal.begin(source, 'INBOX', 1, [1, 2, 3, 4], target, 'Archive')
+        journal.record_copied(entry_id, [1, 2])
+        journal.recover([source, target])
+        source.delete_messages.assert_called_once_with([2, 3], 'INBOX')
+        self.assertEqual(journal.pending, [])
+        self.assertEqual(self.path.read_text(), '')
+        journal.close()
+
+    def test_recover_changed_uidvalidity(self):
+        source, target = _make_connection('a', uids=[1], uidvalidity=2), _make_connection('b')
+        journal = ActionJournal(self.path)
+        journal.begin(source, 'INBOX', 1, [1], target, 'Archive')
+        journal.recover([source, target])
+        source.delete_messages.assert_not_called()
+        self.assertEqual(journal.pending, [])
+        journal.close()
+
+    def test_recover_quoting(self):
+        source = _make_connection('a', uids=[1, 2])
+        source.retrieve_messages_parts.return_value = [
+            (b'1 (UID 1 BODY[HEADER.FIELDS (MESSAGE-ID)] {26}',
+             b'Message-Id: <"a\\b"@a>\r\n\r\n'),
+            (b'2 (UID 2 BODY[HEADER.FIELDS (MESSAGE-ID)] {27}',
+             b'Message-Id: <\xc3\xa9@a>\r\n\r\n')]
+        target = _make_connection('b', uids=[7])
+        journal = ActionJournal(self.path)
+        journal.begin(source, 'INBOX', 1, [1, 2], target, 'Archive')
+        journal.recover([source, target])
+        target.retrieve_message_ids.assert_called_once_with(
+            'Archive', ['HEADER', 'Message-Id', r'"<\"a\\b\"@a>"'])
+        source.delete_messages.assert_called_once_with([1], 'INBOX')
+        journal.close()
+
+    def test_transfer(self):
+        source = _FakeSource({i: 10 for i in range(1, 5)})
+        source.account = 'a'
+        source.uidvalidity = 1
+        target = _FakeTarget(fail_on_batch=1)
+        target.account = 'b'
+        journal = ActionJournal(self.path)
+        transfer = MessageTransfer(
+            source, 'INBOX', target, 'Archive', batch_size=2, journal=journal)
+        with self.assertRaises(RuntimeError):
+            transfer.run([1, 2, 3, 4])
+        entry, = journal.pending
+        self.assertEqual(entry.copied, {1, 2})
+        journal.close()
@@ -0,0 +1,122 @@
+"""Tests for bulk import of messages from archives into IMAP folders."""
+
+import email
+import mailbox
+import pathlib
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from maildaemon.archive_import import \
+    ArchiveImport, ImportCheckpoint, iterate_archive, iterate_maildir, iterate_mbox
+from maildaemon.imap_connection import _append_arguments
+
+from .config import TEST_MESSAGE_PATHS
+
+
+class _FakeSession:
+    """Record appended messages, shared by all sessions of the same connection."""
+
+    def __init__(self, appended, fail_on_batch=None):
+        self.appended = appended
+        self.fail_on_batch = fail_on_batch
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.connect = unittest.mock.Mock()
+        self.disconnect = unittest.mock.Mock()
+
+    def open_session(self):
+        session = _FakeSession(self.appended, self.fail_on_batch)
+        session.lock = self.lock
+        return session
+
+    def add_messages(self, messages_parts, folder, extra_flags):
+        with self.lock:
+            self.batches += 1
+            if self.batches == self.fail_on_batch:
+                raise RuntimeError('add_messages() failed')
+            self.appended += [(_append_arguments(envelope, extra_flags), body)
+                              for envelope, body in messages_parts]
+
+
+def _make_archives(path: pathlib.Path, count: int = 1):
+    mbox_path = path.joinpath('test.mbox')
+    maildir_path = path.joinpath('test_maildir')
+    archives = (mailbox.mbox(mbox_path), mailbox.Maildir(maildir_path))
+    for archive, message_class, read_flag in zip(
+            archives, (mailbox.mboxMessage, mailbox.MaildirMessage), ('RO', 'S')):
+        for _ in range(count):
+            for i, message_path in enumerate(TEST_MESSAGE_PATHS):
+                message = message_class(email.message_from_bytes(message_path.read_bytes()))
+                if i == 0:
+                    message.set_flags(read_flag)
+                if isinstance(message, mailbox.mboxMessage):
+                    message.set_from('sender@domain.com', (2011, 7, 8, 12, 8, 34, 4, 189, 0))
+                archive.add(message)
+        archive.close()
+    return mbox_path, maildir_path
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._directory.name)
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_iterate_mbox(self):
+        mbox_path, _ = _make_archives(self.path)
+        messages = list(iterate_mbox(mbox_path))
+        archive = mailbox.mbox(mbox_path)
+        self.assertEqual([message.raw for message in messages],
+                         [archive.get_bytes(key) for key in archive.iterkeys()])
+        archive.close()
+        self.assertEqual(messages[0].flags, {'Seen'})
+        self.assertEqual(messages[1].flags, set())
+        self.assertEqual(messages[0].date, 1310126914.0)
+        self.assertEqual(messages[0].key, '0')
+
+    def test_iterate_maildir(self):
+        _, maildir_path = _make_archives(self.path)
+        messages = sorted(iterate_maildir(maildir_path), key=lambda _: len(_.flags))
+        self.assertEqual(len(messages), len(TEST_MESSAGE_PATHS))
+        self.assertEqual(messages[1].flags, {'Seen'})
+        self.assertEqual(messages[0].flags, set())
+        with self.assertRaises(ValueError):
+            list(iterate_archive(self.path))
+
+    def test_import(self):
+        for archive_path in _make_archives(self.path, 3):
+            with self.subTest(path=archive_path):
+                connection = _FakeSession([])
+                statistics = ArchiveImport(
+                    connection, 'Archive', sessions=3, batch_size=2).run(archive_path)
+                self.assertEqual(statistics.messages, 6)
+                self.assertEqual(len(connection.appended), 6)
+                flags = sorted(flags for (flags, _), _ in connection.appended)
+                self.assertEqual(flags, ['()'] * 3 + [r'(\Seen)'] * 3)
+                for _, body in connection.appended:
+                    self.assertTrue(body.startswith(b'From: Test'), body[:20])
+                    self.assertEqual(body.count(b'\n'), body.count(b'\r\n'))
+
+    def test_resume(self):
+        mbox_path, _ = _make_archives(self.path, 3)
+        checkpoint = ImportCheckpoint(self.path.joinpath('checkpoint.jsonl'))
+        connection = _FakeSession([], fail_on_batch=2)
+        statistics = ArchiveImport(
+            connection, sessions=1, batch_size=2, checkpoint=checkpoint).run(mbox_path)
+        self.assertEqual((statistics.messages, statistics.failed), (4, 2))
+        checkpoint.close()
+        with self.path.joinpath('checkpoint.jsonl').open('a') as checkpoint_file:
+            checkpoint_file.write('{"keys": ["')
+        checkpoint = ImportCheckpoint(self.path.joinpath('checkpoint.jsonl'))
+        self.assertEqual(len(checkpoint.keys), 4)
+        connection = _FakeSession([])
+        statistics = ArchiveImport(
+            connection, sessions=2, batch_size=2, checkpoint=checkpoint).run(mbox_path)
+        self.assertEqual((statistics.messages, statistics.skipped), (2, 4))
+        self.assertEqual(len(checkpoint.keys), 6)
+        checkpoint.close()
@@ -0,0 +1,66 @@
+"""Tests for content-addressed store of raw messages."""
+
+import pathlib
+import tempfile
+import time
+import unittest
+
+from maildaemon.body_store import BodyStore
+from maildaemon.message_store import split_raw_message
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+RAW_MESSAGES = [TEST_MESSAGE_1_PATH.read_bytes(), TEST_MESSAGE_2_PATH.read_bytes()]
+
+
+class Tests(unittest.TestCase):
+
+    def test_put_and_find(self):
+        store = BodyStore()
+        digests = [store.put(raw_message) for raw_message in RAW_MESSAGES]
+        self.assertEqual(store.put(RAW_MESSAGES[0]), digests[0])
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get(digests[1]), RAW_MESSAGES[1])
+        for raw_message in RAW_MESSAGES:
+            headers, _ = split_raw_message(raw_message)
+            self.assertEqual(store.find(len(raw_message), headers), raw_message)
+            self.assertEqual(
+                store.find(len(raw_message), headers.replace(b'\n', b'\r\n')), raw_message)
+            self.assertIsNone(store.find(len(raw_message) + 1, headers))
+        statistics = store.statistics()
+        self.assertEqual(statistics['hits'], 4)
+        self.assertEqual(statistics['misses'], 2)
+        self.assertAlmostEqual(statistics['hit_rate'], 4 / 6)
+        self.assertEqual(statistics['bytes_saved'], 2 * sum(len(_) for _ in RAW_MESSAGES))
+        self.assertEqual(statistics['raw_bytes'], sum(len(_) for _ in RAW_MESSAGES))
+
+    def test_corrupted(self):
+        store = BodyStore()
+        digest = store.put(RAW_MESSAGES[0])
+        store._db.execute(
+            'UPDATE bodies SET digest = ? WHERE digest = ?', (bytes(len(digest)), digest))
+        headers, _ = split_raw_message(RAW_MESSAGES[0])
+        with self.assertLogs('maildaemon.body_store', level='ERROR'):
+            self.assertIsNone(store.find(len(RAW_MESSAGES[0]), headers))
+        self.assertEqual(len(store), 0)
+
+    def test_collect_garbage(self):
+        store = BodyStore()
+        digests = [store.put(raw_message) for raw_message in RAW_MESSAGES]
+        store._db.execute(
+            'UPDATE bodies SET last_used = ? WHERE digest = ?', (time.time() - 100, digests[0]))
+        self.assertEqual(store.collect_garbage(max_age=1000), 0)
+        self.assertEqual(store.collect_garbage(max_age=10), 1)
+        self.assertIsNone(store.get(digests[0]))
+        self.assertEqual(store.collect_garbage(max_bytes=1), 1)
+        self.assertEqual(len(store), 0)
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory, 'bodies.sqlite3')
+            store = BodyStore(path)
+            digest = store.put(RAW_MESSAGES[1])
+            store.close()
+            store = BodyStore(path)
+            self.assertEqual(store.get(digest), RAW_MESSAGES[1])
+            store.close()
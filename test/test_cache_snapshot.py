@@ -0,0 +1,69 @@
+"""Tests for snapshots of e-mail caches."""
+
+import email
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+
+from maildaemon.cache_snapshot import FILE_HEADER, MAGIC, CacheSnapshot
+from maildaemon.folder import Folder
+from maildaemon.message import Message
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+
+def _make_cache(account: str, uidvalidity: int, uids):
+    cache = unittest.mock.Mock()
+    cache.account = account
+    cache.snapshot_uid.side_effect = lambda message: message._origin_id
+    folder = Folder(cache, 'INBOX')
+    folder.uidvalidity = uidvalidity
+    for uid in uids:
+        path = TEST_MESSAGE_1_PATH if uid % 2 else TEST_MESSAGE_2_PATH
+        message = Message(email.message_from_bytes(path.read_bytes()), cache, 'INBOX', uid)
+        if uid % 3 == 0:
+            message.flags.update({'Seen', 'Flagged'})
+        folder.add_message(message)
+    cache.folders = {'INBOX': folder}
+    return cache
+
+
+class Tests(unittest.TestCase):
+
+    def test_save_and_load(self):
+        caches = [_make_cache('first', 7, range(1, 5)), _make_cache('second', 0, [])]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = pathlib.Path(temp_dir, 'snapshot')
+            snapshot = CacheSnapshot(path)
+            self.assertEqual(snapshot.load_messages('first', 'INBOX', 7), {})
+            snapshot.save(caches)
+            snapshot.close()
+            self.assertFalse(path.with_name('snapshot.tmp').exists())
+
+            snapshot = CacheSnapshot(path)
+            stored = snapshot.load_messages('first', 'INBOX', 7)
+            self.assertEqual(sorted(stored), [1, 2, 3, 4])
+            self.assertEqual(stored[3].flags, {'Seen', 'Flagged'})
+            self.assertEqual(stored[4].flags, set())
+            self.assertIsNone(stored[1].body)
+            message = Message(email.message_from_bytes(stored[2].headers))
+            self.assertEqual(message.subject, 'Different test message')
+            self.assertEqual(message.from_address, 'noreply@domain.com')
+            self.assertEqual(message.contents, [])
+            self.assertEqual(snapshot.load_messages('first', 'INBOX', 8), {})
+            self.assertEqual(snapshot.load_messages('second', 'INBOX', 0), {})
+            snapshot.close()
+
+    def test_unsupported(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = pathlib.Path(temp_dir, 'snapshot')
+            path.write_bytes(FILE_HEADER.pack(MAGIC, 0, 1))
+            snapshot = CacheSnapshot(path)
+            self.assertEqual(snapshot.load_messages('first', 'INBOX', 7), {})
+            snapshot.close()
+            path.write_bytes(FILE_HEADER.pack(MAGIC, 1, 1)[:-1])
+            with self.assertLogs('maildaemon.cache_snapshot'):
+                snapshot = CacheSnapshot(path)
+            self.assertEqual(snapshot.load_messages('first', 'INBOX', 7), {})
+            snapshot.close()
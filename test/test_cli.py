@@ -1,6 +1,7 @@
 """Test the command-line interface."""
 
 import contextlib
+import mailbox
 import os
 import pathlib
 import tempfile
@@ -12,7 +13,7 @@ import daemon
 
 from maildaemon.cli import main
 
-from .config import TEST_CONFIG_PATH
+from .config import TEST_CONFIG_PATH, TEST_MESSAGE_1_PATH
 
 
 class Tests(unittest.TestCase):
@@ -50,6 +51,25 @@ class Tests(unittest.TestCase):
                 with contextlib.redirect_stdout(devnull):
                     main(['--config', str(created_file), '-vv'])
 
+    def test_replay(self):
+        with open(os.devnull, 'w', encoding='utf-8') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                main(['--config', str(TEST_CONFIG_PATH), 'replay', str(TEST_MESSAGE_1_PATH.parent)])
+
+    @unittest.skipUnless(os.environ.get('TEST_COMM') or os.environ.get('CI'),
+                         'test requires server connection')
+    def test_import(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            maildir_path = pathlib.Path(temp_dir, 'test_maildir')
+            archive = mailbox.Maildir(maildir_path)
+            archive.add(TEST_MESSAGE_1_PATH.read_bytes())
+            archive.close()
+            with open(os.devnull, 'w', encoding='utf-8') as devnull:
+                with contextlib.redirect_stdout(devnull):
+                    main(['--config', str(TEST_CONFIG_PATH), 'import', str(maildir_path),
+                          'test-imap', 'INBOX', '--sessions', '2',
+                          '--checkpoint', str(pathlib.Path(temp_dir, 'checkpoint.jsonl'))])
+
     @unittest.skipUnless(os.environ.get('TEST_COMM') or os.environ.get('CI'),
                          'test requires server connection')
     def test_daemon(self):
@@ -0,0 +1,98 @@
+"""Tests for index of messages handled by run-once filters."""
+
+import email
+import pathlib
+import unittest
+import unittest.mock
+
+from maildaemon.connection_group import ConnectionGroup
+from maildaemon.daemon_group import DaemonGroup
+from maildaemon.duplicate_index import make_duplicate_key, DuplicateIndex
+from maildaemon.folder import Folder
+from maildaemon.imap_cache import IMAPCache
+from maildaemon.message import Message
+from maildaemon.message_filter import MessageFilter
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+
+def _load_message(path: pathlib.Path) -> Message:
+    return Message(email.message_from_bytes(path.read_bytes()))
+
+
+class Tests(unittest.TestCase):
+
+    def test_duplicate_key(self):
+        message = _load_message(TEST_MESSAGE_1_PATH)
+        delivered = _load_message(TEST_MESSAGE_1_PATH)
+        delivered._email_message['Delivered-To'] = 'someone@example.com'
+        self.assertEqual(make_duplicate_key(message), make_duplicate_key(delivered))
+        self.assertNotEqual(
+            make_duplicate_key(message), make_duplicate_key(_load_message(TEST_MESSAGE_2_PATH)))
+
+    def test_expiry(self):
+        index = DuplicateIndex(ttl=10)
+        with unittest.mock.patch('time.monotonic', return_value=100.0):
+            self.assertTrue(index.add('a'))
+            self.assertFalse(index.add('a'))
+            self.assertTrue(index.seen('a'))
+            self.assertTrue(index.seen('a', origin=1))
+            self.assertTrue(index.seen('a', origin=1))
+        with unittest.mock.patch('time.monotonic', return_value=110.0):
+            self.assertFalse(index.seen('a'))
+            self.assertEqual(len(index), 0)
+            self.assertTrue(index.add('a', origins=[1]))
+            self.assertTrue(index.seen('a', origin=1))
+        self.assertEqual(index.duplicates, 2)
+
+    def test_max_size(self):
+        index = DuplicateIndex(max_size=2)
+        for key in ('a', 'b', 'c'):
+            index.add(key)
+        self.assertEqual(len(index), 2)
+        self.assertNotIn('a', index)
+        self.assertIn('c', index)
+
+    def test_run_once_filter(self):
+        filters = [
+            MessageFilter.from_dict(
+                {'condition': "'test' in message.subject.lower()", 'run-once': True}, name='a'),
+            MessageFilter.from_dict({'condition': 'True'}, name='b')]
+        daemon_group = DaemonGroup(ConnectionGroup(), filters)
+        copies = [_load_message(TEST_MESSAGE_1_PATH) for _ in range(3)]
+        pending = {}
+        applicable = [daemon_group._find_applicable_filter(_, filters, pending) for _ in copies]
+        self.assertEqual(applicable, [filters[0], None, None])
+        self.assertIsNone(daemon_group._find_applicable_filter(copies[1], filters, pending))
+        self.assertEqual(filters[0].statistics['evaluated'], 1)
+        self.assertEqual(filters[1].statistics['evaluated'], 0)
+        self.assertEqual(len(daemon_group._connections.duplicates), 0)
+        daemon_group._record_duplicates(filters[0], pending)
+        self.assertEqual(pending, {})
+        for _ in range(2):
+            for copy in copies:
+                self.assertIsNone(daemon_group._find_applicable_filter(copy, filters, {}))
+        self.assertEqual(daemon_group._connections.duplicates.duplicates, 2)
+        other = _load_message(TEST_MESSAGE_2_PATH)
+        self.assertIs(daemon_group._find_applicable_filter(other, filters), filters[0])
+
+    def test_run_once_action_failure(self):
+        with unittest.mock.patch('imaplib.IMAP4_SSL'):
+            cache = IMAPCache('imap.example.com', 993)
+        cache.folders['INBOX'] = Folder(cache, 'INBOX')
+        for uid in (1, 2):
+            message = _load_message(TEST_MESSAGE_1_PATH)
+            message._origin_server, message._origin_folder, message._origin_id = cache, 'INBOX', uid
+            cache.folders['INBOX'].add_message(message)
+        cache.add_messages_flags = unittest.mock.Mock(side_effect=RuntimeError('store failed'))
+        message_filter = MessageFilter.from_dict(
+            {'connections': ['imap'], 'condition': 'True', 'actions': ['mark:read'],
+             'run-once': True}, {'imap': cache})
+        daemon_group = DaemonGroup(ConnectionGroup(imap=cache), [message_filter])
+        with self.assertRaises(RuntimeError):
+            daemon_group.apply_filters()
+        self.assertEqual(len(daemon_group._connections.duplicates), 0)
+        cache.add_messages_flags.side_effect = None
+        daemon_group.apply_filters()
+        cache.add_messages_flags.assert_called_with([1], ['Seen'], folder='INBOX')
+        self.assertEqual(len(daemon_group._connections.duplicates), 1)
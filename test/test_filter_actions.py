@@ -0,0 +1,139 @@
+"""Tests for actions of message filters."""
+
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+
+from maildaemon.filter_actions import \
+    mark, move, delete, forward, coalesce_actions, apply_coalesced_actions
+from maildaemon.imap_connection import IMAPConnection
+from maildaemon.message import Message
+from maildaemon.message_filter import MessageFilter
+from maildaemon.pop_cache import POPCache
+from maildaemon.smtp_daemon import SMTPDaemon
+from maildaemon.smtp_spool import SMTPSpool
+
+from .config import TEST_MESSAGE_1_PATH
+
+
+def _make_messages(server, folder: str, count: int):
+    return [Message(None, server, folder, i) for i in range(1, count + 1)]
+
+
+class Tests(unittest.TestCase):
+
+    def test_coalesce(self):
+        server = unittest.mock.Mock()
+        actions = coalesce_actions([(mark, ('read',)), (move, (server, 'Archive'))])
+        self.assertEqual(actions.flags, {'Seen'})
+        self.assertEqual(actions.destination, (server, 'Archive'))
+        self.assertFalse(actions.deleted)
+        actions = coalesce_actions([(move, (server, 'Archive')), (mark, ('read',)), (delete, ())])
+        self.assertEqual(actions.flags, {'Seen'})
+        self.assertEqual(actions.destination, (server, 'Archive'))
+        self.assertTrue(actions.deleted)
+        with self.assertRaises(NotImplementedError):
+            coalesce_actions([(mark, ('important',))])
+
+    def test_mark_and_move_within_server(self):
+        server = unittest.mock.Mock()
+        messages = _make_messages(server, 'INBOX', 3)
+        actions = coalesce_actions([(mark, ('read',)), (move, (server, 'Archive'))])
+        apply_coalesced_actions(messages, actions)
+        server.add_messages_flags.assert_called_once_with([1, 2, 3], ['Seen'], folder='INBOX')
+        server.move_messages.assert_called_once_with([1, 2, 3], 'Archive', 'INBOX')
+        self.assertTrue(all(message.is_read for message in messages))
+
+    def test_mark_and_move_between_servers(self):
+        source, target = unittest.mock.Mock(), unittest.mock.Mock()
+        source.retrieve_messages_parts.return_value = [
+            (b'1 (UID 1 RFC822.SIZE 0)', None), (b'2 (UID 2 RFC822.SIZE 0)', None)]
+        source.retrieve_raw_messages.return_value = [(b'', b'')] * 2
+        messages = _make_messages(source, 'INBOX', 2)
+        actions = coalesce_actions([(mark, ('read',)), (move, (target, 'Archive'))])
+        apply_coalesced_actions(messages, actions)
+        source.add_messages_flags.assert_not_called()
+        source.retrieve_raw_messages.assert_called_once()
+        target.add_messages.assert_called_once_with([(b'', b'')] * 2, 'Archive', ['Seen'])
+        source.delete_messages.assert_called_once_with([1, 2], 'INBOX')
+
+    def test_mark_and_delete(self):
+        server = unittest.mock.Mock()
+        messages = _make_messages(server, 'INBOX', 2) + _make_messages(server, 'Other', 1)
+        actions = coalesce_actions([(mark, ('read',)), (delete, ())])
+        apply_coalesced_actions(messages, actions)
+        self.assertEqual(server.add_messages_flags.call_args_list, [
+            unittest.mock.call([1, 2], ['Deleted', 'Seen'], folder='INBOX'),
+            unittest.mock.call([1], ['Deleted', 'Seen'], folder='Other')])
+        server.move_messages.assert_not_called()
+
+    def test_move_and_delete(self):
+        server = unittest.mock.Mock()
+        messages = _make_messages(server, 'INBOX', 2)
+        actions = coalesce_actions([(move, (server, 'Archive')), (delete, ())])
+        apply_coalesced_actions(messages, actions)
+        server.move_messages.assert_called_once_with([1, 2], 'Archive', 'INBOX')
+        server.add_messages_flags.assert_not_called()
+        messages = _make_messages(server, 'Archive', 1)
+        apply_coalesced_actions(messages, actions)
+        server.add_messages_flags.assert_called_once_with([1], ['Deleted'], folder='Archive')
+
+    def test_filter_from_dict(self):
+        server = unittest.mock.Mock()
+        msg_filter = MessageFilter.from_dict(
+            {'condition': 'True', 'actions': ['mark:read', 'move:server/Archive']},
+            {'server': server})
+        msg_filter.apply_unconditionally_to_many(_make_messages(server, 'INBOX', 4))
+        server.add_messages_flags.assert_called_once()
+        server.move_messages.assert_called_once_with([1, 2, 3, 4], 'Archive', 'INBOX')
+        latencies = msg_filter.summarize_statistics()['latencies']
+        self.assertEqual(latencies['action_move']['samples'], 1)
+
+    def test_forward(self):
+        smtp = unittest.mock.Mock()
+        actions = coalesce_actions([
+            (forward, (smtp, 'a@example.com', False)), (delete, ()),
+            (forward, (smtp, 'a@example.com', False)), (forward, (smtp, 'b@example.com', True))])
+        self.assertEqual(actions.forwards, (
+            (smtp, 'a@example.com', False), (smtp, 'b@example.com', True)))
+        self.assertTrue(actions.deleted)
+
+    def test_forward_via_spool(self):
+        raw_message = TEST_MESSAGE_1_PATH.read_bytes().replace(b'\n', b'\r\n')
+        server = unittest.mock.Mock(spec=IMAPConnection)
+        server.retrieve_raw_messages.side_effect = \
+            lambda ids, *_: [(b'', raw_message) for _ in ids]
+        with unittest.mock.patch('smtplib.SMTP_SSL'):
+            smtp = SMTPDaemon('smtp.example.com', 465)
+        smtp.login = 'forwarder@example.com'
+        with tempfile.TemporaryDirectory() as spool_path:
+            smtp.spool = SMTPSpool(pathlib.Path(spool_path))
+            msg_filter = MessageFilter.from_dict(
+                {'condition': 'True', 'actions': ['forward:smtp/a@example.com', 'delete']},
+                {'smtp': smtp})
+            msg_filter.apply_unconditionally_to_many(_make_messages(server, 'INBOX', 60))
+            self.assertEqual(server.retrieve_raw_messages.call_count, 2)
+            server.add_messages_flags.assert_called_once()
+            self.assertEqual(len(smtp.outbox), 60)
+            entry = smtp.outbox[0]
+            self.assertEqual(entry.sender, 'forwarder@example.com')
+            self.assertEqual(entry.recipients, ('a@example.com',))
+            forwarded = smtp.spool.message_path(entry).read_bytes()
+            self.assertTrue(forwarded.startswith(b'Resent-From: forwarder@example.com\r\n'))
+            self.assertTrue(forwarded.endswith(raw_message))
+            smtp._link.send_message.assert_not_called()
+
+    def test_forward_and_delete_via_pop(self):
+        raw_message = TEST_MESSAGE_1_PATH.read_bytes()
+        server = unittest.mock.Mock(spec=POPCache)
+        server.retrieve_raw_message.return_value = raw_message
+        smtp = unittest.mock.Mock()
+        messages = _make_messages(server, None, 2)
+        actions = coalesce_actions([(forward, (smtp, 'a@example.com', False)), (delete, ())])
+        apply_coalesced_actions(messages, actions)
+        self.assertEqual(server.retrieve_raw_message.call_count, 2)
+        self.assertEqual(smtp.forward_message.call_args_list, [
+            unittest.mock.call(raw_message, 'a@example.com', False)] * 2)
+        server.delete_messages.assert_called_once_with([1, 2])
+        self.assertTrue(all('Deleted' in message.flags for message in messages))
@@ -0,0 +1,68 @@
+"""Tests for caching outcomes of filter conditions."""
+
+import email
+import pathlib
+import tempfile
+import unittest
+
+from maildaemon.connection_group import ConnectionGroup
+from maildaemon.daemon_group import DaemonGroup
+from maildaemon.filter_cache import make_message_key, FilterResultCache
+from maildaemon.message import Message
+from maildaemon.message_filter import MessageFilter
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+
+def _load_message(path: pathlib.Path) -> Message:
+    return Message(email.message_from_bytes(path.read_bytes()))
+
+
+class Tests(unittest.TestCase):
+
+    def test_message_key(self):
+        message1 = _load_message(TEST_MESSAGE_1_PATH)
+        message2 = _load_message(TEST_MESSAGE_2_PATH)
+        key1 = make_message_key(message1)
+        self.assertEqual(key1, make_message_key(_load_message(TEST_MESSAGE_1_PATH)))
+        self.assertNotEqual(key1, make_message_key(message2))
+        message1.flags.add('Seen')
+        self.assertNotEqual(key1, make_message_key(message1))
+        message2.message_id = '<1234@domain.com>'
+        key2 = make_message_key(message2)
+        message2.subject = 'Changed'
+        self.assertEqual(key2, make_message_key(message2))
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = pathlib.Path(temp_dir, 'filter_cache.sqlite3')
+            cache = FilterResultCache(path)
+            cache.set('message', 'condition1', True)
+            cache.set('message', 'condition2', False)
+            cache.close()
+            cache = FilterResultCache(path)
+            self.assertTrue(cache.get('message', 'condition1'))
+            self.assertFalse(cache.get('message', 'condition2'))
+            self.assertIsNone(cache.get('message', 'condition3'))
+            cache.retain_conditions(['condition2'])
+            self.assertIsNone(cache.get('message', 'condition1'))
+            self.assertEqual(len(cache), 1)
+            cache.close()
+
+    def test_daemon_group(self):
+        filters = [
+            MessageFilter.from_dict({'condition': "'Different' in message.subject"}, name='a'),
+            MessageFilter.from_dict({'condition': "'test' in message.subject.lower()"}, name='b')]
+        cache = FilterResultCache()
+        messages = [_load_message(path) for path in (TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH)]
+        daemon_group = DaemonGroup(ConnectionGroup(), filters, filter_results=cache)
+        for _ in range(2):
+            applicable = [daemon_group._find_applicable_filter(_, filters) for _ in messages]
+            self.assertEqual(applicable, [filters[1], filters[0]])
+        self.assertEqual(filters[0].statistics['evaluated'], 2)
+        self.assertEqual(filters[1].statistics['evaluated'], 1)
+        self.assertEqual(cache.hits, 3)
+        changed_filter = MessageFilter.from_dict({'condition': "'message' in message.subject"})
+        daemon_group = DaemonGroup(
+            ConnectionGroup(), [changed_filter, filters[1]], filter_results=cache)
+        self.assertEqual(len(cache), 1)
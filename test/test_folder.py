@@ -0,0 +1,64 @@
+"""Tests for folders of e-mail messages."""
+
+import datetime
+import email
+import unittest
+
+from maildaemon.folder import Folder
+from maildaemon.message import Message
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+
+def _make_message(uid: int, from_address: str, day: int, message_id: str = None) -> Message:
+    message = Message(
+        email.message_from_bytes(TEST_MESSAGE_1_PATH.read_bytes()), None, 'INBOX', uid)
+    message.from_address = from_address
+    message.datetime = datetime.datetime(2024, 1, day, tzinfo=datetime.timezone.utc)
+    message.message_id = message_id
+    return message
+
+
+class Tests(unittest.TestCase):
+
+    def test_find_message(self):
+        folder = Folder(None, 'INBOX')
+        messages = [_make_message(uid, 'a@domain.com', uid, f'<{uid % 2}@domain.com>')
+                    for uid in range(1, 5)]
+        for message in messages:
+            folder.add_message(message)
+        self.assertIs(folder.find_message(uid=3), messages[2])
+        self.assertIsNone(folder.find_message(uid=7))
+        self.assertIs(folder.find_message(message_id='<0@domain.com>'), messages[1])
+        folder.remove_message(messages[1])
+        self.assertIs(folder.find_message(message_id='<0@domain.com>'), messages[3])
+        folder.remove_message(messages[3])
+        self.assertIsNone(folder.find_message(message_id='<0@domain.com>'))
+        self.assertEqual(len(folder.messages), 2)
+        with self.assertRaises(ValueError):
+            folder.find_message()
+
+    def test_find_messages(self):
+        folder = Folder(None, 'INBOX')
+        messages = [_make_message(uid, f'{"ab"[uid % 2]}@domain.com', 10 - uid)
+                    for uid in range(1, 8)]
+        for message in messages:
+            folder.add_message(message)
+        undated = Message(email.message_from_bytes(TEST_MESSAGE_2_PATH.read_bytes()),
+                          None, 'INBOX', 8)
+        folder.add_message(undated)
+        self.assertEqual(len(folder.find_messages()), 8)
+        self.assertEqual(folder.find_messages(from_address='b@domain.com'), messages[::2])
+        since = datetime.datetime(2024, 1, 4, tzinfo=datetime.timezone.utc)
+        before = datetime.datetime(2024, 1, 7, tzinfo=datetime.timezone.utc)
+        self.assertEqual(folder.find_messages(since=since, before=before), messages[3:6])
+        self.assertEqual(folder.find_messages(before=before), messages[3:])
+        self.assertEqual(
+            folder.find_messages(from_address='a@domain.com', since=since), messages[1:6:2])
+        folder.remove_message(messages[4])
+        self.assertEqual(folder.find_messages(since=since, before=before), messages[3:6:2])
+        folder.renumber_messages({1: 2, 2: 1})
+        self.assertEqual(folder.find_messages(
+            since=datetime.datetime(2024, 1, 9, tzinfo=datetime.timezone.utc)), [messages[0]])
+        self.assertEqual(messages[0]._origin_id, 2)
+        self.assertEqual(folder.find_messages(since=since)[:2], [messages[1], messages[0]])
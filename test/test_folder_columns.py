@@ -0,0 +1,122 @@
+"""Tests for columnar metadata of messages in a folder."""
+
+import datetime
+import email
+import importlib.util
+import unittest
+import unittest.mock
+
+from maildaemon.connection_group import ConnectionGroup
+from maildaemon.daemon_group import DaemonGroup
+from maildaemon.folder import Folder
+from maildaemon.imap_cache import IMAPCache
+from maildaemon.message import Message
+from maildaemon.message_filter import MessageFilter
+from maildaemon.message_flags import SEEN, FLAGGED
+
+if importlib.util.find_spec('numpy') is not None:
+    from maildaemon.folder_columns import FolderColumns
+
+
+def _date(day: int) -> datetime.datetime:
+    return datetime.datetime(2024, 1, day, tzinfo=datetime.timezone.utc)
+
+
+@unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+class Tests(unittest.TestCase):
+
+    def test_predicates(self):
+        columns = FolderColumns()
+        for uid in range(1, 101):
+            columns.append(
+                uid, SEEN if uid % 2 else 0, _date(1 + uid % 30) if uid % 10 else None, uid * 100,
+                f'sender{uid % 3}@domain.com', f'subject {uid % 4}')
+        self.assertEqual(len(columns), 100)
+        self.assertEqual(columns.select(columns.with_flags(SEEN))[:3], [1, 3, 5])
+        self.assertEqual(columns.select(columns.without_flags(SEEN | FLAGGED))[:3], [2, 4, 6])
+        self.assertEqual(columns.select(columns.dated_between(_date(2), _date(4))),
+                         [1, 2, 31, 32, 61, 62, 91, 92])
+        self.assertEqual(columns.select(columns.larger_than(9800)), [99, 100])
+        self.assertEqual(len(columns.select(columns.from_senders(
+            ['sender0@domain.com', 'nobody@domain.com']))), 33)
+        self.assertEqual(
+            columns.select(columns.subject_matches(lambda _: _.endswith('3'))
+                           & columns.from_senders(['sender1@domain.com']) & ~columns.all()),
+            [])
+        self.assertEqual(
+            columns.select(columns.subject_matches(lambda _: _.endswith('3'))
+                           & columns.from_senders(['sender1@domain.com'])),
+            [7, 19, 31, 43, 55, 67, 79, 91])
+
+        columns.set_flags(2, SEEN | FLAGGED)
+        self.assertEqual(columns.select(columns.with_flags(FLAGGED)), [2])
+        columns.remove(2)
+        columns.remove(3)
+        self.assertEqual(columns.select(columns.with_flags(SEEN))[:2], [1, 5])
+        self.assertNotIn(3, columns.known_uids)
+        with self.assertRaises(KeyError):
+            columns.set_flags(3, SEEN)
+        columns.remove_selected(columns.with_uids([4, 5, 1000]))
+        self.assertEqual(len(columns), 96)
+        self.assertEqual(columns.select(columns.with_flags(SEEN))[:2], [1, 7])
+        columns.compact()
+        self.assertEqual(len(columns.uids), 96)
+        self.assertEqual(columns.select(columns.larger_than(9800)), [99, 100])
+        columns.set_flags(100, FLAGGED)
+        self.assertEqual(columns.select(columns.with_flags(FLAGGED)), [100])
+
+    def test_from_messages(self):
+        message = Message(None, None, 'INBOX', 7)
+        message.flags.add('Seen')
+        message.from_address = 'sender@domain.com'
+        message.datetime = _date(5)
+        columns = FolderColumns.from_messages([message])
+        self.assertEqual(columns.select(columns.with_flags(SEEN)), [7])
+        self.assertEqual(columns.select(columns.dated_between(since=_date(5))), [7])
+
+    def test_imap_metadata(self):
+        columns = FolderColumns()
+        IMAPCache._append_columns(
+            columns, 12,
+            b'1 (UID 12 FLAGS (\\Seen) INTERNALDATE " 3-Jan-2024 10:00:00 +0000" RFC822.SIZE 2048'
+            b' BODY[HEADER.FIELDS (FROM SUBJECT)] {60}',
+            b'From: Test <noreply@domain.com>\r\nSubject: =?utf-8?q?caf=C3=A9?=\r\n\r\n')
+        self.assertEqual(columns.select(columns.with_flags(SEEN)), [12])
+        self.assertEqual(columns.select(columns.dated_between(_date(3), _date(4))), [12])
+        self.assertEqual(columns.select(columns.larger_than(2047)), [12])
+        self.assertEqual(columns.select(columns.from_senders(['noreply@domain.com'])), [12])
+        self.assertEqual(columns.select(columns.subject_matches(lambda _: _ == 'café')), [12])
+
+    def test_filters(self):
+        with unittest.mock.patch('imaplib.IMAP4_SSL'):
+            cache = IMAPCache('imap.example.com', 993)
+        folder = Folder(cache, 'Archive')
+        folder.columns = FolderColumns()
+        for uid in range(1, 11):
+            folder.columns.append(
+                uid, SEEN if uid % 2 else 0, _date(uid), uid * 100, 'sender@domain.com',
+                f'subject {uid}')
+        cache.folders['Archive'] = folder
+        cache.retrieve_messages = unittest.mock.Mock(side_effect=lambda uids, folder_name, **_: [
+            Message(email.message_from_string(f'Subject: subject {uid}\n\n'), cache,
+                    folder_name, uid) for uid in uids])
+        cache.add_messages_flags = unittest.mock.Mock()
+        filters = [
+            MessageFilter.from_dict({
+                'connections': ['imap'], 'columns-condition': 'columns.without_flags(SEEN)',
+                'condition': "message.subject != 'subject 4'", 'actions': ['mark:read']},
+                {'imap': cache}),
+            MessageFilter.from_dict({
+                'connections': ['imap'], 'columns-condition': 'columns.larger_than(500)',
+                'condition': 'True', 'actions': ['delete']}, {'imap': cache}),
+            MessageFilter.from_dict(
+                {'connections': ['imap'], 'condition': 'True', 'actions': ['delete']},
+                {'imap': cache})]
+        DaemonGroup(ConnectionGroup(imap=cache), filters).apply_filters()
+        self.assertEqual(cache.retrieve_messages.call_args_list, [
+            unittest.mock.call([2, 4, 6, 8, 10], 'Archive', headers_only=True),
+            unittest.mock.call([7, 9], 'Archive', headers_only=True)])
+        self.assertEqual(cache.add_messages_flags.call_args_list, [
+            unittest.mock.call([2, 6, 8, 10], ['Seen'], folder='Archive'),
+            unittest.mock.call([7, 9], ['Deleted'], folder='Archive')])
+        self.assertEqual(filters[2].statistics['evaluated'], 0)
@@ -0,0 +1,63 @@
+"""Tests for forwarding of raw messages."""
+
+import email
+import email.policy
+import unittest
+import unittest.mock
+
+from maildaemon.forwarding import FORWARD_TEXT, forward_chunks, to_crlf
+from maildaemon.smtp_connection import ChunksReader
+from maildaemon.smtp_daemon import SMTPDaemon
+
+from .config import TEST_MESSAGE_2_PATH
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.raw_message = TEST_MESSAGE_2_PATH.read_bytes()
+
+    def test_to_crlf(self):
+        self.assertEqual(to_crlf(b'a\nb\r\nc\n'), b'a\r\nb\r\nc\r\n')
+        raw_message = b'a\r\nb\r\n'
+        self.assertIs(to_crlf(raw_message), raw_message)
+
+    def test_resend(self):
+        chunks = forward_chunks(self.raw_message, 'me@example.com', 'you@example.com')
+        self.assertEqual(chunks[1], to_crlf(self.raw_message))
+        forwarded = email.message_from_bytes(b''.join(chunks))
+        self.assertEqual(forwarded['Resent-To'], 'you@example.com')
+        self.assertEqual(
+            forwarded['Subject'], email.message_from_bytes(self.raw_message)['Subject'])
+
+    def test_attachment(self):
+        chunks = forward_chunks(
+            self.raw_message, 'me@example.com', 'you@example.com', as_attachment=True)
+        forwarded = email.message_from_bytes(b''.join(chunks), policy=email.policy.default)
+        original = email.message_from_bytes(self.raw_message, policy=email.policy.default)
+        self.assertEqual(forwarded['To'], 'you@example.com')
+        self.assertEqual(forwarded['Subject'], f'Fwd: {original["Subject"]}')
+        text, attachment = forwarded.iter_parts()
+        self.assertEqual(text.get_content().strip(), FORWARD_TEXT)
+        attached, = attachment.iter_parts()
+        self.assertEqual(attached['Message-Id'], original['Message-Id'])
+
+    def test_chunks_reader(self):
+        reader = ChunksReader([b'abc', b'', b'defgh'])
+        buffer = bytearray(4)
+        self.assertEqual(reader.readinto(buffer), 3)
+        self.assertEqual(reader.read(), b'defgh')
+
+    def test_daemon_without_spool(self):
+        with unittest.mock.patch('smtplib.SMTP_SSL'):
+            daemon = SMTPDaemon('smtp.example.com', 465)
+        daemon.login = 'me'
+        daemon.forward_message(self.raw_message, 'you@example.com')
+        message, = daemon.outbox
+        self.assertEqual(message.from_address, 'me@smtp.example.com')
+        with unittest.mock.patch.object(daemon, 'send_raw_message') as send_raw_message:
+            daemon.update()
+        raw_message, from_address, to_addresses = send_raw_message.call_args.args
+        self.assertEqual(from_address, 'me@smtp.example.com')
+        self.assertEqual(to_addresses, ('you@example.com',))
+        self.assertEqual(daemon.outbox, [])
@@ -0,0 +1,42 @@
+"""Tests for full-text index of messages."""
+
+import email
+import pathlib
+import tempfile
+import unittest
+
+from maildaemon.full_text_index import FullTextIndex
+from maildaemon.message import Message
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+
+class Tests(unittest.TestCase):
+
+    def test_search(self):
+        messages = [Message(email.message_from_bytes(path.read_bytes()))
+                    for path in (TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH)]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = pathlib.Path(temp_dir, 'index.sqlite3')
+            index = FullTextIndex(path)
+            for uid, message in enumerate(messages, 1):
+                index.add_message('account', 'INBOX', uid, message)
+            index.add_message('other', 'INBOX', 'uidl', messages[1])
+            index.close()
+
+            index = FullTextIndex(path)
+            self.assertEqual(len(index), 3)
+            self.assertEqual(index.search('"this is a test"'), [('account', 'INBOX', 1)])
+            self.assertEqual(
+                sorted(index.search('differ*', account='account')), [('account', 'INBOX', 2)])
+            self.assertEqual(len(index.search('subject: message')), 3)
+            self.assertEqual(index.search('contents: "another test message"', limit=1),
+                             [('account', 'INBOX', 2)])
+            index.remove_messages('account', 'INBOX', [2, 3])
+            self.assertEqual(index.search('another'), [('other', 'INBOX', 'uidl')])
+            index.remove_folder('other', 'INBOX')
+            self.assertEqual(index.search('another'), [])
+            self.assertEqual(len(index), 1)
+            with self.assertRaisesRegex(RuntimeError, 'subject:'):
+                index.search('subject: "unterminated')
+            index.close()
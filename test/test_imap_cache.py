@@ -2,10 +2,13 @@
 
 import logging
 import os
+import pathlib
+import tempfile
 import unittest
 
 from maildaemon.config import load_config
 from maildaemon.imap_cache import IMAPCache
+from maildaemon.message_store import MessageStore
 
 from .config import TEST_CONFIG_PATH
 
@@ -37,3 +40,19 @@ class Tests(unittest.TestCase):
                 c.connect()
                 # c.update()  # TODO: there's some cryptic error in msg id 12 in INBOX
                 c.disconnect()
+
+    def test_update_with_message_store(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = MessageStore(pathlib.Path(temp_dir, 'messages.sqlite3'))
+            counts = []
+            for _ in range(2):
+                c = IMAPCache.from_dict(self.config['connections']['test-imap'])
+                c.message_store = store
+                c.connect()
+                c.update_folders()
+                c.update_messages_in(c.folders['INBOX'])
+                c.update_messages_in(c.folders['INBOX'])
+                c.disconnect()
+                counts.append(len(c.folders['INBOX'].messages))
+            store.close()
+            self.assertEqual(counts[0], counts[1])
@@ -4,15 +4,71 @@ import logging
 import os
 import time
 import unittest
+import unittest.mock
 
 from maildaemon.config import load_config
-from maildaemon.imap_connection import IMAPConnection
+from maildaemon.imap_connection import parse_threads, uid_set, IMAPConnection
 
 from .config import TEST_CONFIG_PATH
 
 _LOG = logging.getLogger(__name__)
 
 
+class UidSetTests(unittest.TestCase):
+
+    def test_uid_set(self):
+        self.assertEqual(uid_set([1]), '1')
+        self.assertEqual(uid_set([1, 2, 3, 5, 7, 8]), '1:3,5,7:8')
+        self.assertEqual(uid_set([3, 1, 2]), '3,1:2')
+
+
+class ParseThreadsTests(unittest.TestCase):
+
+    def test_parse_threads(self):
+        self.assertEqual(parse_threads(b'(2)(3 6 (4 23)(44 7 96))'),
+                         [[2], [3, 6, 4, 23, 44, 7, 96]])
+        self.assertEqual(parse_threads(b'((1)(2 3))(4)'), [[1, 2, 3], [4]])
+        self.assertEqual(parse_threads(b''), [])
+
+
+class _FakeLink:
+    """Answer every continuation request of MULTIAPPEND command, and record sent data."""
+
+    capabilities = ('IMAP4REV1', 'MULTIAPPEND')
+
+    def __init__(self):
+        self.literal = None
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+
+    def _simple_command(self, name, *args):
+        self.sent.append(' '.join((name,) + args).encode())
+        literator, self.literal = self.literal, None
+        while True:
+            rest = literator(b'Ready for literal data')
+            self.sent.append(rest + b'\r\n')
+            if not rest:
+                return 'OK', [b'APPEND completed']
+
+
+class AddMessagesTests(unittest.TestCase):
+
+    def test_multiappend(self):
+        with unittest.mock.patch('imaplib.IMAP4_SSL'):
+            imap = IMAPConnection('imap.example.com', 993)
+        imap._link = _FakeLink()
+        imap._folder = 'Archive'
+        date = b'INTERNALDATE "01-Jan-2020 12:00:00 +0000"'
+        imap.add_messages([
+            (b'1 (UID 1 FLAGS (\\Seen) ' + date + b' BODY[] {5}', b'first'),
+            (b'2 (UID 2 FLAGS () ' + date + b' BODY[] {6}', b'second')], 'Archive', ['Flagged'])
+        self.assertEqual(imap._link.sent, [
+            b'APPEND "Archive" (\\Seen \\Flagged) "01-Jan-2020 12:00:00 +0000" {5}',
+            b'first', b' (\\Flagged) "01-Jan-2020 12:00:00 +0000" {6}\r\n', b'second', b'\r\n'])
+
+
 @unittest.skipUnless(os.environ.get('TEST_COMM') or os.environ.get('CI'),
                      'skipping tests that require server connection')
 class Tests(unittest.TestCase):
@@ -0,0 +1,32 @@
+"""Tests for summaries of latencies."""
+
+import unittest
+
+from maildaemon.latency_statistics import LatencyStatistics, latency_histogram
+
+
+class Tests(unittest.TestCase):
+
+    def test_latency_histogram(self):
+        histogram = latency_histogram([0.00001, 0.005, 0.5, 100.0], (0.001, 1.0, float('inf')))
+        self.assertEqual(histogram, {0.001: 1, 1.0: 2, float('inf'): 1})
+
+    def test_record(self):
+        latencies = LatencyStatistics((0.001, 1.0, float('inf')))
+        for elapsed in (0.00001, 0.005, 0.5, 100.0):
+            latencies.record('condition', elapsed)
+        summary = latencies.summarize()['condition']
+        self.assertEqual(summary['samples'], 4)
+        self.assertAlmostEqual(summary['total'], 100.50501)
+        self.assertAlmostEqual(summary['mean'], 100.50501 / 4)
+        self.assertEqual(summary['max'], 100.0)
+        self.assertEqual(summary['histogram'], {0.001: 1, 1.0: 2, float('inf'): 1})
+
+    def test_measure(self):
+        latencies = LatencyStatistics()
+        with latencies.measure('action'):
+            pass
+        with self.assertRaises(ValueError):
+            with latencies.measure('action'):
+                raise ValueError()
+        self.assertEqual(latencies.summarize()['action']['samples'], 1)
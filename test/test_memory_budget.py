@@ -0,0 +1,68 @@
+"""Tests for memory budget of cached message bodies."""
+
+import email
+import unittest
+import unittest.mock
+
+from maildaemon.folder import Folder
+from maildaemon.memory_budget import MemoryBudget
+from maildaemon.message import Message
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+RAW_MESSAGES = [TEST_MESSAGE_1_PATH.read_bytes(), TEST_MESSAGE_2_PATH.read_bytes()]
+
+
+def _make_messages(server, count: int):
+    messages = []
+    for uid in range(1, count + 1):
+        message = Message(
+            email.message_from_bytes(RAW_MESSAGES[uid % 2]), server, 'INBOX', uid)
+        message.track_body(server.memory_budget, 100)
+        messages.append(message)
+    return messages
+
+
+class Tests(unittest.TestCase):
+
+    def test_evict_and_rehydrate(self):
+        server = unittest.mock.Mock()
+        server.memory_budget = MemoryBudget(250)
+        server.retrieve_email_message.side_effect = \
+            lambda message: email.message_from_bytes(RAW_MESSAGES[message._origin_id % 2])
+        messages = _make_messages(server, 3)
+        self.assertEqual(server.memory_budget.used, 200)
+        self.assertEqual(server.memory_budget.evictions, 1)
+        self.assertTrue(messages[0]._body_evicted)
+        self.assertEqual(messages[0].subject, 'Different test message')
+        server.retrieve_email_message.assert_not_called()
+
+        self.assertEqual(messages[0].contents, ['This is another test message.\n'])
+        server.retrieve_email_message.assert_called_once_with(messages[0])
+        self.assertFalse(messages[0]._body_evicted)
+        self.assertTrue(messages[1]._body_evicted)
+        self.assertFalse(messages[2]._body_evicted)
+
+        messages[2].contents  # pylint: disable=pointless-statement
+        messages[0].contents  # pylint: disable=pointless-statement
+        self.assertEqual(server.memory_budget.evictions, 2)
+        self.assertEqual(server.retrieve_email_message.call_count, 1)
+
+    def test_global_budget(self):
+        global_budget = MemoryBudget(250)
+        servers = [unittest.mock.Mock(), unittest.mock.Mock()]
+        for server in servers:
+            server.memory_budget = MemoryBudget(None, global_budget)
+        first = _make_messages(servers[0], 2)
+        second = _make_messages(servers[1], 1)
+        self.assertTrue(first[0]._body_evicted)
+        self.assertFalse(first[1]._body_evicted)
+        self.assertFalse(second[0]._body_evicted)
+        self.assertEqual(len(servers[0].memory_budget), 1)
+        self.assertEqual(global_budget.used, 200)
+
+        folder = Folder(servers[1], 'INBOX')
+        folder.add_message(second[0])
+        folder.remove_message(second[0])
+        self.assertEqual(len(servers[1].memory_budget), 0)
+        self.assertEqual(global_budget.used, 100)
@@ -1,14 +1,19 @@
 """Test filtering of messages."""
 
+import importlib.util
 import logging
 import os
+import time
 import typing as t
 import unittest
 
 from maildaemon.config import load_config
 from maildaemon.connection import Connection
+from maildaemon.connection_group import ConnectionGroup
+from maildaemon.daemon_group import DaemonGroup
 from maildaemon.imap_connection import IMAPConnection
 from maildaemon.imap_cache import IMAPCache
+from maildaemon.message import Message
 from maildaemon.message_filter import MessageFilter
 
 from .config import TEST_CONFIG_PATH
@@ -31,6 +36,82 @@ class Tests(unittest.TestCase):
         msg_filter = MessageFilter(connections, [[('aa', func1)]], [func2])
         self.assertIsNotNone(msg_filter)
 
+    def test_statistics(self):
+        msg_filter = MessageFilter.from_dict(
+            {'condition': "'test' in message.subject.lower()"}, name='test-message')
+        message = Message()
+        message.subject = 'Test message'
+        self.assertTrue(msg_filter.applies_to(message))
+        message.subject = 'Another message'
+        self.assertFalse(msg_filter.applies_to(message))
+        message.subject = None
+        self.assertFalse(msg_filter.applies_to(message))
+        statistics = msg_filter.summarize_statistics()
+        _LOG.debug('%s', statistics)
+        self.assertEqual(statistics['name'], 'test-message')
+        self.assertEqual(statistics['evaluated'], 3)
+        self.assertEqual(statistics['matched'], 1)
+        self.assertEqual(statistics['errored'], 1)
+        self.assertEqual(statistics['action_failures'], 0)
+        self.assertEqual(statistics['latencies']['condition']['samples'], 2)
+
+    def test_time_budget(self):
+        msg_filter = MessageFilter.from_dict({
+            'condition': "re.fullmatch('(a+)+b', message.subject) is not None",
+            'time-budget': 0.05, 'max-budget-violations': 2}, name='catastrophic-regex')
+        message = Message()
+        message.subject = 40 * 'a'
+        for _ in range(2):
+            self.assertTrue(msg_filter.enabled)
+            start = time.perf_counter()
+            self.assertFalse(msg_filter.applies_to(message))
+            self.assertLess(time.perf_counter() - start, 5)
+        self.assertFalse(msg_filter.enabled)
+        self.assertEqual(msg_filter.statistics['budget_exceeded'], 2)
+        message.subject = 'aab'
+        self.assertFalse(msg_filter.applies_to(message))
+        self.assertEqual(msg_filter.statistics['evaluated'], 2)
+
+    def test_message_time_budget(self):
+        msg_filter = MessageFilter.from_dict({
+            'condition': "re.fullmatch('(a+)+b', message.subject) is not None",
+            'time-budget': 10, 'max-budget-violations': 2}, name='catastrophic-regex')
+        message = Message()
+        message.subject = 40 * 'a'
+        for _ in range(3):
+            self.assertIsNone(msg_filter.evaluate(message, 0.05))
+        self.assertTrue(msg_filter.enabled)
+        self.assertEqual(msg_filter.statistics['budget_exceeded'], 0)
+        trivial_filter = MessageFilter.from_dict({'condition': 'False'}, name='trivial')
+        daemon_group = DaemonGroup(ConnectionGroup(), [trivial_filter], message_time_budget=1e-6)
+        for _ in range(5):
+            self.assertIsNone(daemon_group._find_applicable_filter(message, [trivial_filter]))
+        self.assertTrue(trivial_filter.enabled)
+        self.assertEqual(trivial_filter.statistics['budget_exceeded'], 0)
+
+    def test_regex_engine(self):
+        msg_filter = MessageFilter.from_dict({
+            'condition': "re.search('test', message.subject) is not None", 'regex-engine': 're'})
+        message = Message()
+        message.subject = 'a test message'
+        self.assertTrue(msg_filter.applies_to(message))
+        with self.assertRaises(RuntimeError):
+            MessageFilter.from_dict({'condition': 'True', 'regex-engine': 'no-such-engine'})
+
+    @unittest.skipUnless(importlib.util.find_spec('re2'), 'google-re2 is not installed')
+    def test_regex_engine_re2(self):
+        msg_filter = MessageFilter.from_dict({
+            'condition': "re.fullmatch('(a+)+b', message.subject) is not None",
+            'regex-engine': 're2', 'time-budget': 5})
+        message = Message()
+        message.subject = 40 * 'a'
+        start = time.perf_counter()
+        self.assertFalse(msg_filter.applies_to(message))
+        self.assertLess(time.perf_counter() - start, 1)
+        message.subject = 'aab'
+        self.assertTrue(msg_filter.applies_to(message))
+        self.assertEqual(msg_filter.statistics['budget_exceeded'], 0)
+
     @unittest.skipUnless(os.environ.get('TEST_COMM') or os.environ.get('CI'),
                          'skipping test that requires server connection')
     def test_from_config(self):
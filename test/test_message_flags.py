@@ -0,0 +1,48 @@
+"""Tests for compact representation of message flags."""
+
+import sys
+import unittest
+
+from maildaemon.message_flags import SEEN, DELETED, MessageFlags
+from maildaemon.message import Message
+
+
+class Tests(unittest.TestCase):
+
+    def test_set_interface(self):
+        flags = MessageFlags(['Seen', 'Junk'])
+        self.assertEqual(flags.system, SEEN)
+        self.assertEqual(flags.keywords, ('Junk',))
+        self.assertIn('Seen', flags)
+        self.assertIn('Junk', flags)
+        self.assertNotIn('Deleted', flags)
+        self.assertEqual(flags, {'Seen', 'Junk'})
+        self.assertEqual(len(flags), 2)
+        flags.update({'Deleted', '$Forwarded'})
+        flags.discard('Seen')
+        flags.discard('Junk')
+        self.assertEqual(sorted(flags), ['$Forwarded', 'Deleted'])
+        self.assertEqual(flags | {'Seen'}, {'$Forwarded', 'Deleted', 'Seen'})
+        flags.clear()
+        self.assertEqual(flags, set())
+        self.assertFalse(flags)
+
+    def test_from_imap(self):
+        flags = MessageFlags.from_imap([b'\\Seen', b'\\Deleted', b'$Label1', b'\\Important'])
+        self.assertEqual(flags.system, SEEN | DELETED)
+        self.assertEqual(flags, {'Seen', 'Deleted', '$Label1', 'Important'})
+        other = MessageFlags.from_imap([b'\\Important', b'$Label1'])
+        self.assertIs(flags.keywords, other.keywords)
+        self.assertIs(flags.keywords[0], sys.intern('$Label1'))
+        self.assertNotEqual(flags, other)
+        other.assign(flags)
+        self.assertEqual(flags, other)
+
+    def test_message(self):
+        message = Message()
+        self.assertFalse(message.is_read)
+        message.flags.update({'Seen', 'Flagged'})
+        self.assertTrue(message.is_read)
+        self.assertTrue(message.is_flagged)
+        self.assertFalse(message.is_deleted)
+        self.assertFalse(message.is_answered)
@@ -0,0 +1,47 @@
+"""Tests for persistent store of messages."""
+
+import email
+import pathlib
+import tempfile
+import unittest
+
+from maildaemon.message import Message
+from maildaemon.message_store import split_raw_message, MessageStore
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+
+class Tests(unittest.TestCase):
+
+    def test_split_raw_message(self):
+        self.assertEqual(split_raw_message(b'A: b\r\n\r\nbody'), (b'A: b\r\n\r\n', b'body'))
+        self.assertEqual(split_raw_message(b'A: b\n\n'), (b'A: b\n\n', None))
+        self.assertEqual(split_raw_message(b'A: b\n'), (b'A: b\n', None))
+
+    def test_store(self):
+        raw_messages = [path.read_bytes() for path in (TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH)]
+        messages = [Message(email.message_from_bytes(raw)) for raw in raw_messages]
+        messages[0].flags.add('Seen')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = pathlib.Path(temp_dir, 'messages.sqlite3')
+            store = MessageStore(path, store_bodies=True)
+            for uid, (message, raw) in enumerate(zip(messages, raw_messages), 1):
+                store.save_message('account', 'INBOX', 7, uid, message, raw)
+            store.save_message('account', 'INBOX', 0, 'uidl', messages[1], raw_messages[1])
+            store.close()
+
+            store = MessageStore(path)
+            stored = store.load_messages('account', 'INBOX', 7)
+            self.assertEqual(set(stored), {1, 2})
+            self.assertEqual(stored[1].flags, {'Seen'})
+            self.assertEqual(stored[2].body, raw_messages[1])
+            self.assertEqual(
+                Message(email.message_from_bytes(stored[1].headers)).subject, 'Test message')
+            store.update_flags('account', 'INBOX', 7, {2: {'Seen', 'Flagged'}})
+            store.remove_messages('account', 'INBOX', 7, [1])
+            stored = store.load_messages('account', 'INBOX', 7)
+            self.assertEqual(set(stored), {2})
+            self.assertEqual(stored[2].flags, {'Seen', 'Flagged'})
+            self.assertEqual(store.load_messages('account', 'INBOX', 8), {})
+            self.assertEqual(store.load_messages('account', 'INBOX', 7), {})
+            store.close()
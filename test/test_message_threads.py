@@ -0,0 +1,114 @@
+"""Tests for index of conversation threads."""
+
+import email
+import unittest
+
+from maildaemon.folder import Folder
+from maildaemon.message import Message
+from maildaemon.message_threads import ThreadIndex, parse_message_ids
+
+
+def _make_message(uid: int, message_id: str, references: str = None,
+                  in_reply_to: str = None) -> Message:
+    headers = [f'Message-ID: {message_id}', 'Subject: test']
+    if references is not None:
+        headers.append(f'References: {references}')
+    if in_reply_to is not None:
+        headers.append(f'In-Reply-To: {in_reply_to}')
+    return Message(email.message_from_string('\n'.join(headers) + '\n\ntest\n'), None, 'INBOX', uid)
+
+
+class Tests(unittest.TestCase):
+
+    def test_parse_message_ids(self):
+        self.assertEqual(parse_message_ids('<a@x> <b@x>\n <c@x>'), ['<a@x>', '<b@x>', '<c@x>'])
+        self.assertEqual(parse_message_ids('<a@x> (comment)'), ['<a@x>'])
+        self.assertEqual(parse_message_ids(None), [])
+
+    def test_thread_of(self):
+        threads = ThreadIndex()
+        root = _make_message(1, '<1@x>')
+        reply = _make_message(2, '<2@x>', in_reply_to='<1@x>')
+        # reply to a message that is not in the index still joins the thread
+        nested = _make_message(3, '<4@x>', references='<1@x> <3@x>')
+        other = _make_message(4, '<5@x>')
+        for message in (nested, other, reply, root):
+            threads.add_message(message)
+        self.assertCountEqual(threads.thread_of(root), [root, reply, nested])
+        self.assertCountEqual(threads.thread_of(nested), [root, reply, nested])
+        self.assertEqual(threads.thread_of(other), [other])
+        self.assertIs(threads.parent_of(nested), root)
+        self.assertIs(threads.parent_of(reply), root)
+        self.assertIsNone(threads.parent_of(root))
+
+        threads.remove_message(reply)
+        self.assertCountEqual(threads.thread_of(root), [root, nested])
+        self.assertEqual(len(threads), 3)
+
+    def test_remove_message(self):
+        threads = ThreadIndex()
+        root = _make_message(1, '<1@x>')
+        reply = _make_message(2, '<3@x>', references='<1@x> <2@x>')
+        other = _make_message(3, '<4@x>', references='<5@x>')
+        server = _make_message(4, None)
+        for message in (root, reply, other):
+            threads.add_message(message)
+        threads.add_message(server, thread_id=1234)
+        threads.add_thread([root, server])
+
+        threads.remove_message(other)
+        self.assertNotIn('<4@x>', threads._parents)
+        self.assertNotIn('<5@x>', threads._set_parents)
+        self.assertEqual(len(threads._set_members), 1)
+
+        threads.remove_message(root)
+        self.assertCountEqual(threads.thread_of(reply), [reply, server])
+        self.assertIsNone(threads.parent_of(reply))
+        self.assertIn('<1@x>', threads._set_parents)
+
+        threads.remove_message(server)
+        late = _make_message(5, None)
+        threads.add_message(late, thread_id=1234)
+        self.assertCountEqual(threads.thread_of(reply), [reply, late])
+
+        threads.remove_message(late)
+        threads.remove_message(reply)
+        self.assertEqual(len(threads), 0)
+        self.assertEqual(threads._parents, {})
+        self.assertEqual(threads._set_parents, {})
+        self.assertEqual(threads._set_members, {})
+
+    def test_loops(self):
+        threads = ThreadIndex()
+        first = _make_message(1, '<1@x>', references='<2@x>')
+        second = _make_message(2, '<2@x>', references='<1@x>')
+        threads.add_message(first)
+        threads.add_message(second)
+        self.assertIs(threads.parent_of(first), second)
+        self.assertIsNone(threads.parent_of(second))
+        self.assertCountEqual(threads.thread_of(first), [first, second])
+
+    def test_server_threads(self):
+        threads = ThreadIndex()
+        messages = [_make_message(uid, f'<{uid}@x>') for uid in range(1, 6)]
+        messages[0].thread_id = 1234
+        threads.add_message(messages[0])
+        threads.add_message(messages[1], thread_id=1234)
+        threads.add_message(messages[2])
+        threads.add_message(messages[3])
+        threads.add_thread(messages[2:4])
+        self.assertCountEqual(threads.thread_of(messages[1]), messages[:2])
+        self.assertCountEqual(threads.thread_of(messages[2]), messages[2:4])
+        self.assertEqual(threads.thread_of(messages[4]), messages[4:])
+
+    def test_folder(self):
+        threads = ThreadIndex()
+        folder = Folder(None, 'INBOX', threads=threads)
+        root = _make_message(1, '<1@x>')
+        reply = _make_message(2, '<2@x>', references='<1@x>')
+        folder.add_message(root)
+        folder.add_message(reply)
+        self.assertCountEqual(threads.thread_of(reply), [root, reply])
+        folder.remove_message(root)
+        self.assertEqual(threads.thread_of(reply), [reply])
+        self.assertEqual(reply.thread, [reply])
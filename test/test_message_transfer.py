@@ -0,0 +1,106 @@
+"""Tests for transfer of messages between IMAP servers."""
+
+import mmap
+import unittest
+import unittest.mock
+
+from maildaemon.body_store import BodyStore
+from maildaemon.imap_cache import IMAPCache
+from maildaemon.message_store import split_raw_message
+from maildaemon.message_transfer import MessageTransfer
+
+from .config import TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
+
+
+class _FakeSource:
+    """Serve messages with given sizes, whose contents are their UIDs repeated."""
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.fetched = []
+        self.delete_messages = unittest.mock.Mock()
+
+    def retrieve_messages_parts(self, message_ids, parts, folder):
+        return [(f'{i} (UID {i} RFC822.SIZE {self.sizes[i]})'.encode(), None)
+                for i in message_ids]
+
+    def retrieve_raw_messages(self, message_ids, folder):
+        self.fetched.append(message_ids)
+        return [(f'{i} (UID {i} FLAGS ())'.encode(), bytes([i]) * self.sizes[i])
+                for i in message_ids]
+
+
+class _FakeTarget:
+
+    def __init__(self, fail_on_batch=None):
+        self.batches = []
+        self.fail_on_batch = fail_on_batch
+
+    def add_messages(self, messages_parts, folder, extra_flags):
+        if len(self.batches) == self.fail_on_batch:
+            raise RuntimeError('add_messages() failed')
+        # spooled messages are closed after append, so only their types and contents are kept
+        self.batches.append([(type(body), bytes(body[:1])) for _, body in messages_parts])
+
+
+class Tests(unittest.TestCase):
+
+    def test_batches(self):
+        source = _FakeSource({1: 10, 2: 10, 3: 10, 4: 50, 5: 10})
+        target = _FakeTarget()
+        transfer = MessageTransfer(source, 'INBOX', target, 'Archive', batch_size=2, batch_bytes=40)
+        statistics = transfer.run([1, 2, 3, 4, 5])
+        self.assertEqual(source.fetched, [[1, 2], [3], [4], [5]])
+        self.assertEqual(len(target.batches), 4)
+        source.delete_messages.assert_called_once_with([1, 2, 3, 4, 5], 'INBOX')
+        self.assertEqual(statistics.messages, 5)
+        self.assertEqual(statistics.bytes, 90)
+
+    def test_spooling(self):
+        source = _FakeSource({1: 10, 2: 100})
+        target = _FakeTarget()
+        statistics = MessageTransfer(
+            source, 'INBOX', target, 'Archive', spool_threshold=50).run([1, 2])
+        self.assertEqual(target.batches, [[(bytes, b'\x01'), (mmap.mmap, b'\x02')]])
+        self.assertEqual(statistics.spooled, 1)
+
+    def test_failed_append(self):
+        source = _FakeSource({i: 10 for i in range(1, 7)})
+        target = _FakeTarget(fail_on_batch=1)
+        transfer = MessageTransfer(source, 'INBOX', target, 'Archive', batch_size=2)
+        with self.assertRaises(RuntimeError):
+            transfer.run(list(range(1, 7)))
+        source.delete_messages.assert_called_once_with([1, 2], 'INBOX')
+
+    def test_failed_fetch(self):
+        source = _FakeSource({1: 10, 2: 10})
+        source.retrieve_raw_messages = unittest.mock.Mock(side_effect=[
+            [(b'1 (UID 1 FLAGS ())', b'1')], RuntimeError('retrieve_messages_parts() failed')])
+        target = _FakeTarget()
+        with self.assertRaises(RuntimeError):
+            MessageTransfer(source, 'INBOX', target, 'Archive', batch_size=1).run([1, 2])
+        source.delete_messages.assert_called_once_with([1], 'INBOX')
+
+    def test_body_store(self):
+        raw_messages = {1: TEST_MESSAGE_1_PATH.read_bytes(), 2: TEST_MESSAGE_2_PATH.read_bytes()}
+
+        def retrieve_messages_parts(message_ids, parts, folder):
+            if parts[-1] == 'BODY.PEEK[HEADER]':
+                return [(f'{i} (UID {i} FLAGS () RFC822.SIZE {len(raw_messages[i])})'.encode(),
+                         split_raw_message(raw_messages[i])[0]) for i in message_ids]
+            if parts[-1] == 'BODY.PEEK[]':
+                return [(f'{i} (UID {i})'.encode(), raw_messages[i]) for i in message_ids]
+            return [(f'{i} (UID {i} RFC822.SIZE {len(raw_messages[i])})'.encode(), None)
+                    for i in message_ids]
+
+        with unittest.mock.patch('imaplib.IMAP4_SSL'):
+            source = IMAPCache('imap.example.com', 993)
+        source.body_store = BodyStore()
+        source.body_store.put(raw_messages[1])
+        source.retrieve_messages_parts = retrieve_messages_parts
+        source.delete_messages = unittest.mock.Mock()
+        target = _FakeTarget()
+        statistics = MessageTransfer(source, 'INBOX', target, 'Archive').run([1, 2])
+        self.assertEqual(statistics.messages, 2)
+        self.assertEqual(len(source.body_store), 2)
+        self.assertEqual(source.body_store.hits, 1)
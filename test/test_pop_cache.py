@@ -1,13 +1,20 @@
 """Tests for daemon working with POP connections."""
 
+import io
 import logging
 import os
+import pathlib
+import tempfile
 import unittest
+import unittest.mock
 
+from maildaemon.cache_snapshot import CacheSnapshot
 from maildaemon.config import load_config
+from maildaemon.full_text_index import FullTextIndex
+from maildaemon.memory_budget import MemoryBudget
 from maildaemon.pop_cache import POPCache
 
-from .config import TEST_CONFIG_PATH
+from .config import TEST_CONFIG_PATH, TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
 
 _LOG = logging.getLogger(__name__)
 
@@ -27,3 +34,193 @@ class Tests(unittest.TestCase):
                 connection.disconnect()
                 self.assertIn('INBOX', connection.folders, msg=connection)
                 self.assertGreater(len(connection.folders['INBOX'].messages), 0, msg=connection)
+
+
+class _FakePOP3:
+    """Mailbox served like poplib does, with message numbers assigned in order.
+
+    Raw commands sent via the socket are answered too, and every batch of them is recorded.
+    Commands for messages without contents are answered with -ERR.
+    """
+
+    def __init__(self, *_, **__):
+        self.mailbox = []
+        self.retrieved = []
+        self.capabilities = {'TOP': [], 'UIDL': []}
+        self.batches = []
+        self.sock = unittest.mock.Mock()
+        self.sock.sendall.side_effect = self._receive
+        self.file = io.BytesIO()
+
+    def _receive(self, data: bytes):
+        commands = data.splitlines()
+        self.batches.append(commands)
+        replies = []
+        for command in commands:
+            name, message_id, *_ = command.split()
+            uidl, raw = self.mailbox[int(message_id) - 1]
+            if raw is None:
+                replies.append(b'-ERR no such message\r\n')
+                continue
+            if name == b'DELE':
+                replies.append(b'+OK\r\n')
+                continue
+            if name == b'TOP':
+                raw = raw[:raw.index(b'\n\n') + 1]
+            else:
+                self.retrieved.append(uidl)
+            lines = [b'.' + line if line.startswith(b'.') else line for line in raw.splitlines()]
+            replies.append(b'+OK\r\n' + b''.join(line + b'\r\n' for line in lines) + b'.\r\n')
+        position = self.file.tell()
+        self.file.seek(0, io.SEEK_END)
+        self.file.write(b''.join(replies))
+        self.file.seek(position)
+
+    def _getline(self):
+        line = self.file.readline()
+        return line.rstrip(b'\r\n'), len(line)
+
+    def capa(self):
+        return self.capabilities
+
+    def uidl(self):
+        return b'+OK', [f'{i} {uidl}'.encode() for i, (uidl, _) in enumerate(self.mailbox, 1)], 0
+
+    def list(self):
+        return b'+OK', [f'{i} {len(raw)}'.encode() for i, (_, raw) in enumerate(self.mailbox, 1)], 0
+
+    def retr(self, message_id: int):
+        uidl, raw = self.mailbox[message_id - 1]
+        self.retrieved.append(uidl)
+        return b'+OK', raw.splitlines(), len(raw)
+
+    def top(self, message_id: int, lines_count: int):
+        assert lines_count == 0, lines_count
+        _, raw = self.mailbox[message_id - 1]
+        headers = raw[:raw.index(b'\n\n') + 1]
+        return b'+OK', headers.splitlines() + [b''], len(headers)
+
+
+class IncrementalUpdateTests(unittest.TestCase):
+
+    def setUp(self):
+        with unittest.mock.patch('poplib.POP3_SSL', _FakePOP3):
+            self.cache = POPCache('pop.example.com', 995)
+        self.cache.update_folders()
+        self.link = self.cache._link
+        self.raw_messages = [TEST_MESSAGE_1_PATH.read_bytes(), TEST_MESSAGE_2_PATH.read_bytes()]
+
+    def test_update_twice(self):
+        self.link.mailbox = [('a', self.raw_messages[0]), ('b', self.raw_messages[1])]
+        folder = self.cache.folders['INBOX']
+        self.cache.update_messages_in(folder)
+        self.cache.update_messages_in(folder)
+        self.assertEqual(self.link.retrieved, ['a', 'b'])
+        self.assertEqual(len(folder.messages), 2)
+
+    def test_removed_and_renumbered(self):
+        self.link.mailbox = [('a', self.raw_messages[0]), ('b', self.raw_messages[1])]
+        folder = self.cache.folders['INBOX']
+        self.cache.update_messages_in(folder)
+        self.link.mailbox = [('b', self.raw_messages[1]), ('c', self.raw_messages[0])]
+        self.cache.update_messages_in(folder)
+        self.assertEqual(self.link.retrieved, ['a', 'b', 'c'])
+        self.assertEqual(sorted(folder.uids), [1, 2])
+        self.assertEqual(folder.find_message(uid=1).subject, 'Different test message')
+        self.assertEqual(self.cache.snapshot_uid(folder.find_message(uid=2)), 'c')
+
+    def test_snapshot(self):
+        self.link.mailbox = [('a', self.raw_messages[0]), ('b', self.raw_messages[1])]
+        self.cache.update_messages_in(self.cache.folders['INBOX'])
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = CacheSnapshot(pathlib.Path(directory, 'snapshot.bin'))
+            snapshot.save([self.cache])
+            snapshot.close()
+            self.setUp()
+            self.cache.snapshot = CacheSnapshot(pathlib.Path(directory, 'snapshot.bin'))
+            self.link.mailbox = [('b', self.raw_messages[1]), ('c', self.raw_messages[0])]
+            folder = self.cache.folders['INBOX']
+            self.cache.update_messages_in(folder)
+            self.assertEqual(self.link.retrieved, ['c'])
+            self.assertTrue(folder.find_message(uid=1).headers_only)
+            self.cache.snapshot.close()
+
+    def test_headers_only(self):
+        self.link.mailbox = [('a', self.raw_messages[0]), ('b', self.raw_messages[1])]
+        self.cache.headers_only = True
+        folder = self.cache.folders['INBOX']
+        self.cache.update_messages_in(folder)
+        self.assertEqual(self.link.retrieved, [])
+        message = folder.find_message(uid=2)
+        self.assertTrue(message.headers_only)
+        self.assertEqual(message.subject, 'Different test message')
+        self.assertEqual(message.contents, [])
+        self.assertIn('another test message', message.email_message.get_payload())
+        self.assertEqual(self.link.retrieved, ['b'])
+        self.assertFalse(message.headers_only)
+        self.assertEqual(message.contents, ['This is another test message.\n'])
+
+    def test_headers_only_memory_budget(self):
+        self.link.mailbox = [('a', self.raw_messages[0]), ('b', self.raw_messages[1])]
+        self.cache.headers_only = True
+        self.cache.memory_budget = MemoryBudget()
+        folder = self.cache.folders['INBOX']
+        self.cache.update_messages_in(folder)
+        self.assertEqual((len(self.cache.memory_budget), self.cache.memory_budget.used), (0, 0))
+        folder.find_message(uid=2).retrieve_body()
+        self.assertEqual(len(self.cache.memory_budget), 1)
+        self.assertEqual(self.cache.memory_budget.used, len(self.raw_messages[1]))
+
+    def test_headers_only_full_text_index(self):
+        self.link.mailbox = [('a', self.raw_messages[0]), ('b', self.raw_messages[1])]
+        self.cache.headers_only = True
+        self.cache.full_text_index = FullTextIndex()
+        folder = self.cache.folders['INBOX']
+        self.cache.update_messages_in(folder)
+        self.assertEqual(self.cache.full_text_index.search('another'), [])
+        folder.find_message(uid=2).retrieve_body()
+        self.assertEqual(self.cache.full_text_index.search('another'),
+                         [(self.cache.account, 'INBOX', 'b')])
+
+    def test_pipelining(self):
+        self.link.mailbox = [
+            (str(i), self.raw_messages[i % 2].replace(b'This', b'..This')) for i in range(120)]
+        self.link.capabilities['PIPELINING'] = []
+        folder = self.cache.folders['INBOX']
+        self.cache.update_messages_in(folder)
+        self.assertEqual(len(folder.messages), 120)
+        self.assertEqual([len(batch) for batch in self.link.batches], [50, 50, 20])
+        self.assertEqual(
+            folder.find_message(uid=2).contents, ['..This is another test message.\n'])
+        self.cache.delete_messages(list(range(1, 61)))
+        self.assertEqual([len(batch) for batch in self.link.batches[3:]], [50, 10])
+        streamed, = self.cache.retrieve_messages_streamed([2], keep_raw=True)
+        self.assertEqual(streamed.raw_message, b'\n'.join(self.link.retr(2)[1]) + b'\n')
+        self.assertEqual(streamed.size, len(streamed.raw_message))
+
+    def test_no_pipelining(self):
+        self.link.mailbox = [('a', self.raw_messages[0]), ('b', self.raw_messages[1])]
+        self.cache.update_messages_in(self.cache.folders['INBOX'])
+        self.assertEqual([len(batch) for batch in self.link.batches], [1, 1])
+
+    def test_pipelining_error_reply(self):
+        self.link.mailbox = [('a', self.raw_messages[0]), ('b', None), ('c', self.raw_messages[1])]
+        self.link.capabilities['PIPELINING'] = []
+        folder = self.cache.folders['INBOX']
+        self.cache.update_messages_in(folder)
+        self.assertEqual(self.link.retrieved, ['a', 'c'])
+        self.assertEqual(sorted(folder.uids), [1, 3])
+        with self.assertRaisesRegex(RuntimeError, r'\[2\]'):
+            self.cache.delete_messages([1, 2, 3])
+        self.assertEqual(self.link.file.read(), b'')
+
+    def test_pipelining_stopped_early(self):
+        self.link.mailbox = [(str(i), self.raw_messages[i % 2]) for i in range(10)]
+        self.link.capabilities['PIPELINING'] = []
+        self.cache.full_text_index = unittest.mock.Mock()
+        self.cache.full_text_index.add_message.side_effect = RuntimeError('add_message() failed')
+        with self.assertRaises(RuntimeError):
+            self.cache.update_messages_in(self.cache.folders['INBOX'])
+        self.assertEqual(self.link.file.read(), b'')
+        self.cache.delete_messages([1, 2])
+        self.assertEqual(self.link.file.read(), b'')
@@ -0,0 +1,57 @@
+"""Tests for offline replay of message filters."""
+
+import email
+import mailbox
+import pathlib
+import tempfile
+import unittest
+
+from maildaemon.config import load_config
+from maildaemon.replay import load_messages, replay_filters_from_config
+
+from .config import TEST_CONFIG_PATH, TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH, TEST_MESSAGE_PATHS
+
+
+class Tests(unittest.TestCase):
+
+    config = load_config(TEST_CONFIG_PATH)
+
+    def test_load_directory(self):
+        messages = load_messages(TEST_MESSAGE_1_PATH.parent)
+        self.assertEqual(len(messages), len(TEST_MESSAGE_PATHS))
+        self.assertEqual(messages[0].subject, 'Test message')
+
+    def test_load_single_file(self):
+        messages = load_messages(TEST_MESSAGE_2_PATH)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].subject, 'Different test message')
+
+    def test_load_mbox_and_maildir(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mbox_path = pathlib.Path(temp_dir, 'test.mbox')
+            maildir_path = pathlib.Path(temp_dir, 'test_maildir')
+            archives = (mailbox.mbox(mbox_path), mailbox.Maildir(maildir_path))
+            for archive, message_class, read_flag in zip(
+                    archives, (mailbox.mboxMessage, mailbox.MaildirMessage), ('R', 'S')):
+                for i, path in enumerate(TEST_MESSAGE_PATHS):
+                    message = message_class(email.message_from_bytes(path.read_bytes()))
+                    if i == 0:
+                        message.set_flags(read_flag)
+                    archive.add(message)
+                archive.close()
+            for path in (mbox_path, maildir_path):
+                with self.subTest(path=path):
+                    messages = sorted(load_messages(path), key=lambda _: _.subject)
+                    self.assertEqual(len(messages), len(TEST_MESSAGE_PATHS))
+                    self.assertTrue(messages[1].is_read)
+                    self.assertFalse(messages[0].is_read)
+
+    def test_replay(self):
+        report = replay_filters_from_config(self.config, TEST_MESSAGE_1_PATH.parent)
+        self.assertEqual(report['messages'], len(TEST_MESSAGE_PATHS))
+        self.assertGreater(report['messages_per_second'], 0)
+        self.assertEqual(len(report['filters']), len(self.config['filters']))
+        self.assertEqual(len(report['fired']), len(TEST_MESSAGE_PATHS))
+        for _, message_filter, actions in report['fired']:
+            self.assertEqual(message_filter.name, 'test-message')
+            self.assertEqual(actions, ['mark(message, read)'])
@@ -1,11 +1,14 @@
 """Tests for handling SMTP connections."""
 
 import email
+import io
 import os
+import smtplib
 import unittest
+import unittest.mock
 
 from maildaemon.config import load_config
-from maildaemon.smtp_connection import SMTPConnection
+from maildaemon.smtp_connection import CHUNK_SIZE, SMTPConnection
 
 from .config import TEST_CONFIG_PATH, TEST_MESSAGE_1_PATH, TEST_MESSAGE_2_PATH
 
@@ -51,3 +54,81 @@ class Tests(unittest.TestCase):
         for _ in range(5):
             smtp.send_message(message)
         smtp.disconnect()
+
+
+class _FakeSocket:
+    """Record data sent to the server, whose replies are read from a file instead."""
+
+    def __init__(self):
+        self.writes = []
+
+    def sendall(self, data):
+        self.writes.append(bytes(data))
+
+    def close(self):
+        pass
+
+
+def _connect(extensions: str, replies: bytes) -> SMTPConnection:
+    with unittest.mock.patch('smtplib.SMTP_SSL'):
+        smtp = SMTPConnection('smtp.example.com', 465)
+    link = smtplib.SMTP()
+    link.sock = _FakeSocket()
+    link.file = io.BytesIO(replies)
+    link.ehlo_resp = b'smtp.example.com'
+    link.does_esmtp = True
+    link.esmtp_features = {extension: '' for extension in extensions.split()}
+    smtp._link = link
+    return smtp
+
+
+class PipeliningTests(unittest.TestCase):
+
+    def setUp(self):
+        with TEST_MESSAGE_1_PATH.open(encoding='utf-8') as email_file:
+            self.message = email.message_from_file(email_file)
+        self.recipients = ['a@example.com', 'b@example.com', 'c@example.com']
+
+    def test_pipelining(self):
+        smtp = _connect('pipelining', b'250 ok\r\n250 ok\r\n550 no\r\n250 ok\r\n'
+                        b'354 go\r\n250 ok\r\n')
+        with self.assertRaises(RuntimeError) as context:
+            smtp.send_message(self.message, self.recipients)
+        self.assertEqual(context.exception.__cause__.recipients, {'b@example.com': (550, b'no')})
+        writes = smtp._link.sock.writes
+        self.assertEqual(writes[0], b'mail FROM:<noreply@domain.com>\r\nrcpt TO:<a@example.com>\r\n'
+                         b'rcpt TO:<b@example.com>\r\nrcpt TO:<c@example.com>\r\n')
+        self.assertEqual(writes[1], b'data\r\n')
+        self.assertTrue(writes[2].endswith(b'\r\n.\r\n'))
+
+    def test_sender_refused(self):
+        smtp = _connect('pipelining', b'550 no\r\n503 no\r\n503 no\r\n503 no\r\n250 ok\r\n')
+        with self.assertRaises(RuntimeError) as context:
+            smtp.send_message(self.message, self.recipients)
+        self.assertIsInstance(context.exception.__cause__, smtplib.SMTPSenderRefused)
+        self.assertEqual(smtp._link.sock.writes[-1], b'rset\r\n')
+
+    def test_chunking(self):
+        raw_message = b'Subject: test\r\n\r\n' + b'.\r\n' * (CHUNK_SIZE // 2)
+        smtp = _connect('pipelining chunking', b'250 ok\r\n' * 6)
+        smtp.send_raw_message(raw_message, 'test@domain.com', self.recipients)
+        writes = smtp._link.sock.writes
+        self.assertEqual(writes[1::2], [
+            b'BDAT 65536\r\n', f'BDAT {len(raw_message) - CHUNK_SIZE} LAST\r\n'.encode()])
+        self.assertEqual(b''.join(writes[2::2]), raw_message)
+        self.assertEqual(smtp._link.file.read(), b'')
+
+    def test_chunking_file(self):
+        smtp = _connect('chunking', b'250 ok\r\n' * 6)
+        smtp.send_raw_message(io.BytesIO(b'x' * CHUNK_SIZE), 'test@domain.com', self.recipients)
+        writes = smtp._link.sock.writes
+        self.assertEqual([write for write in writes if write.startswith(b'BDAT')],
+                         [b'BDAT 65536\r\n', b'BDAT 0 LAST\r\n'])
+        self.assertEqual(len(writes), 7)
+
+    def test_fallback(self):
+        smtp = _connect('8bitmime', b'')
+        smtp._link = unittest.mock.Mock(wraps=smtp._link, esmtp_features={})
+        smtp._link.send_message.return_value = {}
+        smtp.send_message(self.message)
+        smtp._link.send_message.assert_called_once_with(self.message, to_addrs=None)
@@ -0,0 +1,127 @@
+"""Tests for pool of SMTP sessions."""
+
+import email
+import smtplib
+import threading
+import time
+import unittest
+import unittest.mock
+
+from maildaemon.smtp_connection import SMTPConnection
+from maildaemon.smtp_daemon import SMTPDaemon
+from maildaemon.smtp_pool import TokenBucket, SMTPPool
+
+from .config import TEST_MESSAGE_1_PATH
+
+
+def _load_message() -> email.message.Message:
+    return email.message_from_bytes(TEST_MESSAGE_1_PATH.read_bytes())
+
+
+class _SessionFactory:
+    """Create sessions with mocked SMTP links, tracking how many send at the same time."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sessions = []
+        self.sending = 0
+        self.max_sending = 0
+        self._lock = threading.Lock()
+
+    def _send_message(self, *args, **kwargs):
+        with self._lock:
+            self.sending += 1
+            self.max_sending = max(self.max_sending, self.sending)
+        time.sleep(self.delay)
+        with self._lock:
+            self.sending -= 1
+        return {}
+
+    def __call__(self) -> SMTPConnection:
+        with unittest.mock.patch('smtplib.SMTP_SSL'):
+            session = SMTPConnection('smtp.example.com', 465)
+        session.login = 'user'
+        session.password = 'password'
+        session._link.login.return_value = (235, b'ok')
+        session._link.rset.return_value = (250, b'ok')
+        session._link.quit.return_value = (221, b'bye')
+        session._link.send_message.side_effect = self._send_message
+        self.sessions.append(session)
+        return session
+
+
+class Tests(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=20, burst=2)
+        start = time.monotonic()
+        for _ in range(4):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_reuse(self):
+        factory = _SessionFactory()
+        pool = SMTPPool(factory, size=2)
+        for _ in range(5):
+            pool.send_message(_load_message())
+        self.assertEqual(len(factory.sessions), 1)
+        self.assertEqual(factory.sessions[0]._link.send_message.call_count, 5)
+        self.assertEqual(pool.statistics['sent'], 5)
+        pool.close()
+        factory.sessions[0]._link.quit.assert_called_once()
+
+    def test_reset_and_drop(self):
+        factory = _SessionFactory()
+        pool = SMTPPool(factory)
+        pool.send_message(_load_message())
+        session = factory.sessions[0]
+        session._link.send_message.side_effect = smtplib.SMTPDataError(451, b'try again')
+        with self.assertRaises(RuntimeError):
+            pool.send_message(_load_message())
+        self.assertEqual(pool.statistics['sessions_reset'], 1)
+        session._link.send_message.side_effect = smtplib.SMTPServerDisconnected()
+        session._link.rset.side_effect = smtplib.SMTPServerDisconnected()
+        with self.assertRaises(RuntimeError):
+            pool.send_message(_load_message())
+        self.assertEqual(pool.statistics['sessions_dropped'], 1)
+        pool.send_message(_load_message())
+        self.assertEqual(len(factory.sessions), 2)
+        self.assertEqual(pool.statistics['failed'], 2)
+        self.assertEqual(pool.statistics['sent'], 2)
+
+    def test_unexpected_error(self):
+        factory = _SessionFactory()
+        pool = SMTPPool(factory, size=1)
+        pool.send_message(_load_message())
+        factory.sessions[0]._link.send_message.side_effect = UnicodeEncodeError(
+            'ascii', 'ż', 0, 1, 'ordinal not in range(128)')
+        with self.assertRaises(UnicodeEncodeError):
+            pool.send_message(_load_message())
+        self.assertEqual(pool.statistics['sessions_dropped'], 1)
+        pool.send_message(_load_message())
+        self.assertEqual(len(factory.sessions), 2)
+        self.assertEqual(pool.statistics['failed'], 1)
+
+    def test_parallel(self):
+        factory = _SessionFactory(delay=0.05)
+        pool = SMTPPool(factory, size=3)
+        messages = [(_load_message(), [f'user{i}@example.com']) for i in range(9)]
+        results = dict(pool.send_messages(messages))
+        self.assertEqual(results, {i: None for i in range(9)})
+        self.assertEqual(len(factory.sessions), 3)
+        self.assertEqual(factory.max_sending, 3)
+        statistics = pool.summarize_statistics()
+        self.assertEqual(statistics['sent'], 9)
+        self.assertGreater(statistics['messages_per_second'], 0)
+
+    def test_daemon(self):
+        with unittest.mock.patch('smtplib.SMTP_SSL'):
+            daemon = SMTPDaemon('smtp.example.com', 465)
+        factory = _SessionFactory()
+        daemon.pool = SMTPPool(factory, size=2)
+        for _ in range(4):
+            daemon.add_to_outbox(_load_message())
+        daemon.update()
+        self.assertEqual(daemon.outbox, [])
+        self.assertEqual(daemon.pool.statistics['sent'], 4)
+        daemon._link.send_message.assert_not_called()
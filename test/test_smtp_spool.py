@@ -0,0 +1,112 @@
+"""Tests for persistent queue of outgoing messages."""
+
+import email
+import pathlib
+import smtplib
+import tempfile
+import unittest
+import unittest.mock
+
+from maildaemon.smtp_daemon import SMTPDaemon
+from maildaemon.smtp_spool import SMTPSpool, classify_failure, recipients_of
+
+from .config import TEST_MESSAGE_1_PATH
+
+
+def _load_message(*recipients: str) -> email.message.Message:
+    message = email.message_from_bytes(TEST_MESSAGE_1_PATH.read_bytes())
+    del message['To']
+    message['To'] = ', '.join(recipients)
+    return message
+
+
+def _refused(**codes: int) -> RuntimeError:
+    refused = smtplib.SMTPRecipientsRefused(
+        {f'user@{domain}.com': (code, b'refused') for domain, code in codes.items()})
+    try:
+        raise RuntimeError('send_message() failed') from refused
+    except RuntimeError as err:
+        return err
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._directory.name)
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_recipients(self):
+        message = _load_message('A <a@one.com>', 'b@two.com')
+        message['Bcc'] = 'c@three.com'
+        self.assertEqual(recipients_of(message), ['a@one.com', 'b@two.com', 'c@three.com'])
+
+    def test_classify_failure(self):
+        recipients = ['user@a.com', 'user@b.com']
+        self.assertEqual(classify_failure(_refused(a=450), recipients), {'user@a.com': 450})
+        data_error = smtplib.SMTPDataError(554, b'rejected')
+        self.assertEqual(classify_failure(data_error, recipients),
+                         {'user@a.com': 554, 'user@b.com': 554})
+        self.assertEqual(classify_failure(smtplib.SMTPServerDisconnected(), recipients),
+                         {'user@a.com': None, 'user@b.com': None})
+
+    def test_persistence(self):
+        spool = SMTPSpool(self.path)
+        entry = spool.add(_load_message('user@a.com'))
+        self.path.joinpath('queue', 'incomplete.eml').write_bytes(b'')
+        spool = SMTPSpool(self.path)
+        self.assertEqual(spool.entries, [entry])
+        self.assertEqual(spool.load_message(entry)['Subject'], 'Test message')
+        self.assertFalse(self.path.joinpath('queue', 'incomplete.eml').exists())
+
+    def test_backoff_per_domain(self):
+        spool = SMTPSpool(self.path, base_delay=10)
+        first = spool.add(_load_message('user@a.com', 'user@b.com'))
+        second = spool.add(_load_message('user@b.com'))
+        third = spool.add(_load_message('user@c.com'))
+        spool.record_failure(first, _refused(a=450), now=first.queued)
+        first, = [entry for entry in spool.entries if entry.entry_id == first.entry_id]
+        self.assertEqual(first.recipients, ('user@a.com',))
+        self.assertEqual(first.attempts, 1)
+        self.assertEqual(spool.due(first.queued + 5), [second, third])
+        self.assertEqual(spool.due(first.queued + 10), [first, second, third])
+        spool.record_failure(first, _refused(a=421), now=first.queued + 10)
+        self.assertEqual(spool.due(first.queued + 25), [second, third])
+        self.assertEqual(spool.due(first.queued + 30), spool.entries)
+        spool = SMTPSpool(self.path, base_delay=10)
+        self.assertEqual(spool.due(first.queued + 25), [second, third])
+
+    def test_permanent_failure(self):
+        spool = SMTPSpool(self.path)
+        entry = spool.add(_load_message('user@a.com', 'user@b.com'))
+        spool.record_failure(entry, _refused(a=550, b=451))
+        spool.record_failure(spool.entries[0], _refused(b=550))
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(spool.failed, 1)
+        self.assertTrue(self.path.joinpath('failed', f'{entry.entry_id}.eml').is_file())
+
+    def test_max_age(self):
+        spool = SMTPSpool(self.path, max_age=60)
+        entry = spool.add(_load_message('user@a.com'))
+        spool.record_failure(entry, _refused(a=450), now=entry.queued + 61)
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(spool.failed, 1)
+
+    def test_daemon(self):
+        with unittest.mock.patch('smtplib.SMTP_SSL') as smtp_class:
+            daemon = SMTPDaemon('smtp.example.com', 465)
+        link = smtp_class.return_value
+        daemon.spool = SMTPSpool(self.path)
+        for domain in 'abc':
+            daemon.add_to_outbox(_load_message(f'user@{domain}.com'))
+        link.send_message.side_effect = [
+            {}, smtplib.SMTPServerDisconnected('lost connection'), {}]
+        daemon.update()
+        self.assertEqual(link.send_message.call_count, 3)
+        self.assertEqual(len(daemon.outbox), 1)
+        self.assertEqual(daemon.outbox[0].recipients, ('user@b.com',))
+        self.assertEqual(daemon.spool.delivered, 2)
+        daemon.update()
+        self.assertEqual(link.send_message.call_count, 3)